@@ -0,0 +1,206 @@
+import itertools
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+MAX_IN_FLIGHT = 4  # Requests one model may run at once from this chatbot
+MAX_QUEUE = 32  # Requests waiting for one model before new ones are turned away
+MAX_WAIT = 90  # Seconds a request may wait for a slot, and the longest estimated wait accepted
+TOKENS_PER_MINUTE = 60000  # Prompt plus completion tokens one user may spend per minute
+SHORT_PROMPT_TOKENS = 2000  # Prompts up to this size jump ahead of long ones
+STARVATION_SECONDS = 20  # Long prompts waiting this long are served like short ones
+DEFAULT_SERVICE_SECONDS = 10.0  # Assumed request duration before any has finished
+SERVICE_ALPHA = 0.2  # Weight of the newest duration in the moving average
+RATE_WINDOW = 60
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Ticket:
+    def __init__(self, user, model, tokens, seq, rate_limited=True):
+        self.user = user
+        self.model = model
+        self.tokens = tokens
+        self.rate_limited = rate_limited  # False for background work that must not use up the user's rate
+        self.seq = seq
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+        self.completion_tokens = 0  # Set by slot() users so the reply counts towards the rate
+
+    @property
+    def short(self):
+        return self.tokens <= SHORT_PROMPT_TOKENS
+
+
+class AdmissionController:
+    """In-process gate between the chatbot sessions and the model backends.
+
+    Each model runs at most max_in_flight requests; the rest wait in per-user
+    queues. A free slot goes to short prompts first, then to the user who has
+    been served the fewest tokens, so one user with many huge prompts cannot
+    starve everyone else. Users over their token rate, full queues and waits
+    that could not finish within max_wait are rejected at once.
+    """
+
+    def __init__(self, max_in_flight=MAX_IN_FLIGHT, max_queue=MAX_QUEUE, max_wait=MAX_WAIT,
+                 tokens_per_minute=TOKENS_PER_MINUTE):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.tokens_per_minute = tokens_per_minute
+        self.in_flight = defaultdict(int)
+        self.queues = defaultdict(lambda: defaultdict(deque))  # model -> user -> tickets
+        self.served = defaultdict(lambda: defaultdict(int))  # model -> user -> tokens, for fairness
+        self.spent = defaultdict(deque)  # user -> (time, tokens) within the rate window
+        self.service_seconds = defaultdict(lambda: DEFAULT_SERVICE_SECONDS)
+        self.rejected = defaultdict(int)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    def _tokens_spent(self, user, now):
+        spent = self.spent[user]
+        while spent and spent[0][0] <= now - RATE_WINDOW:
+            spent.popleft()
+        return sum(tokens for _, tokens in spent)
+
+    def _waiting(self, model):
+        return sum(len(q) for q in self.queues[model].values())
+
+    def _priority(self, ticket, now):
+        # Short (or long-waiting) prompts first, then the least served user, then arrival order
+        urgent = ticket.short or now - ticket.enqueued_at >= STARVATION_SECONDS
+        return (not urgent, self.served[ticket.model][ticket.user], ticket.seq)
+
+    def _next(self, model, now):
+        heads = [q[0] for q in self.queues[model].values() if q]
+        return min(heads, key=lambda t: self._priority(t, now)) if heads else None
+
+    def position(self, ticket):
+        """1-based place in line for the model; 0 once the request is running."""
+        if ticket.started_at is not None:
+            return 0
+        now = time.monotonic()
+        key = self._priority(ticket, now)
+        ahead = sum(
+            1 for q in self.queues[ticket.model].values() for t in q
+            if t is not ticket and self._priority(t, now) < key
+        )
+        return ahead + 1
+
+    def estimated_wait(self, model, position):
+        return position / self.max_in_flight * self.service_seconds[model]
+
+    def _reject(self, model, message, retry_after=None):
+        self.rejected[model] += 1
+        raise AdmissionRejected(message, retry_after)
+
+    def acquire(self, user, model, tokens, on_wait=None, poll=0.5, rate_limited=True):
+        """Block until the request may run and return its ticket, or raise AdmissionRejected.
+
+        on_wait(position, estimated_seconds) is called while the request waits.
+        With rate_limited=False the request still waits for a slot but is
+        neither checked against nor charged to the user's token rate.
+        """
+        now = time.monotonic()
+        with self._cond:
+            spent = self._tokens_spent(user, now)
+            if rate_limited and spent + tokens > self.tokens_per_minute and spent:
+                retry_after = RATE_WINDOW - (now - self.spent[user][0][0])
+                self._reject(model, f"Token rate limit reached ({self.tokens_per_minute:,} tokens per minute)", retry_after)
+            waiting = self._waiting(model)
+            if self.in_flight[model] >= self.max_in_flight:
+                if waiting >= self.max_queue:
+                    self._reject(model, f"{model} is overloaded: {waiting} requests already waiting", self.max_wait)
+                expected = self.estimated_wait(model, waiting + 1)
+                if expected > self.max_wait:
+                    self._reject(model, f"{model} is overloaded: expected wait {expected:.0f}s", expected)
+            ticket = Ticket(user, model, tokens, next(self._seq), rate_limited)
+            self.queues[model][user].append(ticket)
+        try:
+            while True:
+                with self._cond:
+                    if self._can_start(ticket):
+                        return self._start(ticket)
+                    waited = time.monotonic() - ticket.enqueued_at
+                    if waited >= self.max_wait:
+                        self._reject(model, f"No free slot on {model} after {waited:.0f}s", self.max_wait)
+                    if on_wait is None:
+                        self._cond.wait(poll)
+                        continue
+                    position = self.position(ticket)
+                    expected = self.estimated_wait(model, position)
+                # on_wait may be a slow UI call, so other sessions must not wait for it on the lock
+                on_wait(position, expected)
+                with self._cond:
+                    if not self._can_start(ticket):
+                        self._cond.wait(poll)
+        except BaseException:
+            with self._cond:
+                self._dequeue(ticket)
+                self._cond.notify_all()
+            raise
+
+    def _can_start(self, ticket):
+        model = ticket.model
+        return self.in_flight[model] < self.max_in_flight and self._next(model, time.monotonic()) is ticket
+
+    def _start(self, ticket):
+        # Tokens count towards the rate only once the request runs, so rejected requests cost nothing
+        self._dequeue(ticket)
+        self.in_flight[ticket.model] += 1
+        self.served[ticket.model][ticket.user] += ticket.tokens
+        ticket.started_at = time.monotonic()
+        if ticket.rate_limited:
+            self.spent[ticket.user].append((ticket.started_at, ticket.tokens))
+        return ticket
+
+    def _dequeue(self, ticket):
+        queue = self.queues[ticket.model][ticket.user]
+        if ticket in queue:
+            queue.remove(ticket)
+        if not queue:
+            del self.queues[ticket.model][ticket.user]
+
+    def release(self, ticket, completion_tokens=0):
+        with self._cond:
+            self.in_flight[ticket.model] -= 1
+            if completion_tokens:
+                if ticket.rate_limited:
+                    self.spent[ticket.user].append((time.monotonic(), completion_tokens))
+                self.served[ticket.model][ticket.user] += completion_tokens
+            duration = time.monotonic() - ticket.started_at
+            self.service_seconds[ticket.model] = (
+                SERVICE_ALPHA * duration + (1 - SERVICE_ALPHA) * self.service_seconds[ticket.model]
+            )
+            # Fairness only needs recent history: decay served tokens once nobody is waiting
+            if not self._waiting(ticket.model):
+                self.served[ticket.model].clear()
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, user, model, tokens, rate_limited=True):
+        """Hold a slot for a request made inside the with block; yields the ticket."""
+        ticket = self.acquire(user, model, tokens, rate_limited=rate_limited)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket, ticket.completion_tokens)
+
+    def status(self):
+        with self._cond:
+            models = set(self.in_flight) | set(self.queues)
+            return [
+                {
+                    "model": model,
+                    "in_flight": self.in_flight[model],
+                    "waiting": self._waiting(model),
+                    "rejected": self.rejected[model],
+                    "avg_seconds": round(self.service_seconds[model], 1),
+                }
+                for model in sorted(models)
+            ]
@@ -0,0 +1,28 @@
+# Predefined AI Roles, shared by the chatbots and chat_batch.py
+AI_ROLES = {
+    "General Assistant": "You are a versatile assistant designed for general-purpose personal assistance, helping with a wide range of tasks and questions.",
+    "Secretary": "You are a secretary assisting with drafting documents, proofreading, and managing text-based tasks.",
+    "Programmer": "You are a programmer skilled in writing, debugging, and explaining code across various languages.",
+    "Data Analyzer": "You are a data analyst proficient in extracting, analyzing, and interpreting data from various formats.",
+    "Teacher": "You are a teacher tasked with preparing course materials, explaining concepts, and aiding in education.",
+    "Trip Advisor": "You are a trip advisor specializing in planning trips, suggesting itineraries, and providing travel advice."
+}
+DEFAULT_ROLE = "General Assistant"
+CUSTOM_ROLE_DESC = "You are a helpful assistant with a custom role."
+
+
+def role_description(role):
+    """Description of a predefined role; any other text is used as a custom role description."""
+    if not role:
+        return AI_ROLES[DEFAULT_ROLE]
+    return AI_ROLES.get(role, role)
+
+
+def system_prompt(role_desc):
+    # System message with the selected AI role, as chat_bot_up15.py sends it
+    return (
+        f"{role_desc} "
+        "You are a helpful assistant. If the user provides uploaded data in their message, "
+        "use it to answer their question or follow their instructions. "
+        "Do not ask for additional data or links if it is already provided."
+    )
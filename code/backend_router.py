@@ -0,0 +1,249 @@
+import re
+import threading
+import time
+
+import requests
+
+from chat_stream import StreamError, stream_chat_completion
+
+POLL_INTERVAL = 5  # Seconds between model list / queue depth polls
+TTFT_ALPHA = 0.3  # Weight of the newest sample in the moving TTFT average
+DEFAULT_TTFT = 1.0  # Assumed TTFT in seconds before a backend has served anything
+EJECT_AFTER_FAILURES = 3  # Consecutive failures before a backend is ejected
+EJECT_SECONDS = 30  # First ejection period; doubles for each repeated ejection, up to MAX_EJECT_SECONDS
+MAX_EJECT_SECONDS = 600
+OUTLIER_FACTOR = 4.0  # Eject a backend whose TTFT average exceeds this multiple of the fastest one
+STICKY_SLACK = 2.0  # Stay on a conversation's backend while its score is within this factor of the best
+MAX_STICKY = 10000  # Conversations remembered for sticky routing
+CANCEL_CONFIRM_SECONDS = 15  # How long to watch a vLLM backend's metrics for a cancelled request's abort
+
+
+class NoBackendError(Exception):
+    pass
+
+
+class Backend:
+    """One vLLM or Ollama server speaking the OpenAI-compatible API."""
+
+    def __init__(self, name, base_url, kind="vllm", api_key=None):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.kind = kind
+        self.headers = {"Content-Type": "application/json"}
+        if api_key:
+            self.headers["Authorization"] = f"Bearer {api_key}"
+        self.models = set()
+        self.queue_depth = 0  # Requests waiting or running on the server, from its metrics
+        self.aborts = 0  # Requests the server has aborted, from its metrics
+        self.in_flight = 0  # Requests this process currently has open against it
+        self.ttft = DEFAULT_TTFT
+        self.failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+        self.reachable = False
+
+    @property
+    def chat_url(self):
+        return f"{self.base_url}/v1/chat/completions"
+
+    def healthy(self, now=None):
+        return self.reachable and (now or time.time()) >= self.ejected_until
+
+    def score(self):
+        # Expected wait: everything queued ahead of us, times how slowly this backend starts
+        return (self.queue_depth + self.in_flight + 1) * self.ttft
+
+
+def parse_vllm_queue(metrics_text):
+    total = 0.0
+    for line in metrics_text.splitlines():
+        if re.match(r"vllm:num_requests_(waiting|running)\b", line):
+            try:
+                total += float(line.rsplit(" ", 1)[1])
+            except (IndexError, ValueError):
+                continue
+    return int(total)
+
+
+def parse_vllm_aborts(metrics_text):
+    total = 0.0
+    for line in metrics_text.splitlines():
+        if line.startswith("vllm:request_success_total") and 'finished_reason="abort"' in line:
+            try:
+                total += float(line.rsplit(" ", 1)[1])
+            except (IndexError, ValueError):
+                continue
+    return int(total)
+
+
+class BackendRouter:
+    """Least-loaded routing across backends with failover, outlier ejection and sticky conversations."""
+
+    def __init__(self, backends, client, poll_interval=POLL_INTERVAL):
+        self.backends = backends
+        self.client = client
+        self.poll_interval = poll_interval
+        self.sticky = {}  # conversation id -> backend name
+        self._lock = threading.Lock()
+        self.poll()
+        threading.Thread(target=self._poll_loop, daemon=True).start()
+
+    def _poll_loop(self):
+        while True:
+            time.sleep(self.poll_interval)
+            self.poll()
+
+    def poll(self):
+        for backend in self.backends:
+            try:
+                response = self.client.get(f"{backend.base_url}/v1/models", headers=backend.headers)
+                response.raise_for_status()
+                models = {m["id"] for m in response.json().get("data", [])}
+                queue_depth = 0
+                aborts = backend.aborts
+                if backend.kind == "vllm":
+                    metrics = self.client.get(f"{backend.base_url}/metrics")
+                    if metrics.ok:
+                        queue_depth = parse_vllm_queue(metrics.text)
+                        aborts = parse_vllm_aborts(metrics.text)
+                with self._lock:
+                    backend.models = models
+                    backend.queue_depth = queue_depth
+                    backend.aborts = aborts
+                    backend.reachable = True
+            except (requests.exceptions.RequestException, ValueError, KeyError):
+                with self._lock:
+                    backend.reachable = False
+
+    def serves(self, model):
+        with self._lock:
+            return any(model in b.models for b in self.backends)
+
+    def pick(self, model, conversation_id=None, exclude=()):
+        now = time.time()
+        with self._lock:
+            candidates = [
+                b for b in self.backends
+                if model in b.models and b.healthy(now) and b.name not in exclude
+            ]
+            if not candidates:
+                return None
+            best = min(candidates, key=Backend.score)
+            # Prefer the backend that served this conversation before: its prefix cache is warm
+            sticky = next((b for b in candidates if b.name == self.sticky.get(conversation_id)), None)
+            chosen = sticky if sticky and sticky.score() <= best.score() * STICKY_SLACK else best
+            if conversation_id:
+                self.sticky.pop(conversation_id, None)
+                self.sticky[conversation_id] = chosen.name
+                if len(self.sticky) > MAX_STICKY:
+                    del self.sticky[next(iter(self.sticky))]
+            chosen.in_flight += 1
+            return chosen
+
+    def release(self, backend, ttft=None, failed=False):
+        with self._lock:
+            backend.in_flight -= 1
+            if failed:
+                backend.failures += 1
+                if backend.failures >= EJECT_AFTER_FAILURES:
+                    self._eject(backend)
+                return
+            backend.failures = 0
+            if ttft is not None:
+                backend.ttft = TTFT_ALPHA * ttft + (1 - TTFT_ALPHA) * backend.ttft
+                fastest = min((b.ttft for b in self.backends if b.reachable), default=backend.ttft)
+                healthy = [b for b in self.backends if b.healthy()]
+                # Never eject the last healthy backend, even if it is slow
+                if backend.ttft > fastest * OUTLIER_FACTOR and len(healthy) > 1:
+                    self._eject(backend)
+
+    def _eject(self, backend):
+        backend.ejections += 1
+        backend.failures = 0
+        period = min(EJECT_SECONDS * 2 ** (backend.ejections - 1), MAX_EJECT_SECONDS)
+        backend.ejected_until = time.time() + period
+        # Let the average recover, otherwise the backend is ejected again on its first request back
+        backend.ttft = min(backend.ttft, DEFAULT_TTFT)
+
+    def confirm_cancel(self, backend, baseline, on_cancel):
+        # vLLM counts aborted requests in its metrics; watch for ours so we know the GPU slot was freed
+        if backend.kind != "vllm":
+            on_cancel("unverified")
+            return
+        deadline = time.time() + CANCEL_CONFIRM_SECONDS
+        while time.time() < deadline:
+            try:
+                metrics = self.client.get(f"{backend.base_url}/metrics")
+                if metrics.ok and parse_vllm_aborts(metrics.text) > baseline:
+                    on_cancel("confirmed")
+                    return
+            except requests.exceptions.RequestException:
+                pass
+            time.sleep(0.5)
+        on_cancel("unconfirmed")
+
+    def stream_chat(self, payload, stats, conversation_id=None, on_cancel=None):
+        """Yield content deltas like stream_chat_completion, failing over until the first token arrives.
+
+        If the reader stops early, on_cancel(confirmation) is called from a background
+        thread once the backend has (or has not) reported the abort.
+        """
+        tried = set()
+        while True:
+            backend = self.pick(payload["model"], conversation_id, exclude=tried)
+            if backend is None:
+                raise NoBackendError(f"No healthy backend serves {payload['model']}")
+            tried.add(backend.name)
+            start = time.perf_counter()
+            ttft = None
+            baseline = backend.aborts
+            stream = stream_chat_completion(backend.chat_url, backend.headers, payload, stats, session=self.client)
+            released = False
+            try:
+                for delta in stream:
+                    if ttft is None:
+                        ttft = time.perf_counter() - start
+                    yield delta
+            except (requests.exceptions.RequestException, StreamError) as e:
+                client_error = isinstance(e, StreamError) and e.status_code < 500 and e.status_code != 429
+                self.release(backend, failed=not client_error)
+                released = True
+                # Once tokens have been shown, or the request itself was bad, retrying elsewhere won't help
+                if ttft is not None or client_error:
+                    raise
+                stats.end = None
+                stats.response_at = None
+                continue
+            except GeneratorExit:
+                stream.close()
+                self.release(backend, ttft)
+                released = True
+                if stats.cancelled and on_cancel is not None:
+                    threading.Thread(target=self.confirm_cancel, args=(backend, baseline, on_cancel), daemon=True).start()
+                raise
+            else:
+                self.release(backend, ttft)
+                released = True
+                return
+            finally:
+                if not released:
+                    # Any other error still ends the request; the backend must not stay counted as busy
+                    with self._lock:
+                        backend.in_flight -= 1
+
+    def status(self):
+        now = time.time()
+        with self._lock:
+            return [
+                {
+                    "backend": b.name,
+                    "kind": b.kind,
+                    "healthy": b.healthy(now),
+                    "queue": b.queue_depth,
+                    "in_flight": b.in_flight,
+                    "ttft": round(b.ttft, 2),
+                    "aborts": b.aborts,
+                    "models": len(b.models),
+                }
+                for b in self.backends
+            ]
@@ -0,0 +1,265 @@
+"""Headless batch mode: run a JSONL file of prompts through the chatbot pipeline.
+
+Each input line is a JSON object with a "prompt" and optionally an "id",
+"role" (a name from AI_ROLES or a role description), "model", "file" and
+"pages". Command-line options give the defaults for all lines. Prompts are
+built the way chat_bot_up15.py builds them: the role's system prompt, and
+for a document the chunks most relevant to the prompt. Up to --concurrency
+prompts run at once; each result is appended to the output JSONL as soon as
+it finishes, so an interrupted run continues where it stopped when started
+again (prompts whose id already has a successful result are skipped).
+
+    python chat_batch.py prompts.jsonl -o results.jsonl --model llama3.1 --role "Data Analyzer" --file report.pdf
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from ai_roles import AI_ROLES, role_description, system_prompt
+from chat_history import DEFAULT_CONTEXT, build_window, model_budgets
+from chat_stream import StreamError, TurnStats, complete_chat, stream_chat_completion
+from doc_index import DocumentIndex, file_hash, format_chunks
+from file_extract import extract_bytes
+from http_client import BackendClient
+
+# Configuration, as in the chatbots
+API_URL = "http://localhost:8080/api/chat/completions"
+API_KEY = "MyAPI"  # Replace with your actual API key
+MODELS_URL = "http://localhost:8080/api/models"
+EMBED_URL = "http://localhost:11434/api/embed"  # Ollama embedding endpoint for documents
+EMBED_MODEL = "nomic-embed-text"
+RAG_TOP_K = 5  # Most document chunks sent with one prompt
+RAG_TOKEN_BUDGET = 2000  # Most document tokens sent with one prompt
+CONCURRENCY = 4  # Prompts sent to the backend at once
+
+
+def load_prompts(path):
+    """Read the prompt file; lines without an "id" are numbered by line."""
+    prompts = []
+    with open(path, encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            if isinstance(item, str):
+                item = {"prompt": item}
+            if not item.get("prompt"):
+                raise ValueError(f"{path}:{number}: no prompt")
+            item.setdefault("id", str(number))
+            prompts.append(item)
+    return prompts
+
+
+def completed_ids(path):
+    """Ids that already have a successful result in an earlier output file."""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue  # The last line of an interrupted run may be cut off
+            if result.get("error") is None:
+                done.add(str(result.get("id")))
+    return done
+
+
+class Documents:
+    """Extracted and indexed documents, loaded once per file and page range and shared by all prompts."""
+
+    def __init__(self, embed_url=EMBED_URL, embed_model=EMBED_MODEL):
+        self.embed_url = embed_url
+        self.embed_model = embed_model
+        self.indexes = {}
+        self._lock = threading.Lock()
+
+    def get(self, path, pages=None):
+        key = (os.path.abspath(path), pages or "")
+        with self._lock:
+            if key not in self.indexes:
+                with open(path, "rb") as f:
+                    data = f.read()
+                name = os.path.basename(path)
+                text = extract_bytes(name, data, pages)
+                self.indexes[key] = DocumentIndex(name, file_hash(data), text, self.embed_url, self.embed_model)
+            return self.indexes[key]
+
+
+class BatchRunner:
+    """Runs prompt dicts against the chat backend; usable as a library as well as from the CLI."""
+
+    def __init__(self, model, role=None, file=None, pages=None, concurrency=CONCURRENCY,
+                 api_url=API_URL, api_key=API_KEY, models_url=MODELS_URL, stream=True,
+                 top_k=RAG_TOP_K, token_budget=RAG_TOKEN_BUDGET, client=None, documents=None):
+        self.model = model
+        self.role = role
+        self.file = file
+        self.pages = pages
+        self.concurrency = concurrency
+        self.api_url = api_url
+        self.models_url = models_url
+        self.headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
+        self.stream = stream
+        self.top_k = top_k
+        self.token_budget = token_budget
+        self.client = client or BackendClient()
+        self.documents = documents or Documents()
+        self.budgets = None
+
+    def context_budget(self, model):
+        if self.budgets is None:
+            try:
+                response = self.client.get(self.models_url, headers=self.headers)
+                self.budgets = model_budgets(response.json().get("data", [])) if response.status_code == 200 else {}
+            except Exception:
+                self.budgets = {}
+        return self.budgets.get(model, DEFAULT_CONTEXT)
+
+    def build_messages(self, item):
+        """Return (messages, window_info, used_chunks) for one prompt, as the chatbot would send it."""
+        prompt = item["prompt"]
+        attachment = ""
+        used_chunks = []
+        file = item.get("file", self.file)
+        if file:
+            index = self.documents.get(file, item.get("pages", self.pages))
+            hits = index.search(prompt, self.top_k, self.token_budget)
+            if len(hits) < len(index.chunks):
+                used_chunks = [i + 1 for i, _, _ in hits]
+            attachment = (
+                f"\n\n[Uploaded Data]:\n{format_chunks(index, hits)}\n"
+                "Please use the uploaded data above to process my request."
+            )
+        role_desc = role_description(item.get("role", self.role))
+        history = [{"role": "user", "content": prompt, "attachment": attachment}]
+        model = item.get("model", self.model)
+        messages, _, info = build_window(
+            system_prompt(role_desc), history, self.context_budget(model), {"text": "", "covered": 0}
+        )
+        return messages, info, used_chunks
+
+    def run_prompt(self, item, queued_at=None):
+        """Run one prompt and return its result record; errors are recorded, not raised."""
+        started = time.perf_counter()
+        model = item.get("model", self.model)
+        result = {
+            "id": item["id"],
+            "model": model,
+            "role": item.get("role", self.role),
+            "prompt": item["prompt"],
+            "reply": None,
+            "error": None,
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        stats = None
+        try:
+            messages, info, used_chunks = self.build_messages(item)
+            result["prompt_tokens"] = info["prompt_tokens"]
+            result["chunks"] = used_chunks
+            built = time.perf_counter()
+            stats = TurnStats()
+            payload = {"model": model, "messages": messages}
+            if self.stream:
+                reply = "".join(stream_chat_completion(self.api_url, self.headers, payload, stats, session=self.client))
+            else:
+                reply = complete_chat(self.api_url, self.headers, payload, stats, session=self.client)
+            result["reply"] = reply
+        except StreamError as e:
+            result["error"] = f"API Error: {e}"
+        except Exception as e:
+            result["error"] = f"{type(e).__name__}: {e}"
+        else:
+            result["timings"] = {
+                "queued": started - queued_at if queued_at is not None else 0.0,
+                "prompt_build": built - started,
+                **stats.as_dict(),
+            }
+        result["seconds"] = time.perf_counter() - started
+        return result
+
+    def run(self, prompts, output, resume=True, on_result=None):
+        """Run prompts, appending results to the output JSONL; returns a summary dict.
+
+        With resume, prompts that already succeeded in output are skipped and the
+        rest are appended; otherwise output is overwritten. Results are written in
+        the order they finish. on_result(result) is called after each one.
+        """
+        done = completed_ids(output) if resume else set()
+        pending = [item for item in prompts if str(item["id"]) not in done]
+        summary = {"total": len(prompts), "skipped": len(prompts) - len(pending), "ok": 0, "failed": 0}
+        started = time.perf_counter()
+        write_lock = threading.Lock()
+        with open(output, "a" if resume else "w", encoding="utf-8") as out, \
+                ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            queued_at = time.perf_counter()
+            futures = [pool.submit(self.run_prompt, item, queued_at) for item in pending]
+            for future in as_completed(futures):
+                result = future.result()
+                with write_lock:
+                    out.write(json.dumps(result, ensure_ascii=False) + "\n")
+                    out.flush()
+                summary["failed" if result["error"] else "ok"] += 1
+                if on_result is not None:
+                    on_result(result)
+        summary["seconds"] = time.perf_counter() - started
+        return summary
+
+
+def run_batch(prompts, output, model, resume=True, on_result=None, **options):
+    """Library entry point: prompts is a list of dicts or a JSONL path; options are BatchRunner's."""
+    if isinstance(prompts, str):
+        prompts = load_prompts(prompts)
+    return BatchRunner(model, **options).run(prompts, output, resume=resume, on_result=on_result)
+
+
+def build_cli():
+    parser = argparse.ArgumentParser(description="Run a JSONL file of prompts through the chatbot pipeline.")
+    parser.add_argument("prompts", help="JSONL file, one {\"prompt\": ...} object per line")
+    parser.add_argument("-o", "--output", default="batch_results.jsonl", help="JSONL results file (default: batch_results.jsonl)")
+    parser.add_argument("-m", "--model", required=True, help="Model name, as listed by /api/models")
+    parser.add_argument("-r", "--role", default=None,
+                        help=f"AI role ({', '.join(AI_ROLES)}) or a custom role description (default: General Assistant)")
+    parser.add_argument("-f", "--file", help="Document sent with every prompt (txt, md, csv, json, pdf, docx, xlsx)")
+    parser.add_argument("--pages", help="PDF pages to read, e.g. 1-20, 35")
+    parser.add_argument("-c", "--concurrency", type=int, default=CONCURRENCY, help=f"Prompts run at once (default: {CONCURRENCY})")
+    parser.add_argument("--api-url", default=API_URL)
+    parser.add_argument("--api-key", default=API_KEY)
+    parser.add_argument("--models-url", default=MODELS_URL)
+    parser.add_argument("--no-stream", action="store_true", help="Use blocking completions for backends without streaming")
+    parser.add_argument("--restart", action="store_true", help="Overwrite the output instead of resuming it")
+    return parser
+
+
+def main():
+    args = build_cli().parse_args()
+    prompts = load_prompts(args.prompts)
+    total = len(prompts)
+    finished = 0
+
+    def report(result):
+        nonlocal finished
+        finished += 1
+        if result["error"]:
+            print(f"[{finished}] {result['id']}: {result['error']}")
+        else:
+            timings = result["timings"]
+            print(f"[{finished}] {result['id']}: {timings['tokens']} tokens in {timings['total']:.1f}s")
+
+    summary = run_batch(
+        prompts, args.output, args.model, resume=not args.restart, on_result=report,
+        role=args.role, file=args.file, pages=args.pages, concurrency=args.concurrency,
+        api_url=args.api_url, api_key=args.api_key, models_url=args.models_url, stream=not args.no_stream,
+    )
+    print(
+        f"{summary['ok']} ok, {summary['failed']} failed, {summary['skipped']} already done of {total} "
+        f"prompts in {summary['seconds']:.1f}s; results in {args.output}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,372 @@
+"""Offline load test for the Streamlit chatbots.
+
+Drives chat_bot_up15.py / chat_bot_up15_ws.py headlessly with Streamlit's
+AppTest against a local mock of the Open WebUI API, replaying scripted
+sessions (prompts, file uploads, web search) from many concurrent users.
+AppTest is not thread-safe, so each user runs in its own process; resources
+cached with st.cache_resource are therefore per user, not shared as they are
+in one Streamlit server.
+
+    python chat_bench.py --users 30 --ttft 0.3 --token-delay 0.02 -o bench.json
+    python chat_bench.py --sessions my_sessions.json --users 10
+"""
+import argparse
+import json
+import os
+import pickle
+import re
+import sys
+import tempfile
+import threading
+import time
+import types
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+try:
+    import psutil
+except ImportError:  # Current memory is read from /proc/self/statm instead (Linux)
+    psutil = None
+
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCH_MODEL = "bench-model"
+BENCH_CONTEXT = 8192
+UPSTREAM_URLS = ("http://localhost:8080", "http://localhost:11434")  # Open WebUI and Ollama in the chatbots
+
+SAMPLE_DOCUMENT = "\n".join(
+    f"Server rack {i}: host db{i:02d} runs PostgreSQL 15 on {8 + i % 4 * 8} cores, "
+    f"backed up nightly at {i % 24:02d}:00, owner team {'ABC'[i % 3]}."
+    for i in range(400)
+)
+
+# Sessions replayed by default; each user runs them round-robin
+DEFAULT_SESSIONS = [
+    {
+        "name": "chat",
+        "app": "chat_bot_up15.py",
+        "prompts": [
+            "Explain what a reverse proxy does.",
+            "How is that different from a load balancer?",
+            "Give me an nginx example.",
+        ],
+    },
+    {
+        "name": "upload",
+        "app": "chat_bot_up15.py",
+        "upload": {"name": "inventory.txt", "text": SAMPLE_DOCUMENT},
+        "prompts": [
+            "Which hosts run on 32 cores?",
+            "Who owns db07?",
+        ],
+    },
+    {
+        "name": "web_search",
+        "app": "chat_bot_up15_ws.py",
+        "web_search": True,
+        "prompts": [
+            "What changed in the latest PostgreSQL release?",
+            "Summarize the upgrade notes.",
+        ],
+    },
+]
+
+
+class MockOpenAI(BaseHTTPRequestHandler):
+    """Stand-in for Open WebUI and Ollama: model list, streamed chat, embeddings and search result pages."""
+
+    protocol_version = "HTTP/1.1"
+    ttft = 0.2  # Seconds before the first token
+    token_delay = 0.02  # Seconds between tokens
+    tokens = 50  # Tokens per reply
+
+    def log_message(self, *args):
+        pass
+
+    def handle(self):
+        # Clients dropping keep-alive connections at exit is expected, not worth a traceback
+        try:
+            super().handle()
+        except ConnectionResetError:
+            pass
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.endswith("/models"):
+            self.send_json({"data": [{"id": BENCH_MODEL, "name": BENCH_MODEL, "max_model_len": BENCH_CONTEXT}]})
+        elif self.path.endswith("/api/ps"):
+            self.send_json({"models": []})
+        elif self.path.startswith("/page/"):
+            body = f"<html><body><h1>Result {self.path}</h1><p>{SAMPLE_DOCUMENT[:2000]}</p></body></html>".encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_json({"error": "not found"}, 404)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.path.endswith("/api/embed"):
+            from doc_index import hash_embed
+            self.send_json({"embeddings": hash_embed(request.get("input", [])).tolist()})
+            return
+        time.sleep(self.ttft)
+        words = [f" token{i}" for i in range(self.tokens)]
+        if not request.get("stream"):
+            time.sleep(self.token_delay * self.tokens)
+            self.send_json({
+                "choices": [{"message": {"content": "".join(words)}}],
+                "usage": {"completion_tokens": self.tokens},
+            })
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for word in words:
+                self.write_chunk(f"data: {json.dumps({'choices': [{'delta': {'content': word}}]})}\n\n".encode())
+                time.sleep(self.token_delay)
+            self.write_chunk(b"data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def write_chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+
+def start_mock_server(port, ttft, token_delay, tokens):
+    handler = type("BenchHandler", (MockOpenAI,), {"ttft": ttft, "token_delay": token_delay, "tokens": tokens})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def install_offline_search(base_url, delay):
+    # DuckDuckGo is replaced by canned results pointing at the mock server, so runs are offline and repeatable
+    class OfflineDDGS:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            return False
+
+        def text(self, query, max_results=5, **kwargs):
+            time.sleep(delay)
+            return [
+                {"title": f"{query} ({i})", "body": f"Search snippet {i} about {query}.", "href": f"{base_url}/page/{i}"}
+                for i in range(1, max_results + 1)
+            ]
+
+    sys.modules["duckduckgo_search"] = types.SimpleNamespace(DDGS=OfflineDDGS)
+
+
+def load_app_source(app, base_url):
+    with open(os.path.join(CODE_DIR, app), encoding="utf-8") as f:
+        source = f.read()
+    for url in UPSTREAM_URLS:
+        source = source.replace(url, base_url)
+    # Every user process would try to bind the same Prometheus port
+    return re.sub(r"^METRICS_PORT = .*$", "METRICS_PORT = None", source, flags=re.M)
+
+
+def rss_mb():
+    # Current resident memory, not the peak: a worker runs several sessions with --rounds
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / 2**20
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError):
+        return None
+
+
+def init_worker(base_url, search_delay, workdir):
+    # SQLite files and the extraction cache go to a scratch directory, so every run starts cold
+    os.chdir(workdir)
+    os.environ["EXTRACT_CACHE_DIR"] = os.path.join(workdir, "extract_cache")
+    sys.path.insert(0, CODE_DIR)
+    install_offline_search(base_url, search_delay)
+
+
+def session_state_bytes(at):
+    try:
+        return len(pickle.dumps(at.session_state.to_dict()))
+    except Exception:
+        return None
+
+
+def run_session(user, session, source, timeout):
+    # AppTest runs the app as __main__; put the worker's back so its next session can be unpickled
+    main = sys.modules["__main__"]
+    try:
+        return play_session(user, session, source, timeout)
+    finally:
+        sys.modules["__main__"] = main
+
+
+def play_session(user, session, source, timeout):
+    from streamlit.testing.v1 import AppTest
+
+    result = {"user": user, "session": session["name"], "turns": [], "errors": []}
+    rss_before = rss_mb()
+    start = time.perf_counter()
+    at = AppTest.from_string(source, default_timeout=timeout)
+    at.run()
+    result["first_load"] = time.perf_counter() - start
+    result["rss_after_load_mb"] = rss_mb()
+    if at.exception:
+        result["errors"].append(at.exception[0].value)
+        return result
+    if session.get("upload"):
+        upload = session["upload"]
+        data = upload["text"].encode("utf-8") if "text" in upload else open(upload["path"], "rb").read()
+        started = time.perf_counter()
+        at.file_uploader[0].set_value((upload["name"], data, upload.get("mime", "application/octet-stream"))).run()
+        result["upload"] = time.perf_counter() - started
+    if session.get("web_search"):
+        next(b for b in at.button if b.label == "Toggle Web Search").click().run()
+    for prompt in session["prompts"]:
+        started = time.perf_counter()
+        at.chat_input[0].set_value(prompt).run()
+        e2e = time.perf_counter() - started
+        # A plain rerun, as triggered by any widget, measures what every interaction costs
+        started = time.perf_counter()
+        at.run()
+        rerun = time.perf_counter() - started
+        messages = at.session_state.messages if "messages" in at.session_state else []
+        stats = (messages[-1].get("stats") or {}) if messages else {}
+        reply = messages[-1]["content"] if messages else ""
+        if at.exception:
+            result["errors"].append(at.exception[0].value)
+            break
+        if reply.startswith("Error:"):
+            result["errors"].append(reply)
+        result["turns"].append({
+            "e2e": e2e,
+            "rerun": rerun,
+            "ttft": stats.get("ttft"),
+            "tokens_per_sec": stats.get("tokens_per_sec"),
+        })
+    result["state_bytes"] = session_state_bytes(at)
+    result["rss_mb"] = rss_mb()
+    # Memory this session added to its worker, from before its first run to after its last turn
+    if rss_before is not None and result["rss_mb"] is not None:
+        result["rss_growth_mb"] = result["rss_mb"] - rss_before
+    result["total"] = time.perf_counter() - start
+    return result
+
+
+def percentiles(values):
+    values = [v for v in values if v is not None]
+    if not values:
+        return None
+    p50, p90, p95, p99 = np.percentile(values, [50, 90, 95, 99])
+    return {
+        "count": len(values),
+        "mean": float(np.mean(values)),
+        "p50": float(p50),
+        "p90": float(p90),
+        "p95": float(p95),
+        "p99": float(p99),
+        "max": float(max(values)),
+    }
+
+
+def summarize(results):
+    turns = [t for r in results for t in r["turns"]]
+    return {
+        "sessions": len(results),
+        "turns": len(turns),
+        "errors": sum(len(r["errors"]) for r in results),
+        "ttft": percentiles([t["ttft"] for t in turns]),
+        "e2e": percentiles([t["e2e"] for t in turns]),
+        "rerun": percentiles([t["rerun"] for t in turns]),
+        "first_load": percentiles([r["first_load"] for r in results]),
+        "upload": percentiles([r.get("upload") for r in results]),
+        "tokens_per_sec": percentiles([t["tokens_per_sec"] for t in turns]),
+        "rss_mb": percentiles([r.get("rss_mb") for r in results]),
+        "rss_growth_mb": percentiles([r.get("rss_growth_mb") for r in results]),
+        "state_kb": percentiles([r["state_bytes"] / 1024 if r.get("state_bytes") else None for r in results]),
+    }
+
+
+def print_summary(summary):
+    print(f"{summary['sessions']} sessions, {summary['turns']} turns, {summary['errors']} errors")
+    for name in ("ttft", "e2e", "rerun", "first_load", "upload", "tokens_per_sec", "rss_mb", "rss_growth_mb", "state_kb"):
+        row = summary[name]
+        if row:
+            print(f"  {name:<15} p50 {row['p50']:9.3f}  p90 {row['p90']:9.3f}  p99 {row['p99']:9.3f}  max {row['max']:9.3f}")
+
+
+def build_cli():
+    parser = argparse.ArgumentParser(description="Offline load test for the Streamlit chatbots.")
+    parser.add_argument("-u", "--users", type=int, default=30, help="Concurrent users (default: 30)")
+    parser.add_argument("-r", "--rounds", type=int, default=1, help="Sessions each user runs (default: 1)")
+    parser.add_argument("-s", "--sessions", help="JSON file with a list of scripted sessions (default: built-in)")
+    parser.add_argument("--ttft", type=float, default=0.2, help="Mock server seconds before the first token")
+    parser.add_argument("--token-delay", type=float, default=0.02, help="Mock server seconds between tokens")
+    parser.add_argument("--tokens", type=int, default=50, help="Tokens per mock reply")
+    parser.add_argument("--search-delay", type=float, default=0.3, help="Seconds an offline web search takes")
+    parser.add_argument("--port", type=int, default=0, help="Mock server port (default: any free port)")
+    parser.add_argument("--timeout", type=float, default=120, help="Seconds one script run may take")
+    parser.add_argument("-o", "--output", default="bench_results.json", help="JSON results file")
+    return parser
+
+
+def main():
+    args = build_cli().parse_args()
+    sessions = DEFAULT_SESSIONS
+    if args.sessions:
+        with open(args.sessions, encoding="utf-8") as f:
+            sessions = json.load(f)
+    output = os.path.abspath(args.output)
+
+    server = start_mock_server(args.port, args.ttft, args.token_delay, args.tokens)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    sources = {app: load_app_source(app, base_url) for app in {s["app"] for s in sessions}}
+    workdir = tempfile.mkdtemp(prefix="chat_bench_")
+
+    jobs = [(user, sessions[(user + n) % len(sessions)]) for n in range(args.rounds) for user in range(args.users)]
+    started = time.perf_counter()
+    with ProcessPoolExecutor(
+        max_workers=args.users,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(base_url, args.search_delay, workdir),
+    ) as pool:
+        futures = [pool.submit(run_session, user, session, sources[session["app"]], args.timeout) for user, session in jobs]
+        results = [future.result() for future in futures]
+    wall = time.perf_counter() - started
+
+    summary = summarize(results)
+    report = {
+        "config": {k: v for k, v in vars(args).items() if k != "output"},
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "wall_seconds": wall,
+        "workdir": workdir,
+        "summary": summary,
+        "sessions": results,
+    }
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print_summary(summary)
+    print(f"Wall time {wall:.1f}s, results saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,35 @@
+import time
+import uuid
+
 import streamlit as st
 import requests
-import json
+from admission import AdmissionController, AdmissionRejected
+from chat_stream import StreamError, TurnStats, collect, complete_chat, format_stats, stream_chat_completion
+from chat_store import ChatStore
+from chat_transcript import (
+    conversation_sidebar, finish_stopped_reply, init_conversation, persist_summary, render_transcript
+)
+from http_client import BackendClient, format_pool_stats
+from model_catalog import ModelCatalog, model_details, model_label
+from model_warmup import WarmupManager
+from preflight import Preflight, PromptTooLarge, format_preflight
+from turn_metrics import RECENT_TURNS, TurnTimer, format_phases, start_metrics
+from chat_history import DEFAULT_CONTEXT, format_window, model_budgets, summarize_messages
 
 # API Configuration
 API_URL = "http://localhost:8080/api/chat/completions"
 API_KEY = "My_API"  # Replace with your actual API key
 MODELS_URL = "http://localhost:8080/api/models"
+STREAM_RESPONSES = True  # Render tokens as they arrive; set False for backends without streaming
+CONNECT_TIMEOUT = 5  # Seconds to connect to the backend
+READ_TIMEOUT = 300  # Seconds to wait between bytes of a reply
+PS_URL = "http://localhost:8080/ollama/api/ps"  # Models resident in Ollama memory, via Open WebUI
+GENERATE_URL = "http://localhost:8080/ollama/api/generate"  # Used to preload models and renew their keep_alive
+MODEL_USAGE_DB = "model_usage.db"  # SQLite file of which models are used when, for prewarming
+CHAT_STORE_DB = "chat_history.db"  # SQLite file holding conversations, so they survive reloads
+MAX_IN_FLIGHT = 4  # Requests per model this chatbot sends at once; the rest wait in a fair queue
+TRUST_PROXY_USER_HEADER = False  # Identify users by X-Forwarded-User; enable only behind a proxy that sets it
+METRICS_PORT = 9101  # Prometheus endpoint for per-turn latency metrics; None disables it
 
 
 # Web UI
@@ -32,39 +56,106 @@ st.warning(
 )
 
 
-# Fetch available models with proper parsing
-headers = {"Authorization": f"Bearer {API_KEY}"}
-response = requests.get(MODELS_URL, headers=headers)
+# One pooled keep-alive client shared by all sessions and reruns
+@st.cache_resource
+def get_backend_client():
+    return BackendClient(connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT)
+
+client = get_backend_client()
+
+# Model list is cached and refreshed in the background, so reruns never wait on /api/models
+@st.cache_resource
+def get_model_catalog():
+    return ModelCatalog(client, MODELS_URL, {"Authorization": f"Bearer {API_KEY}"}, ps_url=PS_URL)
+
+catalog = get_model_catalog()
+
+# Cold models are loaded as soon as they are picked and kept loaded while sessions use them
+@st.cache_resource
+def get_warmup():
+    return WarmupManager(client, GENERATE_URL, {"Authorization": f"Bearer {API_KEY}"}, catalog, usage_db=MODEL_USAGE_DB)
+
+warmup = get_warmup()
+models_data, models_error = catalog.snapshot()
+models_by_name = {model.get("name", "Unknown Model"): model for model in models_data}
+MODEL_BUDGETS = model_budgets(models_data)
+available_models = list(models_by_name) or ["report01"]  # Fallback option
+if models_error:
+    st.caption(models_error)
+
+# Model selection, labelled with whether each model is already loaded
+MODEL_NAME = st.selectbox(
+    "Select a model:",
+    available_models,
+    format_func=lambda name: model_label(name, warmup.state(models_by_name[name])) if name in models_by_name else name,
+    key="model_name",
+)
+if MODEL_NAME in models_by_name:
+    st.caption(model_details(models_by_name[MODEL_NAME]))
+
+# Conversations are appended to SQLite as they happen and can be resumed from the sidebar
+@st.cache_resource
+def get_chat_store():
+    return ChatStore(CHAT_STORE_DB)
+
+store = get_chat_store()
+
+# Per-turn phase timings are exported to Prometheus from a sidecar HTTP endpoint
+@st.cache_resource
+def get_turn_metrics():
+    return start_metrics(METRICS_PORT)
+
+turn_metrics = get_turn_metrics()
 
-if response.status_code == 200:
-    try:
-        models_data = response.json().get("data", [])
-        available_models = [model.get("name", "Unknown Model") for model in models_data]
-    except json.JSONDecodeError:
-        available_models = ["Error: Invalid JSON response"]
-elif response.status_code == 403:
-    available_models = ["Access Forbidden - Check API Key Permissions"]
-else:
-    available_models = ["report01"]  # Fallback option
+# One admission controller per chatbot process: caps in-flight requests per model and queues the rest fairly
+@st.cache_resource
+def get_admission():
+    return AdmissionController(max_in_flight=MAX_IN_FLIGHT)
 
-# Model selection
-MODEL_NAME = st.selectbox("Select a model:", available_models)
+admission = get_admission()
 
-# Initialize chat history if not already present
-if "messages" not in st.session_state:
-    st.session_state.messages = []
+# Prompt sizes and per-model prefill and decode speed, learned from the turns of all sessions
+@st.cache_resource
+def get_preflight():
+    return Preflight()
 
-# Display chat messages from history
-for message in st.session_state.messages:
-    with st.chat_message(message["role"]):
-        st.markdown(message["content"])
+preflight = get_preflight()
+
+# Initialize chat history, resuming the conversation named in the URL if there is one
+init_conversation(store)
+conversation_sidebar(store)
+if "user_id" not in st.session_state:
+    # Users are told apart by the login an auth proxy forwards, otherwise by browser session;
+    # a client reaching Streamlit directly could send any X-Forwarded-User, so it is opt-in
+    forwarded_user = st.context.headers.get("X-Forwarded-User") if TRUST_PROXY_USER_HEADER else None
+    st.session_state.user_id = forwarded_user or uuid.uuid4().hex
+warmup.select(st.session_state.user_id, MODEL_NAME)
+if MODEL_NAME in models_by_name and warmup.state(models_by_name[MODEL_NAME]) == "warming":
+    st.caption(f"Loading {MODEL_NAME} into memory in the background, so your first message won't wait for it")
+if "turn_phases" not in st.session_state:
+    st.session_state.turn_phases = []
+if "pending_reply" not in st.session_state:
+    st.session_state.pending_reply = None  # Reply being streamed; still set if the run was interrupted
+
+# A reply interrupted by Stop is kept with whatever had arrived
+finish_stopped_reply(store, turn_metrics)
+
+# Display chat messages from history; older turns are paged so reruns stay fast
+render_transcript(
+    st.session_state.messages,
+    copy=False,
+    archived=st.session_state.history_offset,
+    load_archived=lambda offset, limit: store.load_messages(st.session_state.conversation_id, offset, limit),
+)
 
 # User input field
 user_input = st.chat_input("Type your message...")
 
 if user_input:
+    timer = TurnTimer()
     # Add user message to session state
     st.session_state.messages.append({"role": "user", "content": user_input})
+    store.append_message(st.session_state.conversation_id, st.session_state.messages[-1], MODEL_NAME)
     with st.chat_message("user"):
         st.markdown(user_input)
     
@@ -73,21 +164,109 @@ if user_input:
         "Authorization": f"Bearer {API_KEY}",
         "Content-Type": "application/json"
     }
+    # Keep the prompt within the model's context: recent turns verbatim, older ones summarized;
+    # pre-flight counts it for this model and rebuilds it smaller if it would not fit
+    messages, st.session_state.history_summary, window_info = preflight.fit(
+        MODEL_NAME,
+        MODEL_BUDGETS.get(MODEL_NAME, DEFAULT_CONTEXT),
+        None,
+        st.session_state.messages,
+        st.session_state.history_summary,
+        summarize=lambda previous, dropped, max_tokens: summarize_messages(
+            API_URL, headers, MODEL_NAME, previous, dropped, max_tokens, session=client
+        ),
+    )
+    persist_summary(store)
+    st.caption(format_window(window_info) + " · " + format_preflight(window_info))
     payload = {
         "model": MODEL_NAME,
-        "messages": st.session_state.messages
+        "messages": messages
     }
     
     # Send request to Open Web-UI API
-    response = requests.post(API_URL, headers=headers, data=json.dumps(payload))
-    
-    if response.status_code == 200:
-        reply = response.json().get("choices", [{}])[0].get("message", {}).get("content", "No response")
-    else:
-        reply = f"Error: {response.status_code} - {response.text}"
+    timer.lap("prompt_build")
+    stats = TurnStats()
+    outcome = "ok"
+    with st.chat_message("assistant"):
+        # Stop reruns the script, which interrupts the stream below and closes its connection
+        stop_slot = st.empty()
+        stop_slot.button("Stop", key="stop_generation", icon=":material/stop_circle:")
+        queue_status = st.empty()
+        ticket = None
+        st.session_state.pending_reply = {
+            "conversation_id": st.session_state.conversation_id,
+            "model": MODEL_NAME,
+            "role": "default",
+            "content": "",
+            "stats": stats,
+            "routed": False,
+        }
+        try:
+            preflight.check(window_info)
+            ticket = admission.acquire(
+                st.session_state.user_id, MODEL_NAME, window_info["prompt_tokens"],
+                on_wait=lambda position, wait: queue_status.info(
+                    f"Waiting for a free {MODEL_NAME} slot: position {position} in line, about {wait:.0f}s"
+                ),
+            )
+            queue_status.empty()
+            timer.lap("queue")
+            stats.start = time.perf_counter()  # Backend timings start once the request has a slot
+            if STREAM_RESPONSES:
+                reply = st.write_stream(collect(
+                    stream_chat_completion(API_URL, headers, payload, stats, session=client), st.session_state.pending_reply
+                ))
+            else:
+                reply = complete_chat(API_URL, headers, payload, stats, session=client)
+                st.markdown(reply)
+        except PromptTooLarge as e:
+            outcome = "rejected"
+            reply = f"Error: {e}."
+            st.markdown(reply)
+        except AdmissionRejected as e:
+            timer.lap("queue")
+            outcome = "rejected"
+            reply = f"Error: {e}" + (f". Please try again in {e.retry_after:.0f}s." if e.retry_after else "")
+            st.markdown(reply)
+        except StreamError as e:
+            outcome = "error"
+            reply = f"Error: {e.status_code} - {e.text}"
+            st.markdown(reply)
+        except requests.exceptions.RequestException as e:
+            outcome = "error"
+            reply = f"Error: {str(e)}"
+            st.markdown(reply)
+        finally:
+            queue_status.empty()
+            if ticket is not None:
+                admission.release(ticket, stats.tokens)
+        st.session_state.pending_reply = None
+        stop_slot.empty()
+        st.caption(format_stats(stats.as_dict()) + " · " + format_pool_stats(client.stats()))
     
+    # Phase breakdown for the debug sidebar and the metrics endpoint
+    timer.finish_reply(stats)
+    warmup.record_use(MODEL_NAME)
+    if outcome == "ok" and not stats.cancelled:
+        preflight.record(MODEL_NAME, window_info, stats)
+    st.session_state.turn_phases = (st.session_state.turn_phases + [dict(timer.as_dict(), total=timer.total)])[-RECENT_TURNS:]
+    if turn_metrics is not None:
+        turn_metrics.observe(MODEL_NAME, "default", timer, stats.tokens, outcome)
+
     # Add assistant message to session state
-    st.session_state.messages.append({"role": "assistant", "content": reply})
-    
-    with st.chat_message("assistant"):
-        st.markdown(reply)
+    st.session_state.messages.append({"role": "assistant", "content": reply, "stats": stats.as_dict()})
+    store.append_message(st.session_state.conversation_id, st.session_state.messages[-1], MODEL_NAME)
+
+# Optional latency breakdown of recent turns, to see which phase made a slow turn slow
+if st.sidebar.toggle("Latency breakdown", help="Seconds spent in each phase of your recent turns"):
+    if st.session_state.turn_phases:
+        st.sidebar.caption("Last turn: " + format_phases(st.session_state.turn_phases[-1]))
+        st.sidebar.dataframe(st.session_state.turn_phases[::-1], hide_index=True)
+    else:
+        st.sidebar.caption("No turns timed yet")
+    if admission.status():
+        st.sidebar.caption("Model queues")
+        st.sidebar.dataframe(admission.status(), hide_index=True)
+    if preflight.table():
+        st.sidebar.caption("Model throughput")
+        st.sidebar.dataframe(preflight.table(), hide_index=True)
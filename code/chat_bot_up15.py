@@ -1,15 +1,48 @@
+import time
+import uuid
+
 import streamlit as st
 import requests
-import json
-import pandas as pd
-from PyPDF2 import PdfReader
-from docx import Document
-import streamlit.components.v1 as components
+from ai_roles import AI_ROLES, CUSTOM_ROLE_DESC, DEFAULT_ROLE, system_prompt as role_system_prompt
+from admission import AdmissionController, AdmissionRejected
+from chat_stream import StreamError, TurnStats, collect, complete_chat, format_stats, stream_chat_completion
+from chat_store import ChatStore
+from chat_transcript import (
+    conversation_sidebar, copy_control, finish_stopped_reply, init_conversation, persist_summary,
+    render_transcript,
+)
+from http_client import BackendClient, format_pool_stats
+from model_catalog import ModelCatalog, model_details, model_label
+from model_warmup import WarmupManager
+from table_query import TABLE_TYPES, TableDB, format_steps, run_sql_steps
+from preflight import Preflight, PromptTooLarge, format_preflight
+from turn_metrics import RECENT_TURNS, TurnTimer, format_phases, start_metrics
+from chat_history import DEFAULT_CONTEXT, count_message_tokens, format_window, model_budgets, summarize_messages
+from doc_index import DocumentIndex, file_hash, format_chunks
+from doc_mapreduce import MapCache, MapReduce, format_notes
+from file_extract import SUPPORTED_TYPES, extract_file_content
+from response_cache import ResponseCache, format_cache_stats, is_follow_up
 
 # API Configuration
 API_URL = "http://localhost:8080/api/chat/completions"
 API_KEY = "MyAPI"  # Replace with your actual API key
 MODELS_URL = "http://localhost:8080/api/models"
+STREAM_RESPONSES = True  # Render tokens as they arrive; set False for backends without streaming
+CONNECT_TIMEOUT = 5  # Seconds to connect to the backend
+READ_TIMEOUT = 300  # Seconds to wait between bytes of a reply
+PS_URL = "http://localhost:8080/ollama/api/ps"  # Models resident in Ollama memory, via Open WebUI
+GENERATE_URL = "http://localhost:8080/ollama/api/generate"  # Used to preload models and renew their keep_alive
+MODEL_USAGE_DB = "model_usage.db"  # SQLite file of which models are used when, for prewarming
+CHAT_STORE_DB = "chat_history.db"  # SQLite file holding conversations, so they survive reloads
+MAX_IN_FLIGHT = 4  # Requests per model this chatbot sends at once; the rest wait in a fair queue
+TRUST_PROXY_USER_HEADER = False  # Identify users by X-Forwarded-User; enable only behind a proxy that sets it
+METRICS_PORT = 9102  # Prometheus endpoint for per-turn latency metrics; None disables it
+EMBED_URL = "http://localhost:11434/api/embed"  # Ollama embedding endpoint for uploaded documents
+EMBED_MODEL = "nomic-embed-text"
+RAG_TOP_K = 5  # Most document chunks sent with one question
+RAG_TOKEN_BUDGET = 2000  # Most document tokens sent with one question
+RESPONSE_CACHE_DB = "response_cache.db"  # SQLite file for cached answers to repeated questions
+MAP_CACHE_DB = "map_cache.db"  # SQLite file for notes on document parts, reused by later questions
 
 # Web UI
 st.set_page_config(page_title="Chatbot for Tech Team")
@@ -31,7 +64,7 @@ st.markdown(
     - For a custom role (e.g., "Fitness Trainer"), enter a name and description (e.g., "You are a fitness trainer skilled in creating workout plans...").
     - Upload a file to provide data (optional). Supported formats: TXT, MD, CSV, JSON, PDF, DOCX, XLSX.
     - Type your message in the input field below and press Enter to instruct the chatbot.
-    - Use the "Copy" button to copy the assistant's response to your clipboard (works best in Chrome; may require permissions in Firefox).
+    - Use the "Copy" button under a response and click the copy icon to copy it to your clipboard.
     - This is an experimental chatbot interface. Responses may not always be accurate. Please use as a reference.
     """
 )
@@ -44,39 +77,48 @@ st.warning(
     """
 )
 
-# Fetch available models
-headers = {"Authorization": f"Bearer {API_KEY}"}
-response = requests.get(MODELS_URL, headers=headers)
-
-if response.status_code == 200:
-    try:
-        models_data = response.json().get("data", [])
-        available_models = [model.get("name", "Unknown Model") for model in models_data]
-    except json.JSONDecodeError:
-        available_models = ["Error: Invalid JSON response"]
-elif response.status_code == 403:
-    available_models = ["Access Forbidden - Check API Key Permissions"]
-else:
-    available_models = ["report01"]  # Fallback option
+# One pooled keep-alive client shared by all sessions and reruns
+@st.cache_resource
+def get_backend_client():
+    return BackendClient(connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT)
+
+client = get_backend_client()
 
-# Model selection
-MODEL_NAME = st.selectbox("Select a model:", available_models)
+# Model list is cached and refreshed in the background, so reruns never wait on /api/models
+@st.cache_resource
+def get_model_catalog():
+    return ModelCatalog(client, MODELS_URL, {"Authorization": f"Bearer {API_KEY}"}, ps_url=PS_URL)
 
-# Predefined AI Roles
-AI_ROLES = {
-    "General Assistant": "You are a versatile assistant designed for general-purpose personal assistance, helping with a wide range of tasks and questions.",
-    "Secretary": "You are a secretary assisting with drafting documents, proofreading, and managing text-based tasks.",
-    "Programmer": "You are a programmer skilled in writing, debugging, and explaining code across various languages.",
-    "Data Analyzer": "You are a data analyst proficient in extracting, analyzing, and interpreting data from various formats.",
-    "Teacher": "You are a teacher tasked with preparing course materials, explaining concepts, and aiding in education.",
-    "Trip Advisor": "You are a trip advisor specializing in planning trips, suggesting itineraries, and providing travel advice."
-}
+catalog = get_model_catalog()
+
+# Cold models are loaded as soon as they are picked and kept loaded while sessions use them
+@st.cache_resource
+def get_warmup():
+    return WarmupManager(client, GENERATE_URL, {"Authorization": f"Bearer {API_KEY}"}, catalog, usage_db=MODEL_USAGE_DB)
+
+warmup = get_warmup()
+models_data, models_error = catalog.snapshot()
+models_by_name = {model.get("name", "Unknown Model"): model for model in models_data}
+MODEL_BUDGETS = model_budgets(models_data)
+available_models = list(models_by_name) or ["report01"]  # Fallback option
+if models_error:
+    st.caption(models_error)
+
+# Model selection, labelled with whether each model is already loaded
+MODEL_NAME = st.selectbox(
+    "Select a model:",
+    available_models,
+    format_func=lambda name: model_label(name, warmup.state(models_by_name[name])) if name in models_by_name else name,
+    key="model_name",
+)
+if MODEL_NAME in models_by_name:
+    st.caption(model_details(models_by_name[MODEL_NAME]))
 
 # AI Role selection with custom option, defaulting to "General Assistant"
 role_option = st.selectbox(
     "Select AI Role or Choose Custom:",
     list(AI_ROLES.keys()) + ["Custom Role"],
-    index=list(AI_ROLES.keys()).index("General Assistant")  # Set default to "General Assistant"
+    index=list(AI_ROLES.keys()).index(DEFAULT_ROLE)  # Set default to "General Assistant"
 )
 
 # Custom Role Input
@@ -89,122 +131,232 @@ if role_option == "Custom Role":
         ""
     )
     SELECTED_ROLE = custom_role_name if custom_role_name else "Custom Role"
-    SELECTED_ROLE_DESC = custom_role_desc if custom_role_desc else "You are a helpful assistant with a custom role."
+    SELECTED_ROLE_DESC = custom_role_desc if custom_role_desc else CUSTOM_ROLE_DESC
 else:
     SELECTED_ROLE = role_option
     SELECTED_ROLE_DESC = AI_ROLES[role_option]
 
+# Conversations are appended to SQLite as they happen and can be resumed from the sidebar
+@st.cache_resource
+def get_chat_store():
+    return ChatStore(CHAT_STORE_DB)
+
+store = get_chat_store()
+
+# Per-turn phase timings are exported to Prometheus from a sidecar HTTP endpoint
+@st.cache_resource
+def get_turn_metrics():
+    return start_metrics(METRICS_PORT)
+
+turn_metrics = get_turn_metrics()
+
+# One admission controller per chatbot process: caps in-flight requests per model and queues the rest fairly
+@st.cache_resource
+def get_admission():
+    return AdmissionController(max_in_flight=MAX_IN_FLIGHT)
+
+admission = get_admission()
+
+# Prompt sizes and per-model prefill and decode speed, learned from the turns of all sessions
+@st.cache_resource
+def get_preflight():
+    return Preflight()
+
+preflight = get_preflight()
+
 # Initialize session state
-if "messages" not in st.session_state:
-    st.session_state.messages = []
-if "file_content" not in st.session_state:
-    st.session_state.file_content = None
-
-# Display chat messages from history
-for i, message in enumerate(st.session_state.messages):
-    with st.chat_message(message["role"]):
-        st.markdown(message["content"])
-        # Add copy button for assistant messages only
-        if message["role"] == "assistant":
-            # Use a hidden textarea and JavaScript for copying
-            components.html(
-                f"""
-                <textarea id="copy-text-{i}" style="display:none;">{message['content'].replace('`', '\\`').replace('"', '&quot;')}</textarea>
-                <button onclick="copyToClipboard('copy-text-{i}')">Copy</button>
-                <script>
-                function copyToClipboard(elementId) {{
-                    var text = document.getElementById(elementId).value;
-                    if (navigator.clipboard && navigator.clipboard.writeText) {{
-                        navigator.clipboard.writeText(text).then(
-                            function() {{ console.log('Copy successful'); }},
-                            function(err) {{ 
-                                console.error('Clipboard API failed:', err);
-                                fallbackCopy(text);
-                            }}
-                        );
-                    }} else {{
-                        fallbackCopy(text);
-                    }}
-                }}
-                function fallbackCopy(text) {{
-                    var tempInput = document.createElement('textarea');
-                    tempInput.value = text;
-                    document.body.appendChild(tempInput);
-                    tempInput.select();
-                    try {{
-                        document.execCommand('copy');
-                        console.log('Fallback copy successful');
-                    }} catch (err) {{
-                        console.error('Fallback copy failed:', err);
-                        alert('Copy failed. Please copy manually.');
-                    }}
-                    document.body.removeChild(tempInput);
-                }}
-                </script>
-                """,
-                height=50
-            )
+init_conversation(store)
+conversation_sidebar(store)
+if "user_id" not in st.session_state:
+    # Users are told apart by the login an auth proxy forwards, otherwise by browser session;
+    # a client reaching Streamlit directly could send any X-Forwarded-User, so it is opt-in
+    forwarded_user = st.context.headers.get("X-Forwarded-User") if TRUST_PROXY_USER_HEADER else None
+    st.session_state.user_id = forwarded_user or uuid.uuid4().hex
+warmup.select(st.session_state.user_id, MODEL_NAME)
+if MODEL_NAME in models_by_name and warmup.state(models_by_name[MODEL_NAME]) == "warming":
+    st.caption(f"Loading {MODEL_NAME} into memory in the background, so your first message won't wait for it")
+if "turn_phases" not in st.session_state:
+    st.session_state.turn_phases = []
+if "pending_reply" not in st.session_state:
+    st.session_state.pending_reply = None  # Reply being streamed; still set if the run was interrupted
+if "pending_extract" not in st.session_state:
+    st.session_state.pending_extract = None  # Extraction time, charged to the next turn
+
+# A reply interrupted by Stop is kept with whatever had arrived
+finish_stopped_reply(store, turn_metrics)
+
+# Display chat messages from history; older turns are paged so reruns stay fast
+render_transcript(
+    st.session_state.messages,
+    archived=st.session_state.history_offset,
+    load_archived=lambda offset, limit: store.load_messages(st.session_state.conversation_id, offset, limit),
+)
 
 # File upload with extended file types
 uploaded_file = st.file_uploader(
     "Upload a file (optional)", 
-    type=["txt", "md", "csv", "json", "pdf", "docx", "xlsx"]
+    type=SUPPORTED_TYPES
 )
 
-# Function to extract content from different file types
-def extract_file_content(file):
-    file_extension = file.name.split(".")[-1].lower()
-    try:
-        if file_extension in ["txt", "md"]:
-            return file.getvalue().decode("utf-8")
-        elif file_extension == "csv":
-            df = pd.read_csv(file)
-            return df.to_string(index=False)
-        elif file_extension == "json":
-            return json.dumps(json.load(file))
-        elif file_extension == "pdf":
-            reader = PdfReader(file)
-            text = ""
-            for page in reader.pages:
-                text += page.extract_text() or ""
-            return text
-        elif file_extension == "docx":
-            doc = Document(file)
-            text = ""
-            for para in doc.paragraphs:
-                text += para.text + "\n"
-            return text
-        elif file_extension == "xlsx":
-            df = pd.read_excel(file)
-            return df.to_string(index=False)
-        else:
-            return "Unsupported file format."
-    except Exception as e:
-        return f"Error reading file: {str(e)}"
+# Chunk and embed each distinct file once; the index is shared by all sessions
+@st.cache_resource(max_entries=16, show_spinner="Indexing uploaded file...")
+def build_document_index(name, digest, page_range, _text):
+    return DocumentIndex(name, digest, _text, EMBED_URL, EMBED_MODEL)
+
+# CSV and XLSX files are loaded into an in-memory database once per file; the model queries them with SQL
+@st.cache_resource(max_entries=16, show_spinner="Loading table...")
+def load_table_db(name, digest, _data):
+    return TableDB(name, _data)
+
+# Page selection for large PDFs
+page_range = ""
+if uploaded_file is not None and uploaded_file.name.lower().endswith(".pdf"):
+    page_range = st.text_input("PDF pages to read (optional, e.g. 1-20, 35):", "")
 
 # Process uploaded file
+table_db = None
 if uploaded_file is not None:
-    st.session_state.file_content = extract_file_content(uploaded_file)
+    digest = file_hash(uploaded_file.getvalue())
+    if uploaded_file.name.lower().rsplit(".", 1)[-1] in TABLE_TYPES:
+        try:
+            table_db = load_table_db(uploaded_file.name, digest, uploaded_file.getvalue())
+        except Exception as e:
+            st.caption(f"The table could not be loaded for queries ({e}); its text is sent instead")
+    # Streamlit reruns the script on every interaction; only extract when the file or page range changes
+    if st.session_state.file_key != (digest, page_range):
+        extract_started = time.perf_counter()
+        progress_bar = st.progress(0.0, text="Extracting file...")
+        if table_db is not None:
+            # Only the schema, column statistics and sample rows are sent, never the whole sheet
+            st.session_state.file_content = table_db.describe()
+        else:
+            st.session_state.file_content = extract_file_content(
+                uploaded_file,
+                page_range,
+                progress=lambda done, total: progress_bar.progress(done / total, text=f"Extracted {done}/{total} pages"),
+            )
+        progress_bar.empty()
+        st.session_state.pending_extract = time.perf_counter() - extract_started
+        st.session_state.file_key = (digest, page_range)
+        st.session_state.restored_upload = None
+        # The extracted text is kept with the conversation, so resuming it needs no re-upload
+        store.save_upload(
+            st.session_state.conversation_id, f"{digest}:{page_range}", uploaded_file.name, st.session_state.file_content
+        )
+    st.session_state.doc_index = None if table_db is not None else build_document_index(
+        uploaded_file.name, digest, page_range, st.session_state.file_content
+    )
     with st.expander("View Uploaded File Content"):
         st.text(st.session_state.file_content)
+elif st.session_state.restored_upload:
+    upload = st.session_state.restored_upload
+    st.session_state.doc_index = build_document_index(upload["name"], upload["digest"], "", upload["text"])
+    st.caption(f"Using {upload['name']} uploaded earlier in this conversation")
+
+# Documents larger than the retrieval budget can be read whole with map-reduce instead of by excerpts
+@st.cache_resource
+def get_map_reduce():
+    headers = {"Authorization": f"Bearer {API_KEY}", "Content-Type": "application/json"}
+    return MapReduce(API_URL, headers, client, MapCache(MAP_CACHE_DB), concurrency=MAX_IN_FLIGHT, admission=admission)
+
+map_reduce = get_map_reduce()
+use_map_reduce = False
+if st.session_state.file_content and st.session_state.doc_index is not None \
+        and st.session_state.doc_index.total_tokens > RAG_TOKEN_BUDGET:
+    use_map_reduce = st.checkbox(
+        "Read the whole document (map-reduce)",
+        help="For summaries and questions about the whole document: every part is condensed into notes in parallel "
+             "and the notes are merged until they fit the model's context. Notes are cached, so later questions "
+             "on the same file are fast. Without this, only the excerpts most relevant to each question are sent.",
+    )
+
+# Opt-in cache of answers to repeated questions, shared by all sessions
+@st.cache_resource
+def get_response_cache():
+    return ResponseCache(RESPONSE_CACHE_DB, embed_url=EMBED_URL, embed_model=EMBED_MODEL)
+
+response_cache = get_response_cache()
+use_response_cache = st.checkbox(
+    "Answer repeated questions from the response cache",
+    help="Questions without uploaded data are answered from earlier identical or very similar questions to the same model and role",
+)
+if use_response_cache:
+    st.caption(format_cache_stats(response_cache.stats()))
+
+# Each SQL step is a short request to the chosen model and takes an admission slot like any other
+def complete_sql_step(messages):
+    headers = {"Authorization": f"Bearer {API_KEY}", "Content-Type": "application/json"}
+    stats = TurnStats()
+    with admission.slot(st.session_state.user_id, MODEL_NAME, count_message_tokens(messages)) as ticket:
+        reply = complete_chat(API_URL, headers, {"model": MODEL_NAME, "messages": messages}, stats, session=client)
+        ticket.completion_tokens = stats.tokens or 0
+    return reply
 
 # User input field
 user_input = st.chat_input("Type your message...")
 
 if user_input:
-    # Prepare the full user message
-    full_user_message = user_input
+    timer = TurnTimer()
+    timer.add("extract", st.session_state.pending_extract)
+    st.session_state.pending_extract = None
+    # Uploaded data is kept apart from the typed message so that only the newest copy is sent
+    attachment = ""
+    used_chunks = []
+    sql_steps = []
     if st.session_state.file_content:
-        full_user_message = (
-            f"{user_input}\n\n"
-            f"[Uploaded Data]:\n{st.session_state.file_content}\n"
+        # Only the chunks relevant to this question are sent, not the whole document
+        file_text = st.session_state.file_content
+        doc_index = st.session_state.doc_index
+        if table_db is not None:
+            # The model queries the table first and answers from the query results
+            with st.spinner("Querying the table..."):
+                sql_steps, sql_error = run_sql_steps(table_db, user_input, complete_sql_step)
+            if sql_steps:
+                file_text += f"\n\n[SQL Query Results]:\n{format_steps(sql_steps)}"
+            if sql_error:
+                st.caption(f"Table queries stopped early: {sql_error}")
+            timer.lap("table_query")
+        elif use_map_reduce:
+            progress_bar = st.progress(0.0, text="Reading the document...")
+            notes = map_reduce.read(
+                MODEL_NAME,
+                doc_index.name,
+                file_text,
+                MODEL_BUDGETS.get(MODEL_NAME, DEFAULT_CONTEXT),
+                progress=lambda done, total, stage: progress_bar.progress(done / total, text=f"{stage}: {done}/{total} parts"),
+                user=st.session_state.user_id,
+            )
+            progress_bar.empty()
+            file_text = notes["text"]
+            st.caption(format_notes(notes))
+            timer.lap("map_reduce")
+        elif doc_index is not None:
+            hits = doc_index.search(user_input, RAG_TOP_K, RAG_TOKEN_BUDGET)
+            file_text = format_chunks(doc_index, hits)
+            if len(hits) < len(doc_index.chunks):
+                used_chunks = [i + 1 for i, _, _ in hits]
+        attachment = (
+            f"\n\n[Uploaded Data]:\n{file_text}\n"
             "Please use the uploaded data above to process my request."
         )
     
     # Add user message to session state
-    st.session_state.messages.append({"role": "user", "content": full_user_message})
+    st.session_state.messages.append(
+        {"role": "user", "content": user_input, "attachment": attachment, "chunks": used_chunks}
+    )
+    store.append_message(st.session_state.conversation_id, st.session_state.messages[-1], MODEL_NAME)
     with st.chat_message("user"):
-        st.markdown(full_user_message)
+        st.markdown(user_input)
+        if used_chunks:
+            with st.expander(f"Document excerpts used ({len(used_chunks)} of {len(doc_index.chunks)})"):
+                for i, score, text in hits:
+                    st.markdown(f"**Excerpt {i + 1}** (similarity {score:.2f})")
+                    st.text(text)
+        if sql_steps:
+            with st.expander(f"Table queries run ({len(sql_steps)})"):
+                for step in sql_steps:
+                    st.code(step["sql"], language="sql")
+                    st.text(step["result"])
     
     # Prepare API request
     headers = {
@@ -213,75 +365,153 @@ if user_input:
     }
     
     # System message with selected AI role
-    system_prompt = (
-        f"{SELECTED_ROLE_DESC} "
-        "You are a helpful assistant. If the user provides uploaded data in their message, "
-        "use it to answer their question or follow their instructions. "
-        "Do not ask for additional data or links if it is already provided."
-    )
+    system_prompt = role_system_prompt(SELECTED_ROLE_DESC)
     
-    messages = [
-        {"role": "system", "content": system_prompt}
-    ] + st.session_state.messages
+    # Repeated questions are answered from the cache without a GPU generation
+    cached = None
+    # Follow-ups that refer to earlier turns are not cached: their answer depends on the conversation
+    cacheable = use_response_cache and not attachment and not is_follow_up(user_input, st.session_state.messages[:-1])
+    if cacheable:
+        cached = response_cache.lookup(MODEL_NAME, system_prompt, user_input)
     
-    payload = {
-        "model": MODEL_NAME,
-        "messages": messages
-    }
+    if cached is None:
+        # Keep the prompt within the model's context: recent turns verbatim, older ones summarized;
+        # pre-flight counts it for this model and rebuilds it smaller if it would not fit
+        messages, st.session_state.history_summary, window_info = preflight.fit(
+            MODEL_NAME,
+            MODEL_BUDGETS.get(MODEL_NAME, DEFAULT_CONTEXT),
+            system_prompt,
+            st.session_state.messages,
+            st.session_state.history_summary,
+            summarize=lambda previous, dropped, max_tokens: summarize_messages(
+                API_URL, headers, MODEL_NAME, previous, dropped, max_tokens, session=client
+            ),
+        )
+        persist_summary(store)
+        st.caption(format_window(window_info) + " · " + format_preflight(window_info))
     
-    # Send request to Open Web-UI API
-    response = requests.post(API_URL, headers=headers, data=json.dumps(payload))
+        payload = {
+            "model": MODEL_NAME,
+            "messages": messages
+        }
     
-    if response.status_code == 200:
-        reply = response.json().get("choices", [{}])[0].get("message", {}).get("content", "No response")
-        if st.session_state.file_content and ("please provide" in reply.lower() or "input data" in reply.lower() or "link" in reply.lower()):
-            reply += (
-                "\n\n**Note:** The uploaded data was provided in the message. "
-                "Please use it to respond. If I misunderstood, clarify your request!"
-            )
-    else:
-        reply = f"Error: {response.status_code} - {response.text}"
+    # Send request to Open Web-UI API
+    timer.lap("prompt_build")
+    stats = TurnStats()
+    outcome = "ok"
+    with st.chat_message("assistant"):
+        cached_label = None
+        if cached is not None:
+            reply = cached["reply"]
+            st.markdown(reply)
+            if cached["kind"] == "exact":
+                cached_label = f"⚡ Cached answer (same question asked before) · {cached['tokens']} tokens saved"
+            else:
+                cached_label = f"⚡ Cached answer (similar question, similarity {cached['similarity']:.2f}) · {cached['tokens']} tokens saved"
+            st.caption(cached_label)
+            outcome = "cached"
+        else:
+            # Stop reruns the script, which interrupts the stream below and closes its connection
+            stop_slot = st.empty()
+            stop_slot.button("Stop", key="stop_generation", icon=":material/stop_circle:")
+            queue_status = st.empty()
+            ticket = None
+            st.session_state.pending_reply = {
+                "conversation_id": st.session_state.conversation_id,
+                "model": MODEL_NAME,
+                "role": role_option,
+                "content": "",
+                "stats": stats,
+                "routed": False,
+            }
+            try:
+                preflight.check(window_info)
+                ticket = admission.acquire(
+                    st.session_state.user_id, MODEL_NAME, window_info["prompt_tokens"],
+                    on_wait=lambda position, wait: queue_status.info(
+                        f"Waiting for a free {MODEL_NAME} slot: position {position} in line, about {wait:.0f}s"
+                    ),
+                )
+                queue_status.empty()
+                timer.lap("queue")
+                stats.start = time.perf_counter()  # Backend timings start once the request has a slot
+                if STREAM_RESPONSES:
+                    reply = st.write_stream(collect(
+                        stream_chat_completion(API_URL, headers, payload, stats, session=client), st.session_state.pending_reply
+                    ))
+                else:
+                    reply = complete_chat(API_URL, headers, payload, stats, session=client)
+                    st.markdown(reply)
+                reply_lower = reply.lower()
+                note = ""
+                if st.session_state.file_content and ("please provide" in reply_lower or "input data" in reply_lower or "link" in reply_lower):
+                    note += (
+                        "\n\n**Note:** The uploaded data was provided in the message. "
+                        "Please use it to respond. If I misunderstood, clarify your request!"
+                    )
+                if note:
+                    st.markdown(note)
+                    reply += note
+            except PromptTooLarge as e:
+                cacheable = False
+                outcome = "rejected"
+                reply = f"Error: {e}."
+                st.markdown(reply)
+            except AdmissionRejected as e:
+                cacheable = False
+                timer.lap("queue")
+                outcome = "rejected"
+                reply = f"Error: {e}" + (f". Please try again in {e.retry_after:.0f}s." if e.retry_after else "")
+                st.markdown(reply)
+            except StreamError as e:
+                cacheable = False
+                outcome = "error"
+                reply = f"Error: {e.status_code} - {e.text}"
+                st.markdown(reply)
+            except requests.exceptions.RequestException as e:
+                cacheable = False
+                outcome = "error"
+                reply = f"Error: {str(e)}"
+                st.markdown(reply)
+            finally:
+                queue_status.empty()
+                if ticket is not None:
+                    admission.release(ticket, stats.tokens)
+            st.session_state.pending_reply = None
+            stop_slot.empty()
+            st.caption(format_stats(stats.as_dict()) + " · " + format_pool_stats(client.stats()))
+            if cacheable:
+                response_cache.store(MODEL_NAME, system_prompt, user_input, reply, stats.tokens)
+        copy_control(reply)
     
+    # Phase breakdown for the debug sidebar and the metrics endpoint
+    timer.finish_reply(stats)
+    warmup.record_use(MODEL_NAME)
+    if outcome == "ok" and not stats.cancelled:
+        preflight.record(MODEL_NAME, window_info, stats)
+    st.session_state.turn_phases = (st.session_state.turn_phases + [dict(timer.as_dict(), total=timer.total)])[-RECENT_TURNS:]
+    if turn_metrics is not None:
+        turn_metrics.observe(MODEL_NAME, role_option, timer, stats.tokens, outcome)
+
     # Add assistant message to session state
-    st.session_state.messages.append({"role": "assistant", "content": reply})
-    
-    with st.chat_message("assistant"):
-        st.markdown(reply)
-        # Add copy button for the new assistant message
-        components.html(
-            f"""
-            <textarea id="copy-text-latest" style="display:none;">{reply.replace('`', '\\`').replace('"', '&quot;')}</textarea>
-            <button onclick="copyToClipboard('copy-text-latest')">Copy</button>
-            <script>
-            function copyToClipboard(elementId) {{
-                var text = document.getElementById(elementId).value;
-                if (navigator.clipboard && navigator.clipboard.writeText) {{
-                    navigator.clipboard.writeText(text).then(
-                        function() {{ console.log('Copy successful'); }},
-                        function(err) {{ 
-                            console.error('Clipboard API failed:', err);
-                            fallbackCopy(text);
-                        }}
-                    );
-                }} else {{
-                    fallbackCopy(text);
-                }}
-            }}
-            function fallbackCopy(text) {{
-                var tempInput = document.createElement('textarea');
-                tempInput.value = text;
-                document.body.appendChild(tempInput);
-                tempInput.select();
-                try {{
-                    document.execCommand('copy');
-                    console.log('Fallback copy successful');
-                }} catch (err) {{
-                    console.error('Fallback copy failed:', err);
-                    alert('Copy failed. Please copy manually.');
-                }}
-                document.body.removeChild(tempInput);
-            }}
-            </script>
-            """,
-            height=50
-        )
+    st.session_state.messages.append({
+        "role": "assistant",
+        "content": reply,
+        "stats": None if cached else stats.as_dict(),
+        "cached": cached_label,
+    })
+    store.append_message(st.session_state.conversation_id, st.session_state.messages[-1], MODEL_NAME)
+
+# Optional latency breakdown of recent turns, to see which phase made a slow turn slow
+if st.sidebar.toggle("Latency breakdown", help="Seconds spent in each phase of your recent turns"):
+    if st.session_state.turn_phases:
+        st.sidebar.caption("Last turn: " + format_phases(st.session_state.turn_phases[-1]))
+        st.sidebar.dataframe(st.session_state.turn_phases[::-1], hide_index=True)
+    else:
+        st.sidebar.caption("No turns timed yet")
+    if admission.status():
+        st.sidebar.caption("Model queues")
+        st.sidebar.dataframe(admission.status(), hide_index=True)
+    if preflight.table():
+        st.sidebar.caption("Model throughput")
+        st.sidebar.dataframe(preflight.table(), hide_index=True)
@@ -0,0 +1,156 @@
+import re
+from functools import lru_cache
+
+from chat_stream import TurnStats, complete_chat
+
+try:
+    import tiktoken
+    _ENCODING = tiktoken.get_encoding("cl100k_base")
+except Exception:  # tiktoken not installed or its encoding file not available offline
+    _ENCODING = None
+
+# Context window per model name; models not listed here fall back to the
+# length reported by /api/models, then to DEFAULT_CONTEXT
+MODEL_CONTEXT = {}
+DEFAULT_CONTEXT = 8192
+REPLY_RESERVE = 1024  # Tokens left free for the model's answer
+SUMMARY_SHARE = 0.15  # Largest part of the budget the rolling summary may take
+KEEP_RECENT = 4  # Most recent messages that are never folded into the summary
+FOLD_TARGET = 0.6  # When folding, shrink the verbatim window to this share of its budget
+MESSAGE_OVERHEAD = 4  # Role and separator tokens added by chat templates
+
+
+@lru_cache(maxsize=4096)
+def count_tokens(text):
+    if not text:
+        return 0
+    if _ENCODING is not None:
+        return len(_ENCODING.encode(text, disallowed_special=()))
+    # Fallback estimate: sub-word tokenizers produce about 1.3 tokens per word
+    return int(len(re.findall(r"\w+|[^\w\s]", text)) * 1.3) + 1
+
+
+def count_message_tokens(messages):
+    return sum(count_tokens(m["content"]) + MESSAGE_OVERHEAD for m in messages)
+
+
+def context_length(model):
+    # Open WebUI passes through whatever the backend reports, so check the common spellings
+    for key in ("context_length", "max_model_len", "context_window", "num_ctx"):
+        if isinstance(model.get(key), int):
+            return model[key]
+    params = (model.get("info") or {}).get("params") or {}
+    if isinstance(params.get("num_ctx"), int):
+        return params["num_ctx"]
+    return None
+
+
+def model_budgets(models_data):
+    budgets = {}
+    for model in models_data:
+        name = model.get("name", "Unknown Model")
+        budgets[name] = MODEL_CONTEXT.get(name) or context_length(model) or DEFAULT_CONTEXT
+    return budgets
+
+
+def api_messages(history):
+    # Uploaded data and search results are only sent with the newest user turn;
+    # older copies are stale and would be prefilled again on every request
+    last_user = max((i for i, m in enumerate(history) if m["role"] == "user"), default=-1)
+    result = []
+    for i, m in enumerate(history):
+        content = m["content"]
+        if i == last_user and m.get("attachment"):
+            content += m["attachment"]
+        result.append({"role": m["role"], "content": content})
+    return result
+
+
+def fallback_summary(previous, dropped, max_tokens):
+    lines = [previous] if previous else []
+    for m in dropped:
+        text = " ".join(m["content"].split())
+        lines.append(f"{m['role'].capitalize()}: {text[:300]}")
+    summary = "\n".join(lines)
+    while count_tokens(summary) > max_tokens and "\n" in summary:
+        summary = summary.split("\n", 1)[1]
+    return summary
+
+
+def summarize_messages(api_url, headers, model, previous, dropped, max_tokens, timeout=None, session=None):
+    """Fold dropped turns into the rolling summary using the chat model itself."""
+    transcript = "\n\n".join(f"{m['role'].upper()}: {m['content']}" for m in dropped)
+    prompt = (
+        "Update the summary of an ongoing conversation with the new turns below. "
+        "Keep facts, decisions, names, numbers and open questions; drop pleasantries. "
+        f"Answer with the updated summary only, in at most {int(max_tokens * 0.75)} words.\n\n"
+        f"[Current Summary]:\n{previous or '(empty)'}\n\n[New Turns]:\n{transcript}"
+    )
+    payload = {
+        "model": model,
+        "messages": [{"role": "user", "content": prompt}],
+        "max_tokens": max_tokens,
+    }
+    try:
+        return complete_chat(api_url, headers, payload, TurnStats(), timeout=timeout, session=session).strip()
+    except Exception:
+        return fallback_summary(previous, dropped, max_tokens)
+
+
+def build_window(system_prompt, history, budget, summary, summarize=None):
+    """Fit the conversation into the model's token budget.
+
+    Returns the messages to send, the updated summary state and a dict
+    describing the window. summary is {"text": str, "covered": int}, where
+    covered counts the history messages already folded into the text.
+    summarize(previous_text, dropped_messages, max_tokens) produces the
+    new summary; without it an extractive summary is used.
+    """
+    summary = dict(summary)
+    head = [{"role": "system", "content": system_prompt}] if system_prompt else []
+    summary_budget = int(budget * SUMMARY_SHARE)
+    available = budget - REPLY_RESERVE - count_message_tokens(head) - summary_budget
+
+    candidates = api_messages(history)[summary["covered"]:]
+    costs = [count_tokens(m["content"]) + MESSAGE_OVERHEAD for m in candidates]
+    first_kept = len(candidates)
+    used = 0
+    for i in range(len(candidates) - 1, -1, -1):
+        # The newest message is always sent; older ones are kept while they fit
+        if i < len(candidates) - 1 and used + costs[i] > available:
+            break
+        used += costs[i]
+        first_kept = i
+
+    if first_kept > 0:
+        # Fold in batches so the summary is not rewritten on every turn
+        while first_kept < len(candidates) - KEEP_RECENT and used > available * FOLD_TARGET:
+            used -= costs[first_kept]
+            first_kept += 1
+
+        dropped = history[summary["covered"]:summary["covered"] + first_kept]
+        dropped = [{"role": m["role"], "content": m["content"]} for m in dropped]
+        if summarize is not None:
+            summary["text"] = summarize(summary["text"], dropped, summary_budget)
+        else:
+            summary["text"] = fallback_summary(summary["text"], dropped, summary_budget)
+        summary["covered"] += first_kept
+
+    kept = candidates[first_kept:]
+    if summary["text"]:
+        head = head + [{"role": "system", "content": f"[Summary of Earlier Conversation]:\n{summary['text']}"}]
+    messages = head + kept
+    info = {
+        "budget": budget,
+        "prompt_tokens": count_message_tokens(messages),
+        "kept": len(kept),
+        "summarized": summary["covered"],
+    }
+    return messages, summary, info
+
+
+def format_window(info):
+    text = f"Prompt {info['prompt_tokens']}/{info['budget']} tokens · {info['kept']} messages sent verbatim"
+    if info["summarized"]:
+        text += f" · {info['summarized']} earlier messages summarized"
+    return text
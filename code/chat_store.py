@@ -0,0 +1,147 @@
+import json
+import sqlite3
+import threading
+import time
+
+CHAT_STORE_DB = "chat_history.db"
+TITLE_LENGTH = 60
+
+
+class ChatStore:
+    """SQLite store for chatbot conversations.
+
+    Messages are only ever appended; the conversations table is a small index
+    (title, counts, rolling summary) that lists instantly, and messages are
+    read back in pages. Extracted uploads are stored once per content hash.
+    """
+
+    def __init__(self, path=CHAT_STORE_DB):
+        self._lock = threading.Lock()
+        # Streamlit serves each session from its own thread; the lock serializes access
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS conversations (
+                id TEXT PRIMARY KEY,
+                title TEXT NOT NULL,
+                model TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                message_count INTEGER NOT NULL DEFAULT 0,
+                summary_text TEXT NOT NULL DEFAULT '',
+                summary_covered INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS conversations_updated ON conversations (updated_at);
+            CREATE TABLE IF NOT EXISTS messages (
+                conversation_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                meta TEXT NOT NULL DEFAULT '{}',
+                created_at REAL NOT NULL,
+                PRIMARY KEY (conversation_id, seq)
+            );
+            CREATE TABLE IF NOT EXISTS uploads (
+                digest TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                text TEXT NOT NULL,
+                created_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS conversation_uploads (
+                conversation_id TEXT NOT NULL,
+                digest TEXT NOT NULL,
+                attached_at REAL NOT NULL,
+                PRIMARY KEY (conversation_id, digest)
+            );
+            """
+        )
+        self.db.commit()
+
+    def append_message(self, conversation_id, message, model=None):
+        # Attachments are not stored: they are rebuilt from the upload for the newest turn only
+        meta = {k: v for k, v in message.items() if k not in ("role", "content", "attachment") and v}
+        now = time.time()
+        with self._lock:
+            row = self.db.execute(
+                "SELECT message_count FROM conversations WHERE id = ?", (conversation_id,)
+            ).fetchone()
+            if row is None:
+                title = " ".join(message["content"].split())[:TITLE_LENGTH] or "New conversation"
+                self.db.execute(
+                    "INSERT INTO conversations (id, title, model, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                    (conversation_id, title, model, now, now),
+                )
+                seq = 0
+            else:
+                seq = row["message_count"]
+            self.db.execute(
+                "INSERT INTO messages (conversation_id, seq, role, content, meta, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (conversation_id, seq, message["role"], message["content"], json.dumps(meta), now),
+            )
+            self.db.execute(
+                "UPDATE conversations SET message_count = ?, updated_at = ?, model = COALESCE(?, model) WHERE id = ?",
+                (seq + 1, now, model, conversation_id),
+            )
+            self.db.commit()
+
+    def update_summary(self, conversation_id, text, covered):
+        with self._lock:
+            self.db.execute(
+                "UPDATE conversations SET summary_text = ?, summary_covered = ? WHERE id = ?",
+                (text, covered, conversation_id),
+            )
+            self.db.commit()
+
+    def list_conversations(self, limit=50):
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT id, title, model, updated_at, message_count FROM conversations "
+                "ORDER BY updated_at DESC LIMIT ?",
+                (limit,),
+            ).fetchall()
+        return [dict(r) for r in rows]
+
+    def get_conversation(self, conversation_id):
+        with self._lock:
+            row = self.db.execute("SELECT * FROM conversations WHERE id = ?", (conversation_id,)).fetchone()
+        return dict(row) if row else None
+
+    def load_messages(self, conversation_id, offset=0, limit=-1):
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT role, content, meta FROM messages WHERE conversation_id = ? "
+                "ORDER BY seq LIMIT ? OFFSET ?",
+                (conversation_id, limit, offset),
+            ).fetchall()
+        return [dict(json.loads(r["meta"]), role=r["role"], content=r["content"]) for r in rows]
+
+    def save_upload(self, conversation_id, digest, name, text):
+        now = time.time()
+        with self._lock:
+            self.db.execute(
+                "INSERT OR IGNORE INTO uploads (digest, name, text, created_at) VALUES (?, ?, ?, ?)",
+                (digest, name, text, now),
+            )
+            self.db.execute(
+                "INSERT OR REPLACE INTO conversation_uploads (conversation_id, digest, attached_at) VALUES (?, ?, ?)",
+                (conversation_id, digest, now),
+            )
+            self.db.commit()
+
+    def latest_upload(self, conversation_id):
+        with self._lock:
+            row = self.db.execute(
+                "SELECT u.digest, u.name, u.text FROM conversation_uploads c JOIN uploads u ON u.digest = c.digest "
+                "WHERE c.conversation_id = ? ORDER BY c.attached_at DESC LIMIT 1",
+                (conversation_id,),
+            ).fetchone()
+        return dict(row) if row else None
+
+    def delete_conversation(self, conversation_id):
+        with self._lock:
+            self.db.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+            self.db.execute("DELETE FROM conversation_uploads WHERE conversation_id = ?", (conversation_id,))
+            self.db.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
+            self.db.commit()
@@ -0,0 +1,159 @@
+import json
+import time
+
+import requests
+
+
+class StreamError(Exception):
+    def __init__(self, status_code, text):
+        super().__init__(f"{status_code} - {text}")
+        self.status_code = status_code
+        self.text = text
+
+
+class TurnStats:
+    """Timing of a single chat turn: time-to-first-token and decode speed."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.response_at = None  # Response headers received: connection and request are done
+        self.first_token_at = None
+        self.end = None
+        self.chunks = 0
+        self.completion_tokens = None  # Filled from the server's usage block when it sends one
+        self.prompt_tokens = None  # Prompt size as the server's tokenizer counted it, from the same block
+        self.cancelled = False  # The reader stopped before the reply was complete
+
+    def on_response(self):
+        if self.response_at is None:
+            self.response_at = time.perf_counter()
+
+    def on_token(self):
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        self.chunks += 1
+
+    def finish(self):
+        if self.end is None:
+            self.end = time.perf_counter()
+
+    @property
+    def ttft(self):
+        if self.first_token_at is None:
+            return None
+        return self.first_token_at - self.start
+
+    @property
+    def total(self):
+        return (self.end or time.perf_counter()) - self.start
+
+    @property
+    def tokens(self):
+        return self.completion_tokens if self.completion_tokens is not None else self.chunks
+
+    @property
+    def tokens_per_sec(self):
+        if self.first_token_at is None or self.tokens < 2:
+            return None
+        decode_time = (self.end or time.perf_counter()) - self.first_token_at
+        # The first token is produced by prefill, the rest by decoding
+        return (self.tokens - 1) / decode_time if decode_time > 0 else None
+
+    def as_dict(self):
+        return {
+            "ttft": self.ttft,
+            "total": self.total,
+            "tokens": self.tokens,
+            "tokens_per_sec": self.tokens_per_sec,
+        }
+
+
+def format_stats(stats):
+    parts = []
+    if stats.get("ttft") is not None:
+        parts.append(f"TTFT {stats['ttft']:.2f}s")
+    if stats.get("tokens_per_sec") is not None:
+        parts.append(f"{stats['tokens_per_sec']:.1f} tok/s")
+    parts.append(f"{stats.get('tokens', 0)} tokens")
+    parts.append(f"total {stats.get('total', 0):.2f}s")
+    return " · ".join(parts)
+
+
+def parse_sse_line(line):
+    # OpenAI-compatible servers send "data: {...}" lines and finish with "data: [DONE]"
+    if not line or not line.startswith("data:"):
+        return None
+    data = line[len("data:"):].strip()
+    if data == "[DONE]":
+        return "[DONE]"
+    try:
+        return json.loads(data)
+    except json.JSONDecodeError:
+        return None
+
+
+def stream_chat_completion(api_url, headers, payload, stats, timeout=None, session=None):
+    """Yield content deltas of a streaming chat completion, recording timings in stats.
+
+    session may be a requests.Session or http_client.BackendClient to reuse pooled connections.
+    """
+    http = session or requests
+    body = dict(payload, stream=True)
+    try:
+        with http.post(api_url, headers=headers, data=json.dumps(body), stream=True, timeout=timeout) as response:
+            stats.on_response()
+            if response.status_code != 200:
+                raise StreamError(response.status_code, response.text)
+            for line in response.iter_lines(decode_unicode=True):
+                chunk = parse_sse_line(line)
+                if chunk is None:
+                    continue
+                if chunk == "[DONE]":
+                    break
+                usage = chunk.get("usage")
+                if usage and usage.get("completion_tokens") is not None:
+                    stats.completion_tokens = usage["completion_tokens"]
+                    stats.prompt_tokens = usage.get("prompt_tokens")
+                choices = chunk.get("choices") or [{}]
+                delta = choices[0].get("delta", {}).get("content")
+                if delta:
+                    stats.on_token()
+                    yield delta
+    except GeneratorExit:
+        # The reader went away (Stop button or a rerun). Leaving the with block closes the
+        # connection instead of returning it to the pool, and vLLM and Ollama abort on disconnect
+        stats.cancelled = True
+        raise
+    finally:
+        stats.finish()
+
+
+def collect(stream, sink):
+    """Pass deltas through while appending them to sink["content"].
+
+    A Streamlit rerun interrupts the script mid-stream; the sink (kept in
+    session state) still holds the partial reply afterwards.
+    """
+    try:
+        for delta in stream:
+            sink["content"] += delta
+            yield delta
+    finally:
+        stream.close()
+
+
+def complete_chat(api_url, headers, payload, stats, timeout=None, session=None):
+    """Blocking chat completion for backends without streaming; returns the reply text."""
+    http = session or requests
+    response = http.post(api_url, headers=headers, data=json.dumps(payload), timeout=timeout)
+    stats.on_response()
+    stats.finish()
+    if response.status_code != 200:
+        raise StreamError(response.status_code, response.text)
+    data = response.json()
+    reply = data.get("choices", [{}])[0].get("message", {}).get("content", "No response")
+    # Without streaming the first token only becomes visible with the full reply
+    stats.first_token_at = stats.end
+    stats.completion_tokens = data.get("usage", {}).get("completion_tokens")
+    stats.prompt_tokens = data.get("usage", {}).get("prompt_tokens")
+    return reply
@@ -0,0 +1,151 @@
+import math
+import time
+import uuid
+
+import streamlit as st
+
+from chat_stream import format_stats
+
+RECENT_MESSAGES = 20  # Newest messages, always rendered
+PAGE_SIZE = 20  # Messages per page when browsing older history
+
+
+def copy_control(text):
+    # st.code carries Streamlit's own copy-to-clipboard button, so no per-message
+    # iframe or script is needed; the popover keeps the duplicate text out of sight
+    with st.popover("Copy"):
+        st.code(text, language="markdown", wrap_lines=True)
+
+
+def message_captions(message):
+    if message.get("stats"):
+        st.caption(format_stats(message["stats"]))
+    if message.get("chunks"):
+        st.caption("Document excerpts used: " + ", ".join(str(n) for n in message["chunks"]))
+    if message.get("cached"):
+        st.caption(message["cached"])
+    if message.get("stopped"):
+        st.caption("⏹ Stopped before the reply was complete")
+
+
+def render_message(message, copy=True):
+    with st.chat_message(message["role"]):
+        st.markdown(message["content"])
+        message_captions(message)
+        if copy and message["role"] == "assistant":
+            copy_control(message["content"])
+
+
+@st.fragment
+def render_older(messages, copy=True, archived=0, load_archived=None):
+    # A fragment: paging through old turns reruns only this block, not the whole chatbot
+    total = archived + len(messages)
+    if not st.toggle(f"Show {total} earlier messages", key="transcript_show_older"):
+        return
+    pages = math.ceil(total / PAGE_SIZE)
+    page = pages
+    if pages > 1:
+        page = st.select_slider("Page", options=list(range(1, pages + 1)), value=pages, key="transcript_page")
+    start, end = (page - 1) * PAGE_SIZE, min(page * PAGE_SIZE, total)
+    # Messages of a resumed conversation that are no longer in memory are read from the store per page
+    shown = load_archived(start, min(end, archived) - start) if start < archived and load_archived else []
+    shown += messages[max(start - archived, 0):max(end - archived, 0)]
+    for message in shown:
+        render_message(message, copy)
+
+
+def render_transcript(messages, copy=True, archived=0, load_archived=None):
+    """Render the newest messages; older ones are paged on demand so reruns stay flat.
+
+    archived counts earlier messages kept only in the conversation store;
+    load_archived(offset, limit) reads a page of them.
+    """
+    older = messages[:-RECENT_MESSAGES] if len(messages) > RECENT_MESSAGES else []
+    if older or archived:
+        render_older(older, copy, archived, load_archived)
+    for message in messages[len(older):]:
+        render_message(message, copy)
+
+
+def start_conversation():
+    st.session_state.conversation_id = uuid.uuid4().hex
+    st.session_state.messages = []
+    st.session_state.history_summary = {"text": "", "covered": 0}
+    st.session_state.history_offset = 0  # Messages before this index live only in the store
+    st.session_state.file_content = None
+    st.session_state.doc_index = None
+    st.session_state.file_key = None
+    st.session_state.restored_upload = None
+    st.query_params["c"] = st.session_state.conversation_id
+
+
+def resume_conversation(store, conversation_id):
+    """Load a stored conversation: only the messages after its summary are held in memory."""
+    conversation = store.get_conversation(conversation_id)
+    if conversation is None:
+        return False
+    offset = conversation["summary_covered"]
+    st.session_state.conversation_id = conversation_id
+    st.session_state.messages = store.load_messages(conversation_id, offset)
+    st.session_state.history_summary = {"text": conversation["summary_text"], "covered": 0}
+    st.session_state.history_offset = offset
+    upload = store.latest_upload(conversation_id)
+    st.session_state.file_content = upload["text"] if upload else None
+    st.session_state.doc_index = None
+    st.session_state.file_key = None
+    st.session_state.restored_upload = upload
+    st.query_params["c"] = conversation_id
+    return True
+
+
+def init_conversation(store):
+    # A reload keeps the conversation id in the URL, so the conversation is picked up from the store
+    if "conversation_id" in st.session_state:
+        return
+    conversation_id = st.query_params.get("c")
+    if not (conversation_id and resume_conversation(store, conversation_id)):
+        start_conversation()
+
+
+def conversation_sidebar(store, limit=30):
+    with st.sidebar:
+        st.subheader("Conversations")
+        if st.button("New conversation", use_container_width=True):
+            start_conversation()
+            st.rerun()
+        # The index holds titles and counts only; messages are loaded when a conversation is opened
+        for conversation in store.list_conversations(limit):
+            current = conversation["id"] == st.session_state.conversation_id
+            label = f"{'▶ ' if current else ''}{conversation['title']}"
+            when = time.strftime("%Y-%m-%d %H:%M", time.localtime(conversation["updated_at"]))
+            if st.button(label, key=f"conversation_{conversation['id']}", help=f"{when} · {conversation['message_count']} messages",
+                         use_container_width=True, disabled=current):
+                resume_conversation(store, conversation["id"])
+                st.rerun()
+
+
+def persist_summary(store):
+    # Summary coverage is stored as an absolute message index so a resume can skip what it covers
+    summary = st.session_state.history_summary
+    store.update_summary(
+        st.session_state.conversation_id, summary["text"], st.session_state.history_offset + summary["covered"]
+    )
+
+
+def finish_stopped_reply(store, turn_metrics=None):
+    """Keep the partial reply of a run interrupted mid-stream by Stop (or any other rerun)."""
+    pending = st.session_state.get("pending_reply")
+    if pending is None:
+        return
+    st.session_state.pending_reply = None
+    stats = pending["stats"]
+    stats.finish()
+    message = {"role": "assistant", "content": pending["content"], "stats": stats.as_dict(), "stopped": True}
+    if pending["conversation_id"] == st.session_state.conversation_id:
+        st.session_state.messages.append(message)
+    store.append_message(pending["conversation_id"], message, pending["model"])
+    if turn_metrics is not None:
+        turn_metrics.cancelled(pending["model"], pending["role"], stats.tokens)
+        if not pending["routed"]:
+            # Through Open WebUI only the closed connection can be checked, not the backend abort
+            turn_metrics.cancel_confirmation(pending["model"], pending["role"], "unverified")
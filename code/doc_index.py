@@ -0,0 +1,127 @@
+import hashlib
+import re
+
+import numpy as np
+import requests
+
+from chat_history import count_tokens
+
+CHUNK_TOKENS = 300  # Target size of one retrievable chunk
+HASH_DIM = 4096  # Width of the offline hashing vectors
+EMBED_BATCH = 32
+
+
+def file_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def split_long(text, max_tokens):
+    # Paragraphs that exceed a chunk on their own are cut on line, then word boundaries
+    pieces = []
+    step = max(int(max_tokens / 1.3), 1)
+    for line in text.splitlines():
+        if count_tokens(line) > max_tokens:
+            words = line.split()
+            pieces.extend(" ".join(words[i:i + step]) for i in range(0, len(words), step))
+        elif line.strip():
+            pieces.append(line)
+    return pieces
+
+
+def chunk_text(text, max_tokens=CHUNK_TOKENS):
+    paragraphs = [p.strip() for p in re.split(r"\n\s*\n|\f", text) if p.strip()]
+    chunks = []
+    current, current_tokens = [], 0
+    for para in paragraphs:
+        tokens = count_tokens(para)
+        pieces = split_long(para, max_tokens) if tokens > max_tokens else [para]
+        for piece in pieces:
+            piece_tokens = count_tokens(piece)
+            if current and current_tokens + piece_tokens > max_tokens:
+                chunks.append("\n".join(current))
+                current, current_tokens = [], 0
+            current.append(piece)
+            current_tokens += piece_tokens
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+def hash_embed(texts):
+    # Signed hashing-trick term vectors: no model needed, good enough for keyword overlap
+    vectors = np.zeros((len(texts), HASH_DIM), dtype=np.float32)
+    for row, text in enumerate(texts):
+        for word in re.findall(r"\w+", text.lower()):
+            digest = hashlib.md5(word.encode("utf-8")).digest()
+            index = int.from_bytes(digest[:4], "little") % HASH_DIM
+            vectors[row, index] += 1.0 if digest[4] & 1 else -1.0
+    vectors = np.sign(vectors) * np.log1p(np.abs(vectors))
+    return normalize(vectors)
+
+
+def normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def ollama_embed(texts, embed_url, model, timeout=60):
+    vectors = []
+    for i in range(0, len(texts), EMBED_BATCH):
+        response = requests.post(embed_url, json={"model": model, "input": texts[i:i + EMBED_BATCH]}, timeout=timeout)
+        response.raise_for_status()
+        vectors.extend(response.json()["embeddings"])
+    return normalize(np.asarray(vectors, dtype=np.float32))
+
+
+class DocumentIndex:
+    """Chunked, embedded copy of one uploaded document, built once per file hash."""
+
+    def __init__(self, name, digest, text, embed_url=None, embed_model=None):
+        self.name = name
+        self.digest = digest
+        self.embed_url = embed_url
+        self.embed_model = embed_model
+        self.chunks = chunk_text(text)
+        self.chunk_tokens = [count_tokens(c) for c in self.chunks]
+        self.total_tokens = sum(self.chunk_tokens)
+        self.hash_vectors = hash_embed(self.chunks) if self.chunks else np.zeros((0, HASH_DIM), dtype=np.float32)
+        self.model_vectors = None
+        if embed_url and embed_model and self.chunks:
+            try:
+                self.model_vectors = ollama_embed(self.chunks, embed_url, embed_model)
+            except Exception:
+                # Embedding server down: fall back to the hashing vectors
+                self.model_vectors = None
+
+    def scores(self, query):
+        if self.model_vectors is not None:
+            try:
+                return self.model_vectors @ ollama_embed([query], self.embed_url, self.embed_model)[0]
+            except Exception:
+                pass
+        return self.hash_vectors @ hash_embed([query])[0]
+
+    def search(self, query, top_k=5, token_budget=2000):
+        """Return [(chunk_number, score, text)] of the best chunks that fit the budget, in document order."""
+        if not self.chunks:
+            return []
+        # Small documents are sent whole; retrieval only pays off when they don't fit
+        if self.total_tokens <= token_budget:
+            return [(i, 1.0, c) for i, c in enumerate(self.chunks)]
+        scores = self.scores(query)
+        picked, used = [], 0
+        for i in np.argsort(-scores):
+            if len(picked) >= top_k or (picked and scores[i] <= 0):
+                break
+            if used + self.chunk_tokens[i] > token_budget:
+                continue
+            picked.append((int(i), float(scores[i]), self.chunks[i]))
+            used += self.chunk_tokens[i]
+        return sorted(picked)
+
+
+def format_chunks(index, hits):
+    if len(hits) == len(index.chunks):
+        return "\n\n".join(text for _, _, text in hits)
+    return "\n\n".join(f"[Excerpt {i + 1}/{len(index.chunks)} of {index.name}]\n{text}" for i, _, text in hits)
@@ -0,0 +1,246 @@
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from admission import AdmissionRejected
+from chat_history import REPLY_RESERVE, count_tokens
+from chat_stream import TurnStats, complete_chat
+from doc_index import chunk_text, split_long
+from response_cache import digest
+
+MAP_CACHE_DB = "map_cache.db"
+MAP_CACHE_TTL = 30 * 24 * 3600  # Seconds a chunk's notes are reused
+MAP_CHUNK_TOKENS = 3000  # Largest chunk read by one map call; smaller contexts get smaller chunks
+NOTE_TOKENS = 400  # Longest notes written for one chunk or one merge
+NOTES_SHARE = 0.4  # Share of the context the final notes may take
+MAP_CONCURRENCY = 4  # Map and merge calls sent at once
+PROMPT_OVERHEAD = 200  # Tokens of instructions around a chunk
+ADMISSION_WAIT = 600  # Seconds one map or merge call keeps retrying while the model is overloaded
+ADMISSION_RETRY = 5  # Longest pause between those retries
+
+# Notes are written without the question, so they can be reused by every later question on the file
+MAP_PROMPT = (
+    "Below is part {part} of {parts} of the document \"{name}\". Write dense notes of this part for someone "
+    "who will answer questions about the whole document without seeing it. Keep every fact, name, number, "
+    "date, definition and conclusion; drop filler. Answer with the notes only, in at most {words} words.\n\n"
+    "[Document Part]:\n{text}"
+)
+REDUCE_PROMPT = (
+    "Below are notes on consecutive parts of the document \"{name}\". Merge them into one set of notes in "
+    "document order. Keep every fact, name, number and date that could answer a question; remove repetition. "
+    "Answer with the merged notes only, in at most {words} words.\n\n{text}"
+)
+
+
+class MapCache:
+    """Map and merge results keyed by a hash of the model, instructions and input text, stored in SQLite."""
+
+    def __init__(self, path=MAP_CACHE_DB, ttl=MAP_CACHE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS notes (
+                key TEXT PRIMARY KEY,
+                text TEXT NOT NULL,
+                created_at REAL NOT NULL
+            );
+            """
+        )
+        self.db.commit()
+
+    def get(self, key):
+        with self._lock:
+            row = self.db.execute(
+                "SELECT text FROM notes WHERE key = ? AND created_at > ?", (key, time.time() - self.ttl)
+            ).fetchone()
+        return row[0] if row else None
+
+    def put(self, key, text):
+        now = time.time()
+        with self._lock:
+            self.db.execute("INSERT OR REPLACE INTO notes (key, text, created_at) VALUES (?, ?, ?)", (key, text, now))
+            self.db.execute("DELETE FROM notes WHERE created_at <= ?", (now - self.ttl,))
+            self.db.commit()
+
+
+def truncate_tokens(text, max_tokens):
+    # Extractive stand-in when the model call fails: the start of the text, cut to size
+    pieces = split_long(text, max_tokens)
+    kept, used = [], 0
+    for piece in pieces:
+        tokens = count_tokens(piece)
+        if used + tokens > max_tokens:
+            break
+        kept.append(piece)
+        used += tokens
+    return "\n".join(kept)
+
+
+class MapReduce:
+    """Map-reduce reader for documents larger than the model's context.
+
+    The document is split into chunks that each fit one request; every chunk
+    is turned into notes in parallel (map), and the notes are merged in
+    rounds until they fit the budget (reduce). Map and merge results are
+    cached by content hash, so later questions on the same file skip them.
+    When an AdmissionController is given, each call takes a slot from it like
+    any other request to the model, but is not charged to the user's token
+    rate: a large document needs many calls, and the rate limit would cut it
+    off after a few dozen. Calls turned away because the model is overloaded
+    are retried for up to ADMISSION_WAIT seconds.
+    """
+
+    def __init__(self, api_url, headers, client=None, cache=None, concurrency=MAP_CONCURRENCY, admission=None):
+        self.api_url = api_url
+        self.headers = headers
+        self.client = client
+        self.cache = cache or MapCache()
+        self.admission = admission
+        self.pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="map-reduce")
+        self._lock = threading.Lock()
+
+    def count(self, counts, name):
+        with self._lock:
+            counts[name] += 1
+
+    def complete(self, model, prompt, max_tokens, user):
+        payload = {"model": model, "messages": [{"role": "user", "content": prompt}], "max_tokens": max_tokens}
+        stats = TurnStats()
+        if self.admission is None:
+            return complete_chat(self.api_url, self.headers, payload, stats, session=self.client).strip()
+        ticket = self.acquire(user, model, count_tokens(prompt))
+        try:
+            reply = complete_chat(self.api_url, self.headers, payload, stats, session=self.client).strip()
+            ticket.completion_tokens = stats.tokens or 0
+        finally:
+            self.admission.release(ticket, ticket.completion_tokens)
+        return reply
+
+    def acquire(self, user, model, tokens):
+        deadline = time.monotonic() + ADMISSION_WAIT
+        while True:
+            try:
+                return self.admission.acquire(user, model, tokens, rate_limited=False)
+            except AdmissionRejected as e:
+                pause = min(e.retry_after or ADMISSION_RETRY, ADMISSION_RETRY)
+                if time.monotonic() + pause > deadline:
+                    raise
+                time.sleep(pause)
+
+    def run_step(self, model, prompt, source, max_tokens, user, counts):
+        key = digest(model, prompt)
+        cached = self.cache.get(key)
+        if cached is not None:
+            self.count(counts, "cache_hits")
+            return cached
+        self.count(counts, "calls")
+        try:
+            text = self.complete(model, prompt, max_tokens, user)
+        except AdmissionRejected:
+            self.count(counts, "rejected")
+            return truncate_tokens(source, max_tokens)
+        except Exception:
+            self.count(counts, "failed")
+            return truncate_tokens(source, max_tokens)
+        if not text:
+            return truncate_tokens(source, max_tokens)
+        self.cache.put(key, text)
+        return text
+
+    def read(self, model, name, text, context, budget=None, progress=None, user="batch"):
+        """Return notes on the whole document that fit budget tokens (default NOTES_SHARE of context).
+
+        The result is {"text", "chunks", "rounds", "calls", "cache_hits", "failed", "rejected", "tokens",
+        "seconds"}, where failed counts backend errors and rejected calls the model never admitted;
+        progress(done, total, stage) is called as map and merge calls finish.
+        """
+        started = time.perf_counter()
+        budget = budget or int(context * NOTES_SHARE)
+        note_tokens = min(NOTE_TOKENS, budget)
+        chunk_tokens = max(min(MAP_CHUNK_TOKENS, context - REPLY_RESERVE - note_tokens - PROMPT_OVERHEAD), 256)
+        words = int(note_tokens * 0.75)
+        counts = {"calls": 0, "cache_hits": 0, "failed": 0, "rejected": 0}
+
+        chunks = chunk_text(text, chunk_tokens)
+        prompts = [
+            MAP_PROMPT.format(part=i + 1, parts=len(chunks), name=name, words=words, text=chunk)
+            for i, chunk in enumerate(chunks)
+        ]
+        notes = self.run_all(model, prompts, chunks, note_tokens, user, counts, progress, "Reading")
+        # Each note remembers the range of parts it covers
+        spans = [(i + 1, i + 1) for i in range(len(chunks))]
+
+        rounds = 0
+        while len(notes) > 1 and sum(count_tokens(n) for n in notes) > budget:
+            groups = self.group(notes, chunk_tokens)
+            if len(groups) == len(notes):
+                break  # Every note already fills a request on its own
+            rounds += 1
+            sources = [self.label(spans, notes, group) for group in groups]
+            prompts = [REDUCE_PROMPT.format(name=name, words=words, text=source) for source in sources]
+            notes = self.run_all(model, prompts, sources, note_tokens, user, counts, progress, f"Merging (round {rounds})")
+            spans = [(spans[group[0]][0], spans[group[-1]][1]) for group in groups]
+
+        result_text = self.label(spans, notes, range(len(notes)), len(chunks))
+        if count_tokens(result_text) > budget:
+            result_text = truncate_tokens(result_text, budget)
+        return dict(
+            counts,
+            text=result_text,
+            chunks=len(chunks),
+            rounds=rounds,
+            tokens=count_tokens(result_text),
+            seconds=time.perf_counter() - started,
+        )
+
+    def run_all(self, model, prompts, sources, max_tokens, user, counts, progress, stage):
+        futures = [
+            self.pool.submit(self.run_step, model, prompt, source, max_tokens, user, counts)
+            for prompt, source in zip(prompts, sources)
+        ]
+        results = []
+        for done, future in enumerate(futures, 1):
+            results.append(future.result())
+            if progress is not None:
+                progress(done, len(futures), stage)
+        return results
+
+    @staticmethod
+    def group(notes, max_tokens):
+        # Consecutive notes are merged together, as many per request as fit
+        groups, current, used = [], [], 0
+        for i, note in enumerate(notes):
+            tokens = count_tokens(note)
+            if current and used + tokens > max_tokens:
+                groups.append(current)
+                current, used = [], 0
+            current.append(i)
+            used += tokens
+        if current:
+            groups.append(current)
+        return groups
+
+    @staticmethod
+    def label(spans, notes, indices, parts=None):
+        lines = []
+        for i in indices:
+            first, last = spans[i]
+            where = f"part {first}" if first == last else f"parts {first}-{last}"
+            lines.append(f"[Notes on {where}{f' of {parts}' if parts else ''}]\n{notes[i]}")
+        return "\n\n".join(lines)
+
+
+def format_notes(result):
+    text = (
+        f"Read the whole document: {result['chunks']} parts, {result['rounds']} merge rounds, "
+        f"{result['calls']} model calls, {result['cache_hits']} cached, {result['tokens']} tokens of notes, "
+        f"{result['seconds']:.1f}s"
+    )
+    if result["failed"]:
+        text += f" · {result['failed']} calls failed (raw text used)"
+    if result["rejected"]:
+        text += f" · {result['rejected']} calls not admitted, model overloaded (raw text used)"
+    return text
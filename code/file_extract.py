@@ -0,0 +1,176 @@
+import hashlib
+import io
+import json
+import os
+import multiprocessing
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+from PyPDF2 import PdfReader
+from docx import Document
+
+# Extracted text is cached on disk by the SHA-256 of the file, so a rerun or re-upload is free
+EXTRACT_CACHE_DIR = os.environ.get("EXTRACT_CACHE_DIR", os.path.expanduser("~/.cache/chatbot_extract"))
+EXTRACT_CACHE_MAX_BYTES = 512 * 1024 * 1024  # Least recently used entries are removed beyond this size
+EXTRACT_CACHE_MAX_AGE = 30 * 24 * 3600  # Seconds an entry is kept after it was last used
+EXTRACT_WORKERS = min(os.cpu_count() or 2, 8)
+PARALLEL_MIN_PAGES = 8  # Smaller PDFs are not worth starting worker processes for
+SUPPORTED_TYPES = ["txt", "md", "csv", "json", "pdf", "docx", "xlsx"]
+
+_pool = None
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        # spawn, not fork: the Streamlit server is multi-threaded
+        _pool = ProcessPoolExecutor(EXTRACT_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+def parse_page_range(spec, page_count):
+    """Turn "1-5, 8" into sorted 0-based page numbers; an empty spec selects every page."""
+    if not spec or not spec.strip():
+        return list(range(page_count))
+    pages = set()
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            start, end = part.split("-", 1)
+            start = int(start) if start.strip() else 1
+            end = int(end) if end.strip() else page_count
+        else:
+            start = end = int(part)
+        if start < 1 or end < start:
+            raise ValueError(f"Invalid page range: {part}")
+        pages.update(range(start - 1, min(end, page_count)))
+    return sorted(pages)
+
+
+def extract_pdf_pages(path, page_numbers):
+    # Runs in a worker process; each worker opens its own reader on the shared temp file
+    reader = PdfReader(path)
+    return [(n, reader.pages[n].extract_text() or "") for n in page_numbers]
+
+
+def iter_pdf_pages(data, page_numbers):
+    """Yield (page_number, text) as pages finish, in completion order."""
+    if len(page_numbers) < PARALLEL_MIN_PAGES:
+        reader = PdfReader(io.BytesIO(data))
+        for n in page_numbers:
+            yield n, reader.pages[n].extract_text() or ""
+        return
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp:
+        tmp.write(data)
+    try:
+        # Several small batches per worker keep results flowing back steadily
+        batch_size = max(1, len(page_numbers) // (EXTRACT_WORKERS * 4))
+        batches = [page_numbers[i:i + batch_size] for i in range(0, len(page_numbers), batch_size)]
+        futures = [get_pool().submit(extract_pdf_pages, tmp.name, batch) for batch in batches]
+        for future in as_completed(futures):
+            yield from future.result()
+    finally:
+        os.unlink(tmp.name)
+
+
+def extract_pdf(data, page_range=None, progress=None):
+    page_count = len(PdfReader(io.BytesIO(data)).pages)
+    page_numbers = parse_page_range(page_range, page_count)
+    pages = {}
+    for n, text in iter_pdf_pages(data, page_numbers):
+        pages[n] = text
+        if progress:
+            progress(len(pages), len(page_numbers))
+    # Collect first and join once, instead of growing one string page by page
+    return "\n\n".join(pages[n] for n in page_numbers)
+
+
+def cache_path(digest, page_range):
+    key = digest
+    if page_range and page_range.strip():
+        key += "_" + hashlib.sha256(page_range.replace(" ", "").encode("utf-8")).hexdigest()[:12]
+    return os.path.join(EXTRACT_CACHE_DIR, f"{key}.txt")
+
+
+def read_cache(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read()
+        os.utime(path)  # The modification time records the last use, for pruning
+        return text
+    except OSError:
+        return None
+
+
+def write_cache(path, text):
+    try:
+        os.makedirs(EXTRACT_CACHE_DIR, exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=EXTRACT_CACHE_DIR, delete=False) as tmp:
+            tmp.write(text)
+        os.replace(tmp.name, path)
+        prune_cache()
+    except OSError:
+        pass  # A read-only or full disk only costs us the cache
+
+
+def prune_cache(max_bytes=EXTRACT_CACHE_MAX_BYTES, max_age=EXTRACT_CACHE_MAX_AGE):
+    # Remove entries unused for max_age, then the least recently used until the rest fits max_bytes
+    entries = []
+    with os.scandir(EXTRACT_CACHE_DIR) as it:
+        for entry in it:
+            if entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    entries.sort(reverse=True)
+    now = time.time()
+    total = 0
+    for mtime, size, path in entries:
+        if now - mtime <= max_age and total + size <= max_bytes:
+            total += size
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def extract_bytes(name, data, page_range=None, progress=None):
+    """Extract text from file data by extension; page_range only applies to PDFs."""
+    file_extension = name.split(".")[-1].lower()
+    if file_extension != "pdf":
+        page_range = None
+    path = cache_path(hashlib.sha256(data).hexdigest(), page_range)
+    cached = read_cache(path)
+    if cached is not None:
+        return cached
+    try:
+        if file_extension in ["txt", "md"]:
+            text = data.decode("utf-8")
+        elif file_extension == "csv":
+            text = pd.read_csv(io.BytesIO(data)).to_string(index=False)
+        elif file_extension == "json":
+            text = json.dumps(json.loads(data))
+        elif file_extension == "pdf":
+            text = extract_pdf(data, page_range, progress)
+        # DOCX and XLSX stay in this process: a DOCX body is one XML part parsed in a single pass,
+        # and only the first sheet of a workbook is read, so neither has pages to spread over the pool
+        elif file_extension == "docx":
+            doc = Document(io.BytesIO(data))
+            text = "\n".join(para.text for para in doc.paragraphs) + "\n"
+        elif file_extension == "xlsx":
+            text = pd.read_excel(io.BytesIO(data)).to_string(index=False)
+        else:
+            return "Unsupported file format."
+    except Exception as e:
+        return f"Error reading file: {str(e)}"
+    write_cache(path, text)
+    return text
+
+
+def extract_file_content(file, page_range=None, progress=None):
+    # Accepts a Streamlit UploadedFile or any object with .name and .getvalue()
+    return extract_bytes(file.name, file.getvalue(), page_range, progress)
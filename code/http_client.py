@@ -0,0 +1,153 @@
+import asyncio
+import random
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import httpx
+except ImportError:  # Only needed by AsyncBackendClient
+    httpx = None
+
+CONNECT_TIMEOUT = 5  # Seconds to establish a TCP/TLS connection
+READ_TIMEOUT = 300  # Seconds between bytes; long prefills can be slow to send the first token
+POOL_SIZE = 16  # Keep-alive connections kept per host
+RETRIES = 3
+BACKOFF = 0.5  # Base delay in seconds, doubled per attempt, plus up to the same amount of jitter
+RETRY_STATUSES = (429, 502, 503, 504)
+
+
+def make_retry(retries, backoff):
+    # Connection failures are retried for every method since nothing reached the server;
+    # error statuses only for idempotent methods so a generation is never started twice
+    options = dict(
+        total=retries,
+        connect=retries,
+        read=0,
+        status=retries,
+        backoff_factor=backoff,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=frozenset({"GET", "HEAD", "OPTIONS"}),
+        raise_on_status=False,
+    )
+    try:
+        return Retry(backoff_jitter=backoff, **options)
+    except TypeError:  # urllib3 < 2 has no jitter option
+        return Retry(**options)
+
+
+class BackendClient:
+    """Pooled keep-alive session for the chat backend, meant to be shared through st.cache_resource."""
+
+    def __init__(self, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                 pool_size=POOL_SIZE, retries=RETRIES, backoff=BACKOFF):
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=make_retry(retries, backoff))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.adapter = adapter
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def stats(self):
+        # urllib3 counts requests and newly opened connections per host pool
+        requests_made = new_connections = 0
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            requests_made += pool.num_requests
+            new_connections += pool.num_connections
+        return {
+            "requests": requests_made,
+            "hits": max(requests_made - new_connections, 0),
+            "misses": new_connections,
+        }
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncBackendClient:
+    """asyncio counterpart of BackendClient built on httpx."""
+
+    def __init__(self, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                 pool_size=POOL_SIZE, retries=RETRIES, backoff=BACKOFF):
+        if httpx is None:
+            raise RuntimeError("AsyncBackendClient requires httpx (pip install httpx)")
+        self.retries = retries
+        self.backoff = backoff
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        )
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._new_connections = 0
+
+    async def _trace(self, event_name, info):
+        # httpcore reports every newly opened TCP connection through the trace extension
+        if event_name == "connection.connect_tcp.complete":
+            with self._lock:
+                self._new_connections += 1
+
+    def _delay(self, attempt):
+        return self.backoff * (2 ** attempt) + random.uniform(0, self.backoff)
+
+    async def request(self, method, url, **kwargs):
+        extensions = dict(kwargs.pop("extensions", {}), trace=self._trace)
+        idempotent = method.upper() in ("GET", "HEAD", "OPTIONS")
+        for attempt in range(self.retries + 1):
+            with self._lock:
+                self._requests += 1
+            try:
+                response = await self.client.request(method, url, extensions=extensions, **kwargs)
+            except httpx.ConnectError:
+                if attempt == self.retries:
+                    raise
+            else:
+                if not (idempotent and response.status_code in RETRY_STATUSES) or attempt == self.retries:
+                    return response
+                await response.aclose()
+            await asyncio.sleep(self._delay(attempt))
+
+    async def get(self, url, **kwargs):
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request("POST", url, **kwargs)
+
+    def stream(self, method, url, **kwargs):
+        # Streaming responses are not retried: the caller may already have consumed tokens
+        extensions = dict(kwargs.pop("extensions", {}), trace=self._trace)
+        with self._lock:
+            self._requests += 1
+        return self.client.stream(method, url, extensions=extensions, **kwargs)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "requests": self._requests,
+                "hits": max(self._requests - self._new_connections, 0),
+                "misses": self._new_connections,
+            }
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+def format_pool_stats(stats):
+    return f"Connection pool: {stats['hits']} reused, {stats['misses']} new, {stats['requests']} requests"
@@ -1,20 +1,74 @@
+import asyncio
+import base64
 import json
 import uuid
-import websocket
 import logging
 import os
-import copy
-import requests
+import re
+import time
+from contextlib import asynccontextmanager
+
+import httpx
+import websockets
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import Dict, List, Optional
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("comfyui-api")
+# httpx logs every upstream request at INFO, several per job
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+# Configuration
+server_address = "127.0.0.1:8188"
+workflow_dir = "."  # Folder of named workflows in ComfyUI API format
+workflow_prefix = "workflow"  # Only workflow*.json files there are workflows, so other JSON files are not listed
+default_workflow = "workflow01"
+ollama_address = "http://localhost:11434"
+generation_timeout = 600  # Seconds to wait for ComfyUI to finish one workflow
+
+reconnect_max_delay = 30  # Longest wait between attempts to reconnect the ComfyUI WebSocket
+max_backend_connections = 20  # Pooled connections to each of ComfyUI and Ollama
+job_ttl = 3600  # Seconds a finished job and its images are kept for GET /jobs/{job_id}
+queue_poll_seconds = 2  # Queue positions are refreshed at least this often while jobs wait in ComfyUI
+sse_keepalive = 15  # Seconds between keep-alive comments on an idle event stream
+capabilities_ttl = 300  # Seconds cached checkpoints, node schemas and Ollama models are trusted
+capabilities_refresh = 60  # Seconds between background refreshes of the cached capabilities
+
+# One pooled async HTTP client for ComfyUI and Ollama, so a slow generation never blocks other requests
+http_client: Optional[httpx.AsyncClient] = None
+# One WebSocket to ComfyUI shared by all jobs
+comfy_events: Optional["ComfyEvents"] = None
+# Image jobs started with POST /jobs/...
+jobs: Optional["JobStore"] = None
+# Checkpoints, node schemas and Ollama models, so requests are validated without calling the backends
+capabilities: Optional["Capabilities"] = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global http_client, comfy_events, jobs, capabilities
+    http_client = httpx.AsyncClient(
+        timeout=httpx.Timeout(30, connect=5),
+        transport=BoundedTransport(max_backend_connections),
+    )
+    comfy_events = ComfyEvents(server_address)
+    comfy_events.start()
+    jobs = JobStore()
+    jobs.start()
+    capabilities = Capabilities()
+    capabilities.start()
+    try:
+        yield
+    finally:
+        await capabilities.stop()
+        await jobs.stop()
+        await comfy_events.stop()
+        await http_client.aclose()
 
-app = FastAPI(title="ComfyUI API Proxy")
+app = FastAPI(title="ComfyUI API Proxy", lifespan=lifespan)
 
 # Enable CORS
 app.add_middleware(
@@ -25,45 +79,561 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Configuration
-server_address = "127.0.0.1:8188"
-workflow_path = "workflow01.json"
-ollama_address = "http://localhost:11434"
+class WorkflowTemplate:
+    """A workflow compiled once: the graph plus the ids of the nodes each request patches.
 
-# Load workflow
-def load_workflow():
-    try:
-        with open(workflow_path, "r") as f:
-            return json.load(f)
-    except Exception as e:
-        logger.error(f"Failed to load workflow: {str(e)}")
-        raise HTTPException(status_code=500, detail="Failed to load workflow")
+    build() returns a request's graph as a shallow copy of the template in
+    which only the sampler, the two prompt nodes and the checkpoint loader
+    are copied and changed; every other node is shared with the template.
+    """
+
+    def __init__(self, name: str, path: str):
+        self.name = name
+        self.path = path
+        self.mtime = os.stat(path).st_mtime
+        with open(path, "r") as f:
+            self.graph = json.load(f)
+        sampler_ids = [key for key, node in self.graph.items() if node.get("class_type") in ("KSampler", "KSamplerAdvanced")]
+        loader_ids = [key for key, node in self.graph.items() if node.get("class_type") == "CheckpointLoaderSimple"]
+        if not sampler_ids or not loader_ids:
+            raise ValueError("workflow needs a KSampler and a CheckpointLoaderSimple node")
+        self.sampler_id = sampler_ids[0]
+        sampler_inputs = self.graph[self.sampler_id]["inputs"]
+        self.seed_input = "noise_seed" if "noise_seed" in sampler_inputs else "seed"
+        self.positive_id = sampler_inputs["positive"][0]
+        self.negative_id = sampler_inputs["negative"][0]
+        self.checkpoint_id = loader_ids[0]
+
+    def build(self, positive: str, negative: Optional[str], ckpt_name: str, seed: int) -> Dict:
+        graph = dict(self.graph)
+        patches = [
+            (self.sampler_id, self.seed_input, seed),
+            (self.positive_id, "text", positive),
+            (self.checkpoint_id, "ckpt_name", ckpt_name),
+        ]
+        if negative:
+            patches.append((self.negative_id, "text", negative))
+        for node_id, name, value in patches:
+            node = graph[node_id] = dict(graph[node_id])
+            node["inputs"] = dict(node["inputs"], **{name: value})
+        return graph
 
-workflow = load_workflow()
+class WorkflowStore:
+    """Named workflow templates from workflow_dir, compiled on first use and again when their file changes.
+
+    A workflow's name is its file name without .json and must start with
+    workflow_prefix, e.g. workflow01 or workflow_portrait.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.templates: Dict[str, WorkflowTemplate] = {}
+        self.failed: Dict[str, float] = {}  # name -> mtime of a file that did not compile
+
+    def names(self) -> List[str]:
+        return sorted(
+            name[:-5] for name in os.listdir(self.directory)
+            if name.startswith(workflow_prefix) and name.endswith(".json")
+        )
+
+    def get(self, name: str) -> WorkflowTemplate:
+        if not re.fullmatch(r"[\w.-]+", name) or name.startswith("."):
+            raise HTTPException(status_code=400, detail=f"Invalid workflow name: {name}")
+        if not name.startswith(workflow_prefix):
+            raise HTTPException(status_code=404, detail=f"Unknown workflow: {name}")
+        path = os.path.join(self.directory, f"{name}.json")
+        template = self.templates.get(name)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            raise HTTPException(status_code=404, detail=f"Unknown workflow: {name}")
+        if template is not None and mtime in (template.mtime, self.failed.get(name)):
+            return template
+        try:
+            template = WorkflowTemplate(name, path)
+        except Exception as e:
+            logger.error(f"Failed to load workflow {name}: {str(e)}")
+            self.failed[name] = mtime
+            if name in self.templates:
+                return self.templates[name]  # Keep serving the last good version
+            raise HTTPException(status_code=500, detail=f"Failed to load workflow {name}: {str(e)}")
+        logger.info(f"Loaded workflow {name}")
+        self.templates[name] = template
+        return template
+
+# Load workflows; the default one must be valid at startup
+workflows = WorkflowStore(workflow_dir)
+workflows.get(default_workflow)
 
 class WorkflowRequest(BaseModel):
     positive_prompt: str
     negative_prompt: str = ""
     ckpt_name: str = "RealVisXL_V5.0_Lightning_fp32.safetensors"
+    workflow: str = default_workflow
     use_ollama: bool = False
     ollama_model: Optional[str] = None
 
-def open_websocket_connection():
-    client_id = str(uuid.uuid4())
-    ws = websocket.WebSocket()
+class SlotStream(httpx.AsyncByteStream):
+    def __init__(self, stream, release):
+        self.stream = stream
+        self.release = release
+
+    async def __aiter__(self):
+        async for chunk in self.stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self.stream.aclose()
+        finally:
+            self.release()
+
+class BoundedTransport(httpx.AsyncHTTPTransport):
+    """Connection pool whose waiting requests queue on a semaphore per backend.
+
+    httpcore rescans its whole request queue against every connection each
+    time a connection frees up, which grows quadratically once hundreds of
+    jobs wait for the pool. Here a request only enters the pool when its
+    backend has a free connection, and holds it until the response is closed,
+    so slow Ollama calls never hold up ComfyUI requests either.
+    """
+
+    def __init__(self, max_connections: int):
+        super().__init__(limits=httpx.Limits(max_connections=None, max_keepalive_connections=None))
+        self.max_connections = max_connections
+        self.slots: Dict[str, asyncio.Semaphore] = {}
+
+    async def handle_async_request(self, request):
+        slots = self.slots.setdefault(request.url.netloc.decode(), asyncio.Semaphore(self.max_connections))
+        await slots.acquire()
+        try:
+            response = await super().handle_async_request(request)
+        except BaseException:
+            slots.release()
+            raise
+        released = False
+
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                slots.release()
+
+        response.stream = SlotStream(response.stream, release)
+        return response
+
+class ComfyEvents:
+    """Long-lived, auto-reconnecting WebSocket to ComfyUI shared by all jobs.
+
+    All prompts are queued under this connection's client id. One reader task
+    routes progress, executing and executed events to the queue of the prompt
+    they belong to; binary preview frames go to the prompt that is executing.
+    After a reconnect, prompts that finished meanwhile are found in /history.
+    """
+
+    def __init__(self, address: str):
+        self.address = address
+        self.client_id = str(uuid.uuid4())
+        self.watchers: Dict[str, asyncio.Queue] = {}
+        self.executing: Optional[str] = None
+        self.connected = asyncio.Event()
+        self.queue_changed = asyncio.Event()
+        self.connections = 0
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    def watch(self, prompt_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue()
+        self.watchers[prompt_id] = queue
+        return queue
+
+    def unwatch(self, prompt_id: str):
+        self.watchers.pop(prompt_id, None)
+
+    async def run(self):
+        delay = 1
+        while True:
+            try:
+                # Previews arrive as large binary frames, so the frame size is not limited
+                async with websockets.connect(f"ws://{self.address}/ws?clientId={self.client_id}", max_size=None) as ws:
+                    self.connections += 1
+                    self.connected.set()
+                    delay = 1
+                    logger.info("ComfyUI WebSocket connected")
+                    await self.check_history()
+                    async for message in ws:
+                        self.dispatch(message)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"ComfyUI WebSocket error: {str(e)}")
+            self.connected.clear()
+            self.executing = None
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, reconnect_max_delay)
+
+    def dispatch(self, message):
+        if isinstance(message, bytes):
+            # Binary preview image: 4 bytes event type, 4 bytes image format (1 JPEG, 2 PNG), then the image
+            queue = self.watchers.get(self.executing)
+            if queue is not None:
+                image_format = "image/png" if int.from_bytes(message[4:8], "big") == 2 else "image/jpeg"
+                queue.put_nowait({"type": "preview", "data": {"prompt_id": self.executing, "image": message[8:], "format": image_format}})
+            return
+        try:
+            event = json.loads(message)
+        except ValueError:
+            return
+        data = event.get("data") or {}
+        prompt_id = data.get("prompt_id")
+        if event.get("type") == "status":
+            # The queue grew or shrank; waiting jobs refresh their positions
+            self.queue_changed.set()
+        if event.get("type") == "executing":
+            self.executing = prompt_id if data.get("node") is not None else None
+        queue = self.watchers.get(prompt_id)
+        if queue is not None:
+            queue.put_nowait(event)
+
+    async def check_history(self):
+        # Events sent while the socket was down are lost; ask ComfyUI which watched prompts are done
+        for prompt_id, queue in list(self.watchers.items()):
+            try:
+                response = await http_client.get(f"http://{self.address}/history/{prompt_id}")
+                if response.is_success and prompt_id in response.json():
+                    queue.put_nowait({"type": "execution_success", "data": {"prompt_id": prompt_id}})
+            except Exception as e:
+                logger.warning(f"Failed to check history of {prompt_id}: {str(e)}")
+
+class Job:
+    """One image generation, followed by clients through GET /jobs/{job_id} and its event stream."""
+
+    def __init__(self, kind: str):
+        self.id = str(uuid.uuid4())
+        self.kind = kind
+        self.status = "pending"  # pending, queued, running, done or failed
+        self.stage = "Starting"
+        self.prompt_id: Optional[str] = None
+        self.queue_position: Optional[int] = None
+        self.step: Optional[int] = None
+        self.steps: Optional[int] = None
+        self.preview: Optional[Dict] = None
+        self.result: Optional[Dict] = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.listeners: List[asyncio.Queue] = []
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed")
+
+    def state(self) -> Dict:
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "stage": self.stage,
+            "queue_position": self.queue_position,
+            "step": self.step,
+            "steps": self.steps,
+            "error": self.error,
+        }
+
+    def listen(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=100)
+        self.listeners.append(queue)
+        return queue
+
+    def unlisten(self, queue: asyncio.Queue):
+        if queue in self.listeners:
+            self.listeners.remove(queue)
+
+    def publish(self, event: str, data: Dict):
+        for queue in self.listeners:
+            try:
+                queue.put_nowait((event, data))
+            except asyncio.QueueFull:
+                pass  # A stalled client misses updates; it gets the current state when it reconnects
+
+    def update(self, status: Optional[str] = None, stage: Optional[str] = None):
+        self.status = status or self.status
+        self.stage = stage or self.stage
+        self.publish("status", self.state())
+
+    def comfy_event(self, message: Dict):
+        kind = message.get("type")
+        data = message.get("data") or {}
+        if kind in ("execution_start", "executing") and self.status == "queued":
+            self.queue_position = 0
+            self.update("running", "Generating image")
+        elif kind == "progress":
+            self.step, self.steps = data.get("value"), data.get("max")
+            self.publish("progress", {"step": self.step, "steps": self.steps})
+        elif kind == "preview":
+            self.preview = {"format": data["format"], "data": base64.b64encode(data["image"]).decode("utf-8")}
+            self.publish("preview", self.preview)
+
+    def queued_at(self, position: int):
+        if position != self.queue_position:
+            self.queue_position = position
+            self.publish("queue", {"queue_position": position})
+
+class JobStore:
+    """Image jobs run in the background, kept in memory until job_ttl after they finish.
+
+    POST /jobs/... returns a job id at once; the client reads the job's state
+    and, when it is done, its images with GET /jobs/{job_id}, or follows it
+    with the event stream, which starts with the current state so a client
+    can reconnect at any time. Queue positions come from ComfyUI's /queue,
+    read again whenever ComfyUI reports a change in its queue.
+    """
+
+    def __init__(self):
+        self.jobs: Dict[str, Job] = {}
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.track_queue())
+
+    async def stop(self):
+        for job in self.jobs.values():
+            if job.task is not None:
+                job.task.cancel()
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    def create(self, kind: str, work) -> Job:
+        """Start work(job), a coroutine function returning the job's result, in the background."""
+        self.prune()
+        job = Job(kind)
+        self.jobs[job.id] = job
+        job.task = asyncio.create_task(self.execute(job, work))
+        return job
+
+    async def run(self, kind: str, work) -> Job:
+        """Run work like create() for a request that waits for it, and return the finished job.
+
+        The job id is never given out, so the job is dropped once it finishes
+        instead of keeping its images for job_ttl.
+        """
+        job = self.create(kind, work)
+        try:
+            await asyncio.shield(job.task)
+        finally:
+            # A disconnected client leaves the work running, but nobody can fetch its result
+            self.jobs.pop(job.id, None)
+        return job
+
+    async def execute(self, job: Job, work):
+        try:
+            job.result = await work(job)
+            job.update("done", "Done")
+        except HTTPException as e:
+            job.error = str(e.detail)
+            job.update("failed", "Failed")
+        except Exception as e:
+            logger.error(f"Job {job.id} failed: {str(e)}")
+            job.error = str(e)
+            job.update("failed", "Failed")
+        finally:
+            job.finished_at = time.time()
+
+    def get(self, job_id: str) -> Job:
+        job = self.jobs.get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="Job not found or expired")
+        return job
+
+    def prune(self):
+        now = time.time()
+        for job_id, job in list(self.jobs.items()):
+            if job.finished_at is not None and now - job.finished_at > job_ttl:
+                del self.jobs[job_id]
+
+    async def track_queue(self):
+        while True:
+            try:
+                await asyncio.wait_for(comfy_events.queue_changed.wait(), queue_poll_seconds)
+            except asyncio.TimeoutError:
+                pass
+            comfy_events.queue_changed.clear()
+            waiting = {job.prompt_id: job for job in self.jobs.values() if job.status == "queued" and job.prompt_id}
+            if not waiting:
+                continue
+            try:
+                response = await http_client.get(f"http://{server_address}/queue", timeout=5)
+                response.raise_for_status()
+                queue = response.json()
+            except Exception as e:
+                logger.warning(f"Failed to read the ComfyUI queue: {str(e)}")
+                continue
+            # Entries are [number, prompt_id, ...]; the position is the count of prompts ahead
+            running = queue.get("queue_running", [])
+            pending = sorted(queue.get("queue_pending", []), key=lambda item: item[0])
+            for position, item in enumerate(pending, start=len(running)):
+                job = waiting.get(item[1])
+                if job is not None:
+                    job.queued_at(position)
+
+class Capabilities:
+    """ComfyUI node schemas and Ollama's model list, cached for capabilities_ttl.
+
+    A background task refreshes them every capabilities_refresh seconds, so
+    requests validate checkpoints and models without calling the backends.
+    A name missing from the cached list triggers one refresh before it is
+    refused, so a checkpoint or model added since is found at once. When a
+    backend cannot be reached, the last list is used until it expires.
+    """
+
+    def __init__(self):
+        self.values: Dict[str, Dict] = {}  # "object_info/<class_type>" or "ollama_models" -> response
+        self.fetched_at: Dict[str, float] = {}
+        self.pending: Dict[str, asyncio.Task] = {}
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        for task in [self.task, *self.pending.values()]:
+            if task is not None:
+                task.cancel()
+        if self.task is not None:
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    def fresh(self, key: str) -> bool:
+        return key in self.values and time.time() - self.fetched_at[key] < capabilities_ttl
+
+    async def get(self, key: str) -> Dict:
+        if self.fresh(key):
+            return self.values[key]
+        return await self.refresh(key)
+
+    async def refresh(self, key: str) -> Dict:
+        """Fetch key from its backend again; concurrent callers share one request."""
+        task = self.pending.get(key)
+        if task is None:
+            task = asyncio.create_task(self.fetch(key))
+            self.pending[key] = task
+            task.add_done_callback(lambda _: self.pending.pop(key, None))
+        # Shielded so a cancelled request does not cancel the fetch other callers wait for
+        return await asyncio.shield(task)
+
+    async def fetch(self, key: str) -> Dict:
+        try:
+            if key == "ollama_models":
+                response = await http_client.get(f"{ollama_address}/api/tags", timeout=5)
+            else:
+                response = await http_client.get(f"http://{server_address}/{key}", timeout=5)
+            response.raise_for_status()
+            value = response.json()
+        except Exception as e:
+            if not self.fresh(key):
+                raise
+            logger.warning(f"Failed to refresh {key}, using the cached copy: {str(e)}")
+            return self.values[key]
+        self.values[key] = value
+        self.fetched_at[key] = time.time()
+        return value
+
+    async def run(self):
+        keys = {"object_info/CheckpointLoaderSimple", "ollama_models"}
+        while True:
+            keys.update(self.values)
+            results = await asyncio.gather(*(self.refresh(key) for key in keys), return_exceptions=True)
+            for key, result in zip(keys, results):
+                if isinstance(result, Exception):
+                    logger.warning(f"Failed to refresh {key}: {str(result)}")
+            await asyncio.sleep(capabilities_refresh)
+
+    async def names(self, key: str, extract, require: Optional[str] = None) -> List[str]:
+        names = extract(await self.get(key))
+        if require is not None and require not in names:
+            # Unknown name: look again in case it was added since the last refresh
+            names = extract(await self.refresh(key))
+        return names
+
+    async def node_info(self, class_type: str) -> Dict:
+        """Input schema of a ComfyUI node type, from /object_info/<class_type>."""
+        return (await self.get(f"object_info/{class_type}")).get(class_type, {})
+
+    async def checkpoints(self, require: Optional[str] = None) -> List[str]:
+        return await self.names(
+            "object_info/CheckpointLoaderSimple",
+            lambda data: data.get("CheckpointLoaderSimple", {}).get("input", {}).get("required", {}).get("ckpt_name", [[]])[0],
+            require,
+        )
+
+    async def ollama_models(self, require: Optional[str] = None) -> List[str]:
+        return await self.names(
+            "ollama_models",
+            lambda data: [model["name"] for model in data.get("models", [])],
+            require,
+        )
+
+async def job_events(job: Job):
+    """Server-sent events for a job: its current state first, then status, queue, progress and preview updates."""
+    queue = job.listen()
     try:
-        ws.connect(f"ws://{server_address}/ws?clientId={client_id}")
-        logger.info("WebSocket connected successfully")
-        return ws, client_id
-    except Exception as e:
-        logger.error(f"WebSocket connection error: {str(e)}")
-        raise HTTPException(status_code=503, detail=f"ComfyUI server connection error: {str(e)}")
+        yield sse_message("status", job.state())
+        if job.preview is not None and not job.finished:
+            yield sse_message("preview", job.preview)
+        while not job.finished:
+            try:
+                event, data = await asyncio.wait_for(queue.get(), sse_keepalive)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+            yield sse_message(event, data)
+        # The final status may still be waiting in the queue
+        while not queue.empty():
+            event, data = queue.get_nowait()
+            yield sse_message(event, data)
+    finally:
+        job.unlisten(queue)
+
+def sse_message(event: str, data: Dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def event_stream(job: Job) -> StreamingResponse:
+    # X-Accel-Buffering stops nginx from holding events back
+    return StreamingResponse(
+        job_events(job),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+def job_response(job: Job) -> Dict:
+    return dict(job.state(), result=job.result if job.status == "done" else None)
 
-def queue_prompt(prompt: Dict, client_id: str) -> Dict:
+async def queue_prompt(prompt: Dict, prompt_id: str) -> Dict:
     try:
-        response = requests.post(
+        await asyncio.wait_for(comfy_events.connected.wait(), 5)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=503, detail=f"ComfyUI server connection error: WebSocket to {server_address} is down")
+    try:
+        response = await http_client.post(
             f"http://{server_address}/prompt",
-            json={"prompt": prompt, "client_id": client_id}
+            json={"prompt": prompt, "client_id": comfy_events.client_id, "prompt_id": prompt_id}
         )
         response.raise_for_status()
         return response.json()
@@ -71,57 +641,89 @@ def queue_prompt(prompt: Dict, client_id: str) -> Dict:
         logger.error(f"Failed to queue prompt: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to queue prompt: {str(e)}")
 
-def track_progress(ws: websocket.WebSocket, prompt_id: str):
+async def track_progress(events: asyncio.Queue, prompt_id: str, job: Job):
     while True:
-        try:
-            message = json.loads(ws.recv())
-            if message.get("type") == "executed" and message.get("data", {}).get("prompt_id") == prompt_id:
-                break
-        except Exception as e:
-            logger.error(f"WebSocket error during progress tracking: {str(e)}")
-            raise HTTPException(status_code=500, detail="Error tracking progress")
+        message = await events.get()
+        job.comfy_event(message)
+        kind = message.get("type")
+        if kind in ("execution_error", "execution_interrupted"):
+            logger.error(f"ComfyUI failed prompt {prompt_id}: {message.get('data')}")
+            raise HTTPException(status_code=500, detail=f"ComfyUI {kind.replace('_', ' ')}")
+        # ComfyUI reports the end of a prompt as executing with no node
+        if kind == "execution_success" or (kind == "executing" and message["data"].get("node") is None):
+            break
+
+async def wait_for_prompt(events: asyncio.Queue, prompt_id: str, job: Job):
+    try:
+        await asyncio.wait_for(track_progress(events, prompt_id, job), generation_timeout)
+    except asyncio.TimeoutError:
+        logger.error(f"Prompt {prompt_id} did not finish within {generation_timeout}s")
+        raise HTTPException(status_code=504, detail="Image generation timed out")
+
+async def run_prompt(prompt: Dict, job: Job) -> List[Dict]:
+    # The prompt id is chosen here so the job is watched before ComfyUI can report on it
+    prompt_id = str(uuid.uuid4())
+    events = comfy_events.watch(prompt_id)
+    try:
+        queued_id = (await queue_prompt(prompt, prompt_id))["prompt_id"]
+        if queued_id != prompt_id:
+            # ComfyUI versions that ignore the requested id
+            comfy_events.unwatch(prompt_id)
+            prompt_id = queued_id
+            events = comfy_events.watch(prompt_id)
+        job.prompt_id = prompt_id
+        if job.status == "pending":
+            job.update("queued", "Waiting in the ComfyUI queue")
+            comfy_events.queue_changed.set()
+        await wait_for_prompt(events, prompt_id, job)
+        job.update(stage="Fetching images")
+        return await get_images(prompt_id)
+    finally:
+        comfy_events.unwatch(prompt_id)
+
+async def fetch_image(node_id: str, unit: Dict) -> Dict:
+    image_response = await http_client.get(
+        f"http://{server_address}/view", params={"filename": unit["filename"], "type": "output"}
+    )
+    image_response.raise_for_status()
+    return {
+        "node_id": node_id,
+        "data": base64.b64encode(image_response.content).decode("utf-8"),
+        "format": "image/png"
+    }
 
-def get_images(prompt_id: str) -> List[Dict]:
+async def get_images(prompt_id: str) -> List[Dict]:
     try:
-        response = requests.get(f"http://{server_address}/history/{prompt_id}")
+        response = await http_client.get(f"http://{server_address}/history/{prompt_id}")
         response.raise_for_status()
         history = response.json()
         outputs = history.get(prompt_id, {}).get("outputs", {})
-        result = []
-        for node_id, output in outputs.items():
-            for unit in output.get("images", []):
-                image_response = requests.get(f"http://{server_address}/view?filename={unit['filename']}&type=output")
-                image_response.raise_for_status()
-                import base64
-                result.append({
-                    "node_id": node_id,
-                    "data": base64.b64encode(image_response.content).decode("utf-8"),
-                    "format": "image/png"
-                })
-        return result
+        # All images of the prompt are downloaded at the same time
+        return await asyncio.gather(*(
+            fetch_image(node_id, unit)
+            for node_id, output in outputs.items()
+            for unit in output.get("images", [])
+        ))
     except Exception as e:
         logger.error(f"Failed to retrieve images: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to retrieve images: {str(e)}")
 
-def get_ollama_models() -> List[str]:
+async def get_ollama_models(require: Optional[str] = None) -> List[str]:
     try:
-        response = requests.get(f"{ollama_address}/api/tags", timeout=5)
-        response.raise_for_status()
-        data = response.json()
-        models = [model["name"] for model in data.get("models", [])]
+        models = await capabilities.ollama_models(require)
         if not models:
             logger.warning("No Ollama models found")
         return models
-    except requests.exceptions.ConnectionError:
+    except httpx.ConnectError:
         logger.error(f"Ollama server not reachable at {ollama_address}")
         return []
     except Exception as e:
         logger.error(f"Failed to fetch Ollama models: {str(e)}")
         return []
 
-def enhance_prompt_with_ollama(prompt: str, model: str) -> str:
+async def enhance_prompt_with_ollama(prompt: str, model: str) -> str:
     try:
-        response = requests.post(
+        response = await http_client.post(
             f"{ollama_address}/api/generate",
             json={
                 "model": model,
@@ -133,19 +735,19 @@ def enhance_prompt_with_ollama(prompt: str, model: str) -> str:
         response.raise_for_status()
         result = response.json()
         return result.get("response", prompt)
-    except requests.exceptions.ConnectionError:
+    except httpx.ConnectError:
         logger.warning(f"Ollama server not reachable at {ollama_address}")
         return prompt
-    except requests.exceptions.HTTPError as e:
+    except httpx.HTTPStatusError as e:
         logger.warning(f"Ollama HTTP error: {str(e)}")
         return prompt
     except Exception as e:
         logger.warning(f"Failed to enhance prompt with Ollama: {str(e)}")
         return prompt
 
-def generate_follow_up_with_ollama(prompt: str, images: List[Dict], model: str) -> str:
+async def generate_follow_up_with_ollama(prompt: str, images: List[Dict], model: str) -> str:
     try:
-        response = requests.post(
+        response = await http_client.post(
             f"{ollama_address}/api/generate",
             json={
                 "model": model,
@@ -157,40 +759,42 @@ def generate_follow_up_with_ollama(prompt: str, images: List[Dict], model: str)
         response.raise_for_status()
         result = response.json()
         return result.get("response", "No follow-up description available.")
-    except requests.exceptions.ConnectionError:
+    except httpx.ConnectError:
         logger.warning(f"Ollama server not reachable at {ollama_address}")
         return "Ollama server not reachable."
-    except requests.exceptions.HTTPError as e:
+    except httpx.HTTPStatusError as e:
         logger.warning(f"Ollama HTTP error: {str(e)}")
         return f"Ollama error: {str(e)}"
     except Exception as e:
         logger.warning(f"Failed to generate follow-up with Ollama: {str(e)}")
         return "No follow-up description available due to an error."
 
+@app.get("/workflows")
+async def get_workflows():
+    return {"workflows": workflows.names(), "default": default_workflow}
+
 @app.get("/checkpoints")
 async def get_checkpoints():
     try:
-        response = requests.get(f"http://{server_address}/object_info/CheckpointLoaderSimple", timeout=5)
-        if not response.ok:
-            logger.error(f"ComfyUI returned HTTP {response.status_code}: {response.text}")
-            raise HTTPException(status_code=503, detail=f"ComfyUI server error: HTTP {response.status_code}")
-        data = response.json()
-        checkpoints = data.get("CheckpointLoaderSimple", {}).get("input", {}).get("required", {}).get("ckpt_name", [])[0]
-        if not checkpoints:
-            logger.warning("No checkpoints found in ComfyUI response")
-            raise HTTPException(status_code=404, detail="No checkpoints available")
-        return {"checkpoints": checkpoints}
-    except requests.exceptions.ConnectionError:
+        checkpoints = await capabilities.checkpoints()
+    except httpx.ConnectError:
         logger.error(f"ComfyUI server not reachable at {server_address}")
         raise HTTPException(status_code=503, detail=f"ComfyUI server not reachable at {server_address}")
+    except httpx.HTTPStatusError as e:
+        logger.error(f"ComfyUI returned HTTP {e.response.status_code}: {e.response.text}")
+        raise HTTPException(status_code=503, detail=f"ComfyUI server error: HTTP {e.response.status_code}")
     except Exception as e:
         logger.error(f"Failed to fetch checkpoints: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to fetch checkpoints: {str(e)}")
+    if not checkpoints:
+        logger.warning("No checkpoints found in ComfyUI response")
+        raise HTTPException(status_code=404, detail="No checkpoints available")
+    return {"checkpoints": checkpoints}
 
 @app.get("/ollama_health")
 async def ollama_health():
     try:
-        response = requests.get(f"{ollama_address}/api/tags", timeout=5)
+        response = await http_client.get(f"{ollama_address}/api/tags", timeout=5)
         response.raise_for_status()
         return {"status": "Ollama server is running", "models": response.json().get("models", [])}
     except Exception as e:
@@ -199,79 +803,79 @@ async def ollama_health():
 
 @app.get("/ollama_models")
 async def get_ollama_models_endpoint():
-    models = get_ollama_models()
+    models = await get_ollama_models()
     if not models:
         raise HTTPException(status_code=503, detail="No Ollama models available or server not reachable")
     return {"models": models}
 
+async def generate_image(request: WorkflowRequest, job: Job) -> Dict:
+    template = workflows.get(request.workflow)
+
+    # Validate checkpoint name
+    job.update(stage="Checking checkpoint")
+    checkpoints = await capabilities.checkpoints(request.ckpt_name)
+    if request.ckpt_name not in checkpoints:
+        raise HTTPException(status_code=400, detail="Invalid checkpoint name")
+
+    # Validate Ollama model if use_ollama is true
+    final_positive_prompt = request.positive_prompt
+    if request.use_ollama:
+        if not request.ollama_model or request.ollama_model == "undefined":
+            raise HTTPException(status_code=400, detail="Ollama model must be specified when use_ollama is true")
+
+        available_models = await get_ollama_models(request.ollama_model)
+        if not available_models:
+            logger.warning("No Ollama models available; falling back to original prompt")
+            request.use_ollama = False
+        elif request.ollama_model not in available_models:
+            raise HTTPException(status_code=400, detail=f"Invalid Ollama model: {request.ollama_model}. Available models: {available_models}")
+        else:
+            job.update(stage="Enhancing prompt with Ollama")
+            final_positive_prompt = await enhance_prompt_with_ollama(request.positive_prompt, request.ollama_model)
+            logger.info(f"Enhanced prompt: {final_positive_prompt}")
+
+    # Patch the compiled workflow: seed, prompts and checkpoint
+    prompt = template.build(
+        positive=final_positive_prompt,
+        negative=request.negative_prompt,
+        ckpt_name=request.ckpt_name,
+        seed=int.from_bytes(os.urandom(8), "big") % (10**15),
+    )
+
+    # Queue the prompt and wait for its images
+    images = await run_prompt(prompt, job)
+
+    # Generate follow-up description with Ollama if requested
+    follow_up = ""
+    if request.use_ollama and available_models:
+        job.update(stage="Writing follow-up with Ollama")
+        follow_up = await generate_follow_up_with_ollama(final_positive_prompt, images, request.ollama_model)
+
+    return {
+        "status": "success",
+        "result": images,
+        "enhanced_prompt": final_positive_prompt,
+        "follow_up": follow_up
+    }
+
 @app.post("/run")
 async def run_workflow(request: WorkflowRequest):
-    try:
-        # Validate checkpoint name
-        response = requests.get(f"http://{server_address}/object_info/CheckpointLoaderSimple", timeout=5)
-        response.raise_for_status()
-        data = response.json()
-        checkpoints = data.get("CheckpointLoaderSimple", {}).get("input", {}).get("required", {}).get("ckpt_name", [])[0]
-        
-        if request.ckpt_name not in checkpoints:
-            raise HTTPException(status_code=400, detail="Invalid checkpoint name")
-
-        # Validate Ollama model if use_ollama is true
-        final_positive_prompt = request.positive_prompt
-        if request.use_ollama:
-            if not request.ollama_model or request.ollama_model == "undefined":
-                raise HTTPException(status_code=400, detail="Ollama model must be specified when use_ollama is true")
-            
-            available_models = get_ollama_models()
-            if not available_models:
-                logger.warning("No Ollama models available; falling back to original prompt")
-                request.use_ollama = False
-            elif request.ollama_model not in available_models:
-                raise HTTPException(status_code=400, detail=f"Invalid Ollama model: {request.ollama_model}. Available models: {available_models}")
-            else:
-                final_positive_prompt = enhance_prompt_with_ollama(request.positive_prompt, request.ollama_model)
-                logger.info(f"Enhanced prompt: {final_positive_prompt}")
-
-        # Create a copy of the workflow
-        prompt = copy.deepcopy(workflow)
-        
-        # Update prompts
-        id_to_class_type = {id: details["class_type"] for id, details in prompt.items()}
-        k_sampler_id = [key for key, value in id_to_class_type.items() if value == "KSampler"][0]
-        positive_input_id = prompt[k_sampler_id]["inputs"]["positive"][0]
-        negative_input_id = prompt[k_sampler_id]["inputs"]["negative"][0]
-        
-        # Update seed for each run
-        prompt[k_sampler_id]["inputs"]["seed"] = int.from_bytes(os.urandom(8), "big") % (10**15)
-        prompt[positive_input_id]["inputs"]["text"] = final_positive_prompt
-        if request.negative_prompt:
-            prompt[negative_input_id]["inputs"]["text"] = request.negative_prompt
-
-        # Update checkpoint name
-        checkpoint_loader_id = [key for key, value in id_to_class_type.items() if value == "CheckpointLoaderSimple"][0]
-        prompt[checkpoint_loader_id]["inputs"]["ckpt_name"] = request.ckpt_name
-
-        # Connect to WebSocket and queue prompt
-        ws, client_id = open_websocket_connection()
-        try:
-            prompt_id = queue_prompt(prompt, client_id)["prompt_id"]
-            track_progress(ws, prompt_id)
-            images = get_images(prompt_id)
-            
-            # Generate follow-up description with Ollama if requested
-            follow_up = ""
-            if request.use_ollama and available_models:
-                follow_up = generate_follow_up_with_ollama(final_positive_prompt, images, request.ollama_model)
-            
-            return {
-                "status": "success",
-                "result": images,
-                "enhanced_prompt": final_positive_prompt,
-                "follow_up": follow_up
-            }
-        finally:
-            ws.close()
-    except Exception as e:
-        logger.error(f"Error running workflow: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
-    
+    # Runs as a job, with the request held open until it is done
+    job = await jobs.run("run", lambda job: generate_image(request, job))
+    if job.status == "failed":
+        logger.error(f"Error running workflow: {job.error}")
+        raise HTTPException(status_code=500, detail=job.error)
+    return job.result
+
+@app.post("/jobs/run", status_code=202)
+async def start_run_job(request: WorkflowRequest):
+    job = jobs.create("run", lambda job: generate_image(request, job))
+    return job.state()
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    return job_response(jobs.get(job_id))
+
+@app.get("/jobs/{job_id}/events")
+async def get_job_events(job_id: str):
+    return event_stream(jobs.get(job_id))
@@ -0,0 +1,338 @@
+"""Offline load test for the ComfyUI proxies (img_gen_server.py, img_prompt_server.py, txt_img2img/server.py).
+
+Runs the chosen proxy under uvicorn against a stand-in ComfyUI and Ollama
+server that take a fixed time per generation, fires concurrent /run
+requests and probes /ollama_health while they run. With non-blocking I/O
+the runs overlap (wall time close to one run) and health checks answer in
+milliseconds; a proxy that blocks its event loop serializes both. With
+--jobs, each client uses the job API instead: it starts a job, follows its
+event stream, drops and reopens the stream once mid-run, and fetches the
+images when the job is done.
+
+    python img_server_bench.py --requests 8 --generate-seconds 2
+    python img_server_bench.py --server txt_img2img/server.py --requests 16
+    python img_server_bench.py --jobs --comfy-workers 1 --requests 4
+"""
+import argparse
+import asyncio
+import base64
+import importlib.util
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+
+import httpx
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, Response, WebSocket, WebSocketDisconnect
+
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCH_CHECKPOINT = "bench.safetensors"
+BENCH_OLLAMA_MODEL = "bench-llm"
+# 1x1 transparent PNG returned for every generated image
+PNG_BYTES = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=="
+)
+BENCH_STEPS = 4  # Sampler steps reported by the stand-in ComfyUI, each with a preview frame
+BENCH_WORKFLOW = {
+    "3": {"class_type": "KSampler", "inputs": {"seed": 0, "positive": ["6", 0], "negative": ["7", 0], "model": ["4", 0]}},
+    "4": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": BENCH_CHECKPOINT}},
+    "6": {"class_type": "CLIPTextEncode", "inputs": {"text": "", "clip": ["4", 1]}},
+    "7": {"class_type": "CLIPTextEncode", "inputs": {"text": "", "clip": ["4", 1]}},
+    "9": {"class_type": "SaveImage", "inputs": {"images": ["8", 0]}},
+}
+
+
+def stand_in_app(generate_seconds, ollama_seconds, images, workers=0):
+    """ComfyUI and Ollama endpoints used by the proxies, with fixed delays instead of models.
+
+    workers is how many prompts the stand-in ComfyUI runs at once (ComfyUI
+    itself runs one); 0 runs every prompt at once.
+    """
+    app = FastAPI()
+    app.state.ws_connections = 0
+    app.state.object_info_requests = 0
+    sockets = {}  # client_id -> WebSocket
+    slots = asyncio.Semaphore(workers) if workers else None
+    pending = {}  # prompt_id -> number
+    running = {}
+    numbers = iter(range(1, 1 << 62))
+
+    @app.get("/object_info/CheckpointLoaderSimple")
+    async def object_info():
+        app.state.object_info_requests += 1
+        return {"CheckpointLoaderSimple": {"input": {"required": {"ckpt_name": [[BENCH_CHECKPOINT]]}}}}
+
+    @app.websocket("/ws")
+    async def progress(ws: WebSocket, clientId: str = ""):
+        await ws.accept()
+        app.state.ws_connections += 1
+        sockets[clientId] = ws
+        try:
+            while True:
+                await ws.receive_text()
+        except WebSocketDisconnect:
+            sockets.pop(clientId, None)
+
+    async def send(client_id, kind, **data):
+        ws = sockets.get(client_id)
+        if ws is not None:
+            await ws.send_text(json.dumps({"type": kind, "data": data}))
+
+    async def queue_status():
+        remaining = len(pending) + len(running)
+        for client_id in list(sockets):
+            await send(client_id, "status", status={"exec_info": {"queue_remaining": remaining}})
+
+    async def execute(prompt_id, client_id):
+        if slots is not None:
+            await slots.acquire()
+        running[prompt_id] = pending.pop(prompt_id)
+        try:
+            await run(prompt_id, client_id)
+        finally:
+            del running[prompt_id]
+            if slots is not None:
+                slots.release()
+            await queue_status()
+
+    async def run(prompt_id, client_id):
+        # The same events, in the same order, as ComfyUI sends for one prompt
+        await send(client_id, "execution_start", prompt_id=prompt_id)
+        for step in range(1, BENCH_STEPS + 1):
+            await asyncio.sleep(generate_seconds / BENCH_STEPS)
+            await send(client_id, "executing", node="3", prompt_id=prompt_id)
+            await send(client_id, "progress", value=step, max=BENCH_STEPS, node="3", prompt_id=prompt_id)
+            ws = sockets.get(client_id)
+            if ws is not None:
+                await ws.send_bytes(b"\x00\x00\x00\x01\x00\x00\x00\x02" + PNG_BYTES)
+        await send(client_id, "executed", node="9", output={}, prompt_id=prompt_id)
+        await send(client_id, "executing", node=None, prompt_id=prompt_id)
+
+    @app.post("/prompt")
+    async def queue(body: dict):
+        prompt_id = body.get("prompt_id") or str(uuid.uuid4())
+        pending[prompt_id] = next(numbers)
+        asyncio.create_task(execute(prompt_id, body.get("client_id")))
+        await queue_status()
+        return {"prompt_id": prompt_id, "number": pending.get(prompt_id, 0)}
+
+    @app.get("/queue")
+    async def queue_state():
+        return {
+            "queue_running": [[number, prompt_id, {}, {}, []] for prompt_id, number in running.items()],
+            "queue_pending": [[number, prompt_id, {}, {}, []] for prompt_id, number in pending.items()],
+        }
+
+    @app.get("/history/{prompt_id}")
+    async def history(prompt_id: str):
+        units = [{"filename": f"{prompt_id}_{i}.png", "subfolder": "", "type": "output"} for i in range(images)]
+        return {prompt_id: {"outputs": {"9": {"images": units}}}}
+
+    @app.get("/view")
+    async def view(filename: str):
+        return Response(PNG_BYTES, media_type="image/png")
+
+    @app.get("/bench/stats")
+    async def stats():
+        return {"ws_connections": app.state.ws_connections, "object_info_requests": app.state.object_info_requests}
+
+    @app.get("/api/tags")
+    async def tags():
+        return {"models": [{"name": BENCH_OLLAMA_MODEL}]}
+
+    @app.post("/api/generate")
+    async def generate(body: dict):
+        await asyncio.sleep(ollama_seconds)
+        return {"model": body.get("model"), "response": "a detailed bench prompt", "done": True}
+
+    return app
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def run_stand_in(port, generate_seconds, ollama_seconds, images, workers):
+    # Own process, so the stand-in does not share the proxy's interpreter lock
+    uvicorn.run(stand_in_app(generate_seconds, ollama_seconds, images, workers), host="127.0.0.1", port=port, log_level="warning")
+
+
+def wait_for(url, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return httpx.get(url).json()
+        except httpx.TransportError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def serve(app, port):
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", lifespan="on"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def load_server(path, stand_in):
+    # The proxies read workflow01.json from the working directory when imported
+    workdir = tempfile.mkdtemp(prefix="img_bench_")
+    with open(os.path.join(workdir, "workflow01.json"), "w") as f:
+        json.dump(BENCH_WORKFLOW, f)
+    os.chdir(workdir)
+    spec = importlib.util.spec_from_file_location("bench_img_server", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.server_address = stand_in
+    module.ollama_address = f"http://{stand_in}"
+    return module
+
+
+def percentiles(values):
+    if not values:
+        return None
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return {"count": len(values), "p50": float(p50), "p90": float(p90), "p99": float(p99), "max": float(max(values))}
+
+
+async def follow_job(user, body):
+    """Run one job through the job API; return (ok, event counts, highest queue position seen)."""
+    response = await user.post("/jobs/run", json=body)
+    response.raise_for_status()
+    job_id = response.json()["job_id"]
+    events, position, reconnected = Counter(), 0, False
+    while True:
+        dropped = False
+        async with user.stream("GET", f"/jobs/{job_id}/events") as stream:
+            event = None
+            async for line in stream.aiter_lines():
+                if line.startswith("event: "):
+                    event = line[len("event: "):]
+                    events[event] += 1
+                elif line.startswith("data: ") and event == "queue":
+                    position = max(position, json.loads(line[len("data: "):])["queue_position"])
+                elif line.startswith("data: ") and event == "progress" and not reconnected:
+                    # Drop the stream once mid-run; the job keeps running and the client reconnects
+                    dropped = reconnected = True
+                    break
+        if not dropped:
+            break
+        events["reconnects"] += 1
+    job = (await user.get(f"/jobs/{job_id}")).json()
+    return job["status"] == "done" and len(job["result"]["result"]) > 0, events, position
+
+
+async def run_load(base_url, requests, use_ollama, probe_interval, timeout, use_jobs=False):
+    body = {
+        "positive_prompt": "a lighthouse at dusk",
+        "ckpt_name": BENCH_CHECKPOINT,
+        "use_ollama": use_ollama,
+        "ollama_model": BENCH_OLLAMA_MODEL,
+    }
+    async with httpx.AsyncClient(base_url=base_url, timeout=timeout) as client:
+        events, positions = Counter(), []
+
+        async def one_run():
+            # Each request comes from its own client, like separate browsers (plain HTTP, no certificates loaded)
+            async with httpx.AsyncClient(base_url=base_url, timeout=timeout, verify=False) as user:
+                started = time.perf_counter()
+                if use_jobs:
+                    ok, job_events, position = await follow_job(user, body)
+                    events.update(job_events)
+                    positions.append(position)
+                    return time.perf_counter() - started, ok
+                response = await user.post("/run", json=body)
+                return time.perf_counter() - started, response.status_code == 200 and len(response.json()["result"]) > 0
+
+        async def probe(done):
+            latencies = []
+            while not done.is_set():
+                started = time.perf_counter()
+                await client.get("/ollama_health")
+                latencies.append(time.perf_counter() - started)
+                await asyncio.sleep(probe_interval)
+            return latencies
+
+        done = asyncio.Event()
+        prober = asyncio.create_task(probe(done))
+        started = time.perf_counter()
+        runs = await asyncio.gather(*(one_run() for _ in range(requests)), return_exceptions=True)
+        wall = time.perf_counter() - started
+        done.set()
+        health = await prober
+    durations = [r[0] for r in runs if not isinstance(r, Exception)]
+    failed = sum(1 for r in runs if isinstance(r, Exception) or not r[1])
+    return {
+        "wall_seconds": wall,
+        "serial_seconds": sum(durations),
+        "overlap": sum(durations) / wall if wall else None,
+        "failed": failed,
+        "run": percentiles(durations),
+        "health": percentiles(health),
+        "events": dict(events),
+        "max_queue_position": max(positions) if positions else None,
+    }
+
+
+def build_cli():
+    parser = argparse.ArgumentParser(description="Offline load test for the ComfyUI proxies.")
+    parser.add_argument("--server", default="img_gen_server.py", help="Proxy to test, relative to this folder (default: img_gen_server.py)")
+    parser.add_argument("-n", "--requests", type=int, default=8, help="Concurrent /run requests (default: 8)")
+    parser.add_argument("--generate-seconds", type=float, default=2.0, help="Stand-in ComfyUI seconds per workflow")
+    parser.add_argument("--ollama-seconds", type=float, default=0.5, help="Stand-in Ollama seconds per generate call")
+    parser.add_argument("--images", type=int, default=2, help="Images per workflow")
+    parser.add_argument("--no-ollama", action="store_true", help="Send use_ollama false")
+    parser.add_argument("--jobs", action="store_true", help="Use the job API and event streams instead of /run")
+    parser.add_argument("--comfy-workers", type=int, default=0, help="Prompts the stand-in ComfyUI runs at once (default: 0, all)")
+    parser.add_argument("--probe-interval", type=float, default=0.1, help="Seconds between /ollama_health probes")
+    parser.add_argument("--timeout", type=float, default=300, help="Client timeout per request")
+    return parser
+
+
+def main():
+    args = build_cli().parse_args()
+    server_path = os.path.join(CODE_DIR, args.server)
+
+    stand_in_port = free_port()
+    stand_in = multiprocessing.Process(
+        target=run_stand_in, args=(stand_in_port, args.generate_seconds, args.ollama_seconds, args.images, args.comfy_workers), daemon=True,
+    )
+    stand_in.start()
+    wait_for(f"http://127.0.0.1:{stand_in_port}/bench/stats")
+    module = load_server(server_path, f"127.0.0.1:{stand_in_port}")
+    proxy_port = free_port()
+    serve(module.app, proxy_port)
+
+    result = asyncio.run(run_load(
+        f"http://127.0.0.1:{proxy_port}", args.requests, not args.no_ollama, args.probe_interval, args.timeout, args.jobs,
+    ))
+    print(f"{args.server}: {args.requests} concurrent {'jobs' if args.jobs else '/run'}, {result['failed']} failed")
+    print(f"  wall {result['wall_seconds']:.2f}s, serial sum {result['serial_seconds']:.2f}s, overlap x{result['overlap']:.1f}")
+    stats = wait_for(f"http://127.0.0.1:{stand_in_port}/bench/stats")
+    print(f"  ComfyUI WebSocket connections opened: {stats['ws_connections']}")
+    print(f"  ComfyUI /object_info requests: {stats['object_info_requests']}")
+    # Only job API submissions are kept (for job_ttl); blocking /run calls are dropped when they finish
+    print(f"  jobs kept by the proxy: {len(module.jobs.jobs)}")
+    if args.jobs:
+        print(f"  events {result['events']}, highest queue position {result['max_queue_position']}")
+    for name in ("run", "health"):
+        row = result[name]
+        if row:
+            print(f"  {name:<7} p50 {row['p50']:8.3f}  p90 {row['p90']:8.3f}  p99 {row['p99']:8.3f}  max {row['max']:8.3f}")
+    return 1 if result["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
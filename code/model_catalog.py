@@ -0,0 +1,133 @@
+import threading
+import time
+
+import requests
+
+from chat_history import context_length
+
+MODELS_TTL = 300  # Seconds before the model list is refetched in the background
+READINESS_TTL = 15  # Seconds before the loaded/cold state is refetched
+INITIAL_WAIT = 3  # Seconds the very first page load waits for the model list
+
+
+class ModelCatalog:
+    """Cached /api/models list with background refresh and per-model readiness.
+
+    Reads never wait on the network except on the very first load; stale data is
+    served while a refresh thread fetches the new list. Readiness comes from
+    Ollama's /api/ps (models resident in memory); models served by other
+    backends such as vLLM are always resident.
+    """
+
+    def __init__(self, client, models_url, headers, ps_url=None,
+                 ttl=MODELS_TTL, readiness_ttl=READINESS_TTL):
+        self.client = client
+        self.models_url = models_url
+        self.headers = headers
+        self.ps_url = ps_url
+        self.ttl = ttl
+        self.readiness_ttl = readiness_ttl
+        self.models = []
+        self.error = None
+        self.loaded = None  # Names of resident Ollama models, None when unknown
+        self.fetched_at = 0.0
+        self.readiness_at = 0.0
+        self._lock = threading.Lock()
+        self._refreshing = False
+        self._first_load = threading.Event()
+
+    def fetch_models(self):
+        try:
+            response = self.client.get(self.models_url, headers=self.headers)
+        except requests.exceptions.RequestException as e:
+            return None, f"Model list unavailable: {e}"
+        if response.status_code == 403:
+            return None, "Access Forbidden - Check API Key Permissions"
+        if response.status_code != 200:
+            return None, f"Model list unavailable: HTTP {response.status_code}"
+        try:
+            return response.json().get("data", []), None
+        except ValueError:
+            return None, "Error: Invalid JSON response"
+
+    def fetch_loaded(self):
+        if not self.ps_url:
+            return None
+        try:
+            response = self.client.get(self.ps_url, headers=self.headers)
+            response.raise_for_status()
+            return {m.get("name") for m in response.json().get("models", [])}
+        except (requests.exceptions.RequestException, ValueError):
+            return None
+
+    def _refresh(self, models_due):
+        try:
+            if models_due:
+                models, error = self.fetch_models()
+                with self._lock:
+                    if models is not None:
+                        self.models = models
+                    # Keep serving the last good list when a refresh fails
+                    self.error = error
+                    self.fetched_at = time.time()
+            loaded = self.fetch_loaded()
+            with self._lock:
+                self.loaded = loaded
+                self.readiness_at = time.time()
+        finally:
+            with self._lock:
+                self._refreshing = False
+            self._first_load.set()
+
+    def refresh_async(self, force=False):
+        now = time.time()
+        with self._lock:
+            models_due = force or now - self.fetched_at > self.ttl
+            readiness_due = force or now - self.readiness_at > self.readiness_ttl
+            if self._refreshing or not (models_due or readiness_due):
+                return
+            self._refreshing = True
+        threading.Thread(target=self._refresh, args=(models_due,), daemon=True).start()
+
+    def snapshot(self):
+        """Return (models, error) without blocking, starting a refresh when data is stale."""
+        self.refresh_async()
+        self._first_load.wait(INITIAL_WAIT)
+        with self._lock:
+            return list(self.models), self.error
+
+    def readiness(self, model):
+        if model.get("owned_by") != "ollama":
+            return "loaded"
+        with self._lock:
+            loaded = self.loaded
+        if loaded is None:
+            return "unknown"
+        return "loaded" if ollama_name(model) in loaded else "cold"
+
+
+def ollama_name(model):
+    return (model.get("ollama") or {}).get("name") or model.get("id") or model.get("name")
+
+
+READINESS_LABELS = {"loaded": "🟢 ready", "warming": "🟡 warming up", "cold": "⚪ cold start", "unknown": ""}
+
+
+def model_label(name, state):
+    label = READINESS_LABELS.get(state, "")
+    return f"{name}  ({label})" if label else name
+
+
+def model_details(model):
+    parts = []
+    length = context_length(model)
+    if length:
+        parts.append(f"context {length:,} tokens")
+    details = (model.get("ollama") or {}).get("details") or {}
+    if details.get("parameter_size"):
+        parts.append(details["parameter_size"])
+    if details.get("quantization_level"):
+        parts.append(details["quantization_level"])
+    if model.get("owned_by"):
+        parts.append(f"served by {model['owned_by']}")
+    return " · ".join(parts)
@@ -0,0 +1,158 @@
+import logging
+import sqlite3
+import threading
+import time
+
+import requests
+
+from model_catalog import ollama_name
+
+logger = logging.getLogger(__name__)
+
+KEEP_ALIVE = "30m"  # How long Ollama keeps a warmed or renewed model in memory
+LEASE_SECONDS = 15 * 60  # A session that has not rerun for this long no longer holds its model
+RENEW_SECONDS = 5 * 60  # Leased models have their keep_alive renewed this often
+WARM_RETRY_SECONDS = 60  # A failed or unconfirmed warm-up is not retried sooner
+CHECK_SECONDS = 30  # Period of the background renew and prewarm loop
+USAGE_DB = "model_usage.db"  # SQLite file recording which models are used at which hours
+USAGE_DAYS = 28  # Days of usage history used to pick models to prewarm
+PREWARM_MODELS = 2  # Most models prewarmed for one hour of the week
+PREWARM_MIN_USES = 3  # Uses in that hour of the week before a model counts as popular
+PREWARM_LEAD = 10 * 60  # Seconds before the hour that prewarming starts
+
+
+class WarmupManager:
+    """Keeps the models people are using loaded in Ollama.
+
+    select() is called on every rerun with the session's chosen model: a cold
+    model is loaded at once in the background (an empty /api/generate request
+    with keep_alive) instead of on the first message, and the session takes a
+    lease on it. A background loop renews keep_alive for leased models and,
+    while nobody holds a lease (e.g. before the working day), prewarms the
+    models most used in the coming hour of the week.
+    """
+
+    def __init__(self, client, generate_url, headers, catalog, keep_alive=KEEP_ALIVE, usage_db=USAGE_DB):
+        self.client = client
+        self.generate_url = generate_url
+        self.headers = headers
+        self.catalog = catalog
+        self.keep_alive = keep_alive
+        self.leases = {}  # model name -> {session: last seen}
+        self.warming = set()
+        self.warmed_at = {}  # model name -> last warm-up or renewal request
+        self.prewarmed_slot = None
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(usage_db, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS model_uses (model TEXT NOT NULL, used_at REAL NOT NULL, slot INTEGER NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS model_uses_slot ON model_uses (slot, used_at)")
+        self.db.commit()
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def _model(self, name):
+        models, _ = self.catalog.snapshot()
+        return next((m for m in models if m.get("name") == name), None)
+
+    def state(self, model):
+        """Readiness of a model dict from the catalog, or "warming" while a warm-up is in progress."""
+        with self._lock:
+            if model.get("name") in self.warming:
+                return "warming"
+        return self.catalog.readiness(model)
+
+    def select(self, session, name):
+        """Take (or renew) the session's lease on its chosen model and warm the model if it is cold."""
+        now = time.time()
+        with self._lock:
+            for model_name, sessions in self.leases.items():
+                if model_name != name:
+                    sessions.pop(session, None)
+            self.leases.setdefault(name, {})[session] = now
+        model = self._model(name)
+        if model is not None and self.state(model) == "cold":
+            self.warm(model)
+
+    def warm(self, model):
+        name = model.get("name")
+        with self._lock:
+            if name in self.warming or time.time() - self.warmed_at.get(name, 0) < WARM_RETRY_SECONDS:
+                return
+            self.warming.add(name)
+            self.warmed_at[name] = time.time()
+        threading.Thread(target=self._load, args=(model,), daemon=True).start()
+
+    def _load(self, model):
+        try:
+            self.keep(model)
+        finally:
+            with self._lock:
+                self.warming.discard(model.get("name"))
+            self.catalog.refresh_async(force=True)
+
+    def keep(self, model):
+        # Without a prompt, Ollama only loads the model and sets how long it stays loaded
+        body = {"model": ollama_name(model), "keep_alive": self.keep_alive}
+        try:
+            response = self.client.post(self.generate_url, headers=self.headers, json=body)
+            return response.status_code == 200
+        except requests.exceptions.RequestException:
+            return False
+
+    def leased(self, now):
+        with self._lock:
+            for sessions in self.leases.values():
+                for session, seen in list(sessions.items()):
+                    if now - seen > LEASE_SECONDS:
+                        del sessions[session]
+            return [name for name, sessions in self.leases.items() if sessions]
+
+    def record_use(self, name):
+        now = time.time()
+        with self._lock:
+            self.db.execute("INSERT INTO model_uses (model, used_at, slot) VALUES (?, ?, ?)", (name, now, week_slot(now)))
+            self.db.execute("DELETE FROM model_uses WHERE used_at < ?", (now - USAGE_DAYS * 86400,))
+            self.db.commit()
+
+    def popular(self, slot):
+        """Models most used in this hour of the week over the last USAGE_DAYS."""
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT model, COUNT(*) AS uses FROM model_uses WHERE slot = ? AND used_at > ? "
+                "GROUP BY model HAVING uses >= ? ORDER BY uses DESC LIMIT ?",
+                (slot, time.time() - USAGE_DAYS * 86400, PREWARM_MIN_USES, PREWARM_MODELS),
+            ).fetchall()
+        return [model for model, _ in rows]
+
+    def _loop(self):
+        while True:
+            time.sleep(CHECK_SECONDS)
+            try:
+                self.tick(time.time())
+            except Exception:
+                logger.exception("Model warm-up loop failed")
+
+    def tick(self, now):
+        leased = self.leased(now)
+        for name in leased:
+            with self._lock:
+                due = now - self.warmed_at.get(name, 0) >= RENEW_SECONDS
+                if due:
+                    self.warmed_at[name] = now
+            model = self._model(name) if due else None
+            if model is not None and model.get("owned_by") == "ollama":
+                self.keep(model)
+        # Prewarming only while idle, so it never evicts a model someone is using
+        slot = week_slot(now + PREWARM_LEAD)
+        if leased or slot == self.prewarmed_slot:
+            return
+        self.prewarmed_slot = slot
+        for name in self.popular(slot):
+            model = self._model(name)
+            if model is not None and self.state(model) == "cold":
+                self.warm(model)
+
+
+def week_slot(timestamp):
+    # Hour of the week in local time, Monday 00:00 being 0
+    t = time.localtime(timestamp)
+    return t.tm_wday * 24 + t.tm_hour
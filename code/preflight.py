@@ -0,0 +1,152 @@
+import logging
+import threading
+from functools import lru_cache
+
+from chat_history import MESSAGE_OVERHEAD, REPLY_RESERVE, build_window, count_message_tokens
+
+try:
+    from transformers import AutoTokenizer
+except ImportError:  # Without transformers, prompts are sized with the calibrated estimate
+    AutoTokenizer = None
+
+logger = logging.getLogger(__name__)
+
+# Hugging Face tokenizer per model name, e.g. {"llama3.1:8b": "meta-llama/Llama-3.1-8B-Instruct"};
+# models not listed are sized with chat_history's estimate, corrected by what the server reports
+MODEL_TOKENIZERS = {}
+MIN_REPLY_TOKENS = 256  # Prompts leaving less room than this for the answer are not sent
+FIT_ATTEMPTS = 3  # Times the window is rebuilt with a smaller budget before giving up
+THROUGHPUT_ALPHA = 0.3  # Weight of the newest turn in the moving averages
+
+
+class PromptTooLarge(Exception):
+    pass
+
+
+@lru_cache(maxsize=16)
+def load_tokenizer(model):
+    # Loaded once per model and process; a missing or unreachable tokenizer falls back to the estimate
+    repo = MODEL_TOKENIZERS.get(model)
+    if not repo or AutoTokenizer is None:
+        return None
+    try:
+        return AutoTokenizer.from_pretrained(repo)
+    except Exception as e:
+        logger.warning(f"Tokenizer {repo} for {model} not loaded: {e}")
+        return None
+
+
+def average(previous, value):
+    if value is None:
+        return previous
+    return value if previous is None else THROUGHPUT_ALPHA * value + (1 - THROUGHPUT_ALPHA) * previous
+
+
+class Preflight:
+    """Sizes each assembled prompt for its model before it is sent, and learns each model's throughput.
+
+    count() uses the model's own tokenizer when one is configured, otherwise
+    the local estimate scaled by the ratio between the prompt sizes the
+    server reported and what was estimated. record() feeds each finished turn
+    into a per-model table of prefill and decode speed, which gives the
+    expected prefill time of the next prompt.
+    """
+
+    def __init__(self):
+        self.models = {}
+        self._lock = threading.Lock()
+
+    def _model(self, model):
+        return self.models.setdefault(model, {
+            "turns": 0, "token_ratio": None, "prefill_tps": None, "decode_tps": None, "ttft": None,
+        })
+
+    def count(self, model, messages):
+        """Return (tokens, exact) for messages as the model will see them."""
+        tokenizer = load_tokenizer(model)
+        if tokenizer is not None:
+            try:
+                return len(tokenizer.apply_chat_template(messages, tokenize=True, add_generation_prompt=True)), True
+            except Exception:
+                # No chat template: count the contents and add the usual per-message overhead
+                return sum(len(tokenizer.encode(m["content"])) + MESSAGE_OVERHEAD for m in messages), True
+        with self._lock:
+            ratio = self._model(model)["token_ratio"] or 1.0
+        return int(count_message_tokens(messages) * ratio), False
+
+    def prefill_seconds(self, model, tokens):
+        with self._lock:
+            tps = self._model(model)["prefill_tps"]
+        return tokens / tps if tps else None
+
+    def fit(self, model, budget, system_prompt, history, summary, summarize=None):
+        """Build the prompt window and shrink it until the counted prompt fits the model's context.
+
+        Returns (messages, summary, info) like chat_history.build_window, which
+        builds each attempt; info also holds the counted size and the expected
+        prefill time.
+        """
+        target = budget
+        for attempt in range(FIT_ATTEMPTS):
+            messages, new_summary, info = build_window(system_prompt, history, target, summary, summarize)
+            tokens, exact = self.count(model, messages)
+            if tokens + REPLY_RESERVE <= budget or attempt == FIT_ATTEMPTS - 1:
+                break
+            # The estimate undercounts for this model: ask for a proportionally smaller window.
+            # Retries keep this attempt's summary and fold further turns extractively, so the
+            # summarizer model is called at most once per turn
+            target = int(target * (budget - REPLY_RESERVE) / (tokens + REPLY_RESERVE))
+            summary, summarize = new_summary, None
+        summary = new_summary
+        info = dict(
+            info,
+            estimated_tokens=info["prompt_tokens"],
+            prompt_tokens=tokens,
+            exact=exact,
+            context=budget,
+            prefill_seconds=self.prefill_seconds(model, tokens),
+        )
+        return messages, summary, info
+
+    def check(self, info):
+        """Raise PromptTooLarge for a prompt that would leave too little room for the answer."""
+        if info["prompt_tokens"] + MIN_REPLY_TOKENS > info["context"]:
+            raise PromptTooLarge(
+                f"The message is too long for this model: {info['prompt_tokens']:,} tokens, "
+                f"context {info['context']:,}. Please shorten it or choose a model with a larger context"
+            )
+
+    def record(self, model, info, stats):
+        """Update the model's throughput table from a completed turn."""
+        with self._lock:
+            entry = self._model(model)
+            entry["turns"] += 1
+            if stats.prompt_tokens and not info["exact"] and info["estimated_tokens"]:
+                entry["token_ratio"] = average(entry["token_ratio"], stats.prompt_tokens / info["estimated_tokens"])
+            prompt_tokens = stats.prompt_tokens or info["prompt_tokens"]
+            if stats.ttft:
+                # Time to the first token is mostly prefill once the request has its slot
+                entry["prefill_tps"] = average(entry["prefill_tps"], prompt_tokens / stats.ttft)
+                entry["ttft"] = average(entry["ttft"], stats.ttft)
+            entry["decode_tps"] = average(entry["decode_tps"], stats.tokens_per_sec)
+
+    def table(self):
+        with self._lock:
+            return [
+                {
+                    "model": model,
+                    "turns": entry["turns"],
+                    "tokenizer": "model" if load_tokenizer(model) is not None else f"estimate ×{entry['token_ratio'] or 1.0:.2f}",
+                    "prefill_tok_s": round(entry["prefill_tps"]) if entry["prefill_tps"] else None,
+                    "decode_tok_s": round(entry["decode_tps"], 1) if entry["decode_tps"] else None,
+                    "avg_ttft_s": round(entry["ttft"], 2) if entry["ttft"] else None,
+                }
+                for model, entry in sorted(self.models.items())
+            ]
+
+
+def format_preflight(info):
+    text = f"Pre-flight: {info['prompt_tokens']:,} tokens ({'model tokenizer' if info['exact'] else 'estimated'})"
+    if info["prefill_seconds"] is not None:
+        text += f" · expected prefill {info['prefill_seconds']:.1f}s"
+    return text
@@ -0,0 +1,177 @@
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from doc_index import hash_embed, ollama_embed
+
+CACHE_DB = "response_cache.db"
+CACHE_TTL = 7 * 24 * 3600  # Seconds an answer stays valid
+CACHE_MAX_ENTRIES = 5000  # Least recently used entries are evicted beyond this
+SIMILARITY_THRESHOLD = 0.92  # Cosine similarity needed for a semantic hit
+FOLLOW_UP_MAX_WORDS = 3  # Later prompts this short ("why?", "and in 2020?") depend on the conversation
+
+# Words that refer back to earlier turns
+FOLLOW_UP_WORDS = re.compile(
+    r"\b(it|its|this|that|these|those|they|them|their|he|she|him|her|his|above|previous|earlier|again|"
+    r"instead|same|you said|your answer|rewrite|shorter|longer)\b",
+    re.I,
+)
+
+
+def normalize_prompt(prompt):
+    text = " ".join(prompt.lower().split())
+    return re.sub(r"^[\W_]+|[\W_]+$", "", text)
+
+
+def digest(*parts):
+    return hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Answers keyed by (model, system prompt, normalized prompt), stored in SQLite.
+
+    Exact lookups use the key hash; semantic lookups compare prompt embeddings
+    within the same model and system prompt. The earlier conversation is not
+    part of the key, so a repeated question hits wherever it is asked; callers
+    skip the cache for follow-ups that need the earlier turns (is_follow_up).
+    """
+
+    def __init__(self, path=CACHE_DB, ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES,
+                 threshold=SIMILARITY_THRESHOLD, embed_url=None, embed_model=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.embed_url = embed_url
+        self.embed_model = embed_model
+        self._lock = threading.Lock()
+        # Streamlit serves each session from its own thread; the lock serializes access
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                scope TEXT NOT NULL,
+                prompt TEXT NOT NULL,
+                reply TEXT NOT NULL,
+                tokens INTEGER NOT NULL,
+                embedder TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS responses_scope ON responses (scope, embedder);
+            CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used);
+            CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+            """
+        )
+        self.db.commit()
+
+    def embed(self, text):
+        if self.embed_url and self.embed_model:
+            try:
+                return self.embed_model, ollama_embed([text], self.embed_url, self.embed_model)[0]
+            except Exception:
+                pass
+        return "hash", hash_embed([text])[0]
+
+    def _bump(self, **counts):
+        for name, value in counts.items():
+            self.db.execute(
+                "INSERT INTO counters (name, value) VALUES (?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                (name, value),
+            )
+
+    def lookup(self, model, system_prompt, prompt):
+        """Return {"reply", "kind", "similarity", "tokens"} for a hit, or None."""
+        normalized = normalize_prompt(prompt)
+        scope = digest(model, system_prompt)
+        key = digest(scope, normalized)
+        now = time.time()
+        with self._lock:
+            row = self.db.execute(
+                "SELECT key, reply, tokens, 1.0 FROM responses WHERE key = ? AND created_at > ?",
+                (key, now - self.ttl),
+            ).fetchone()
+        kind = "exact"
+        if row is None:
+            # Embedding may call the embedding server, so it runs outside the lock
+            embedder, vector = self.embed(normalized)
+            with self._lock:
+                rows = self.db.execute(
+                    "SELECT key, reply, tokens, vector FROM responses "
+                    "WHERE scope = ? AND embedder = ? AND created_at > ?",
+                    (scope, embedder, now - self.ttl),
+                ).fetchall()
+            if rows:
+                matrix = np.stack([np.frombuffer(r[3], dtype=np.float32) for r in rows])
+                scores = matrix @ vector.astype(np.float32)
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    row = rows[best][:3] + (float(scores[best]),)
+                    kind = "semantic"
+        with self._lock:
+            if row is None:
+                self._bump(lookups=1, misses=1)
+                self.db.commit()
+                return None
+            self.db.execute("UPDATE responses SET hits = hits + 1, last_used = ? WHERE key = ?", (now, row[0]))
+            self._bump(lookups=1, hits=1, saved_tokens=row[2])
+            self.db.commit()
+        return {"reply": row[1], "kind": kind, "similarity": row[3], "tokens": row[2]}
+
+    def store(self, model, system_prompt, prompt, reply, tokens):
+        normalized = normalize_prompt(prompt)
+        scope = digest(model, system_prompt)
+        embedder, vector = self.embed(normalized)
+        now = time.time()
+        with self._lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses "
+                "(key, scope, prompt, reply, tokens, embedder, vector, created_at, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (digest(scope, normalized), scope, normalized, reply, int(tokens or 0), embedder,
+                 vector.astype(np.float32).tobytes(), now, now),
+            )
+            self.evict(now)
+            self.db.commit()
+
+    def evict(self, now):
+        self.db.execute("DELETE FROM responses WHERE created_at <= ?", (now - self.ttl,))
+        self.db.execute(
+            "DELETE FROM responses WHERE key IN ("
+            "SELECT key FROM responses ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self.db.execute("SELECT name, value FROM counters").fetchall())
+            entries = self.db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        lookups = counters.get("lookups", 0)
+        return {
+            "entries": entries,
+            "lookups": lookups,
+            "hits": counters.get("hits", 0),
+            "hit_ratio": counters.get("hits", 0) / lookups if lookups else 0.0,
+            "saved_tokens": counters.get("saved_tokens", 0),
+        }
+
+
+def is_follow_up(prompt, history):
+    """True when prompt, asked after the messages in history, probably needs them to be answered."""
+    if not history:
+        return False
+    return len(normalize_prompt(prompt).split()) <= FOLLOW_UP_MAX_WORDS or bool(FOLLOW_UP_WORDS.search(prompt))
+
+
+def format_cache_stats(stats):
+    return (
+        f"Response cache: {stats['hits']}/{stats['lookups']} hits ({stats['hit_ratio']:.0%}), "
+        f"{stats['saved_tokens']:,} tokens saved, {stats['entries']} entries"
+    )
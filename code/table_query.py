@@ -0,0 +1,239 @@
+import csv
+import io
+import re
+import sqlite3
+import threading
+import time
+
+import pandas as pd
+
+from chat_history import count_tokens
+
+try:
+    import duckdb
+except ImportError:  # SQLite from the standard library is used instead
+    duckdb = None
+
+TABLE_TYPES = ("csv", "xlsx")
+SAMPLE_ROWS = 5  # Rows of each table shown to the model
+TOP_VALUES = 3  # Most frequent values listed for text columns
+MAX_RESULT_ROWS = 50  # Rows of a query result sent back to the model
+RESULT_TOKEN_BUDGET = 1500  # Most tokens of one query result
+QUERY_SECONDS = 10  # Queries running longer are interrupted
+MAX_SQL_STEPS = 4  # Queries the model may run before answering
+
+SQL_PROMPT = (
+    "You answer questions about the tables below by querying them with SQL ({dialect}). "
+    "Do not compute totals, averages or counts yourself; query them. "
+    "To run a query, reply with exactly one ```sql``` code block containing one SELECT statement and nothing else. "
+    "You will get its result and may run more queries. When the results so far are enough to answer "
+    "the question, or the question does not need the tables, reply with DONE only.\n\n{schema}"
+)
+
+
+class TableQueryError(Exception):
+    pass
+
+
+def table_name(name, taken):
+    base = re.sub(r"\W+", "_", name.rsplit(".", 1)[0]).strip("_").lower() or "data"
+    if base[0].isdigit():
+        base = f"t_{base}"
+    candidate, n = base, 2
+    while candidate in taken:
+        candidate, n = f"{base}_{n}", n + 1
+    return candidate
+
+
+def read_tables(name, data):
+    """Return {table_name: DataFrame} for a CSV file or every sheet of an XLSX workbook."""
+    extension = name.rsplit(".", 1)[-1].lower()
+    if extension == "csv":
+        frames = {name: pd.read_csv(io.BytesIO(data))}
+    elif extension == "xlsx":
+        frames = pd.read_excel(io.BytesIO(data), sheet_name=None)
+    else:
+        raise TableQueryError(f"Not a table file: {name}")
+    tables = {}
+    for source, frame in frames.items():
+        frame.columns = [str(c) for c in frame.columns]
+        tables[table_name(name if extension == "csv" else str(source), tables)] = frame
+    return tables
+
+
+def column_stats(series):
+    nulls = int(series.isna().sum())
+    values = series.dropna()
+    text = f"{series.dtype}, {nulls} null" if nulls else f"{series.dtype}"
+    if values.empty:
+        return text
+    if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+        return f"{text}, min {values.min():g}, max {values.max():g}, mean {values.mean():.4g}"
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return f"{text}, from {values.min()} to {values.max()}"
+    top = values.astype(str).value_counts().head(TOP_VALUES)
+    listed = ", ".join(f"{value[:40]!r} ({count})" for value, count in top.items())
+    return f"{text}, {values.nunique()} distinct, most common {listed}"
+
+
+def to_csv(columns, rows):
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator="\n")
+    writer.writerow(columns)
+    writer.writerows(rows)
+    return out.getvalue()
+
+
+class TableDB:
+    """Uploaded CSV/XLSX tables in an in-memory DuckDB (or SQLite) database the model can query.
+
+    Only the schema, column statistics and a few sample rows go into the
+    prompt; the model asks for the numbers it needs with SELECT statements,
+    which are computed here and returned as compact CSV.
+    """
+
+    def __init__(self, name, data):
+        self.name = name
+        self.frames = read_tables(name, data)
+        self._lock = threading.Lock()
+        if duckdb is not None:
+            self.dialect = "DuckDB"
+            self.db = duckdb.connect(":memory:")
+            for table, frame in self.frames.items():
+                self.db.register(f"{table}_frame", frame)
+                self.db.execute(f'CREATE TABLE "{table}" AS SELECT * FROM "{table}_frame"')
+                self.db.unregister(f"{table}_frame")
+            # Queries come from the model: no reading or writing of files on this host
+            self.db.execute("SET enable_external_access = false")
+        else:
+            self.dialect = "SQLite"
+            self.db = sqlite3.connect(":memory:", check_same_thread=False)
+            for table, frame in self.frames.items():
+                frame.to_sql(table, self.db, index=False)
+            self.db.execute("PRAGMA query_only = ON")
+
+    def describe(self, sample_rows=SAMPLE_ROWS):
+        parts = []
+        for table, frame in self.frames.items():
+            lines = [f"Table {table} ({len(frame):,} rows) from {self.name}:"]
+            lines += [f'  "{column}": {column_stats(frame[column])}' for column in frame.columns]
+            sample = frame.head(sample_rows)
+            lines.append(f"First {len(sample)} rows:")
+            lines.append(to_csv(sample.columns, sample.itertuples(index=False)).rstrip())
+            parts.append("\n".join(lines))
+        return "\n\n".join(parts)
+
+    def query(self, sql, max_rows=MAX_RESULT_ROWS):
+        """Run one read-only SELECT; return (columns, rows, more) or raise TableQueryError.
+
+        At most max_rows rows are fetched, so a huge result never reaches
+        this process; more tells whether the result had further rows.
+        """
+        statement = single_select(sql)
+        with self._lock:
+            try:
+                if duckdb is not None:
+                    timer = threading.Timer(QUERY_SECONDS, self.db.interrupt)
+                    timer.start()
+                    try:
+                        cursor = self.db.execute(statement)
+                        columns = [d[0] for d in cursor.description]
+                        rows = cursor.fetchmany(max_rows + 1)
+                    finally:
+                        timer.cancel()
+                else:
+                    deadline = time.monotonic() + QUERY_SECONDS
+                    self.db.set_progress_handler(lambda: time.monotonic() > deadline, 10000)
+                    try:
+                        cursor = self.db.execute(statement)
+                        columns = [d[0] for d in cursor.description]
+                        rows = cursor.fetchmany(max_rows + 1)
+                    finally:
+                        self.db.set_progress_handler(None, 0)
+            except TableQueryError:
+                raise
+            except Exception as e:
+                raise TableQueryError(str(e)) from e
+        return columns, rows[:max_rows], len(rows) > max_rows
+
+    def parses(self, sql):
+        """True when sql is one SELECT the database accepts, checked with EXPLAIN without running it."""
+        try:
+            statement = single_select(sql)
+            with self._lock:
+                self.db.execute(f"EXPLAIN {statement}").fetchall()
+        except Exception:
+            return False
+        return True
+
+    def query_text(self, sql):
+        try:
+            columns, rows, more = self.query(sql)
+        except TableQueryError as e:
+            return f"Error: {e}", False
+        fetched = len(rows)
+        text = to_csv(columns, rows)
+        # Cut whole rows from the end until the result fits its budget
+        while count_tokens(text) > RESULT_TOKEN_BUDGET and rows:
+            rows = rows[:len(rows) // 2] if len(rows) > 1 else []
+            text = to_csv(columns, rows)
+        if more:
+            text += "(more rows not shown; aggregate or add LIMIT)\n"
+        elif len(rows) < fetched:
+            text += f"({fetched - len(rows)} more rows not shown; aggregate or add LIMIT)\n"
+        return text, True
+
+
+def single_select(sql):
+    statement = re.sub(r"--[^\n]*|/\*.*?\*/", " ", sql, flags=re.S).strip().rstrip(";").strip()
+    if not re.match(r"(?i)^(select|with)\b", statement) or ";" in statement:
+        raise TableQueryError("Only a single SELECT statement is allowed")
+    return statement
+
+
+def extract_sql(reply, table_db):
+    match = re.search(r"```sql\s*(.*?)```", reply, re.S | re.I)
+    if match:
+        return match.group(1).strip()
+    # An unfenced reply counts as a query only if it parses; prose such as "With 12 rows, ..." is the answer
+    match = re.match(r"\s*((select|with)\b.*)", reply, re.S | re.I)
+    if match and table_db.parses(match.group(1)):
+        return match.group(1).strip()
+    return None
+
+
+def run_sql_steps(table_db, question, complete, max_steps=MAX_SQL_STEPS):
+    """Let the model query the tables before it answers.
+
+    complete(messages) returns the model's reply text. Returns the queries
+    run, as [{"sql", "result", "ok", "seconds"}], for the answer prompt, and
+    the error that ended the loop early, if any.
+    """
+    messages = [
+        {"role": "system", "content": SQL_PROMPT.format(dialect=table_db.dialect, schema=table_db.describe())},
+        {"role": "user", "content": question},
+    ]
+    steps = []
+    for _ in range(max_steps):
+        try:
+            reply = complete(messages)
+        except Exception as e:
+            # The results gathered so far are still useful for the answer
+            return steps, str(e)
+        sql = extract_sql(reply, table_db)
+        if not sql:
+            break
+        started = time.perf_counter()
+        result, ok = table_db.query_text(sql)
+        steps.append({"sql": sql, "result": result, "ok": ok, "seconds": time.perf_counter() - started})
+        messages += [
+            {"role": "assistant", "content": f"```sql\n{sql}\n```"},
+            {"role": "user", "content": f"[Query Result]:\n{result}"},
+        ]
+    return steps, None
+
+
+def format_steps(steps):
+    return "\n\n".join(
+        f"Query {i}:\n```sql\n{step['sql']}\n```\nResult:\n{step['result']}" for i, step in enumerate(steps, 1)
+    )
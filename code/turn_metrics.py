@@ -0,0 +1,121 @@
+import logging
+import time
+
+try:
+    import prometheus_client
+except ImportError:  # Metrics export is optional; the breakdown still works without it
+    prometheus_client = None
+
+logger = logging.getLogger(__name__)
+
+# Phases of one chat turn, in the order they happen
+PHASES = ["extract", "search", "map_reduce", "table_query", "prompt_build", "queue", "network", "first_token", "completion", "render"]
+PHASE_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+RECENT_TURNS = 20  # Turns kept for the debug sidebar
+
+
+class TurnTimer:
+    """Seconds spent in each named phase of one chat turn.
+
+    lap(name) charges the time since the previous lap to a phase, so the
+    chatbot only marks where each phase ends.
+    """
+
+    def __init__(self):
+        self.phases = {}
+        self.mark = time.perf_counter()
+
+    def add(self, name, seconds):
+        if seconds:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def lap(self, name):
+        now = time.perf_counter()
+        self.add(name, now - self.mark)
+        self.mark = now
+
+    def finish_reply(self, stats):
+        # The backend part of the reply is split with the timestamps chat_stream recorded
+        # (connect and send, prefill until the first token, decoding); the rest is rendering
+        now = time.perf_counter()
+        elapsed = now - self.mark
+        self.mark = now
+        backend = 0.0
+        responded = stats.response_at or stats.end
+        if responded is not None:
+            backend += self._add_part("network", responded - stats.start)
+        if stats.first_token_at is not None:
+            backend += self._add_part("first_token", stats.first_token_at - (stats.response_at or stats.start))
+            if stats.end is not None:
+                backend += self._add_part("completion", stats.end - stats.first_token_at)
+        self.add("render", max(elapsed - backend, 0.0))
+
+    def _add_part(self, name, seconds):
+        seconds = max(seconds, 0.0)
+        self.add(name, seconds)
+        return seconds
+
+    @property
+    def total(self):
+        return sum(self.phases.values())
+
+    def as_dict(self):
+        return {name: self.phases[name] for name in PHASES if name in self.phases}
+
+
+def format_phases(phases):
+    return " · ".join(f"{name.replace('_', ' ')} {seconds:.2f}s" for name, seconds in phases.items())
+
+
+class TurnMetrics:
+    """Prometheus counters and histograms for chat turns, served from a sidecar HTTP endpoint."""
+
+    def __init__(self, port, addr="0.0.0.0", prefix="chatbot"):
+        # A private registry, so a second chatbot in the same process cannot clash on metric names
+        self.registry = prometheus_client.CollectorRegistry()
+        self.turns = prometheus_client.Counter(
+            f"{prefix}_turns", "Chat turns", ["model", "role", "outcome"], registry=self.registry
+        )
+        self.tokens = prometheus_client.Counter(
+            f"{prefix}_completion_tokens", "Tokens generated", ["model", "role"], registry=self.registry
+        )
+        self.cancellations = prometheus_client.Counter(
+            f"{prefix}_cancellations", "Generations stopped by the user, by whether the backend confirmed the abort",
+            ["model", "role", "confirmation"], registry=self.registry,
+        )
+        self.phase_seconds = prometheus_client.Histogram(
+            f"{prefix}_turn_phase_seconds", "Seconds spent in each phase of a chat turn",
+            ["model", "role", "phase"], buckets=PHASE_BUCKETS, registry=self.registry,
+        )
+        self.turn_seconds = prometheus_client.Histogram(
+            f"{prefix}_turn_seconds", "Seconds for a whole chat turn",
+            ["model", "role"], buckets=PHASE_BUCKETS, registry=self.registry,
+        )
+        prometheus_client.start_http_server(port, addr=addr, registry=self.registry)
+
+    def observe(self, model, role, timer, tokens=None, outcome="ok"):
+        self.turns.labels(model, role, outcome).inc()
+        if tokens:
+            self.tokens.labels(model, role).inc(tokens)
+        for name, seconds in timer.phases.items():
+            self.phase_seconds.labels(model, role, name).observe(seconds)
+        self.turn_seconds.labels(model, role).observe(timer.total)
+
+    def cancelled(self, model, role, tokens=None):
+        self.turns.labels(model, role, "cancelled").inc()
+        if tokens:
+            self.tokens.labels(model, role).inc(tokens)
+
+    def cancel_confirmation(self, model, role, confirmation):
+        self.cancellations.labels(model, role, confirmation).inc()
+
+
+def start_metrics(port):
+    """Return a TurnMetrics serving on port, or None when disabled, unavailable or the port is taken."""
+    if not port or prometheus_client is None:
+        return None
+    try:
+        return TurnMetrics(port)
+    except OSError as e:
+        logger.warning(f"Metrics endpoint not started on port {port}: {e}")
+        return None
@@ -0,0 +1,299 @@
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from html.parser import HTMLParser
+
+import requests
+
+from chat_history import count_tokens
+
+try:
+    from duckduckgo_search import DDGS
+except ImportError:
+    DDGS = None
+
+RESULTS_PER_QUERY = 5
+FETCH_PAGES = 4  # Top results whose pages are read
+SEARCH_DEADLINE = 5  # Seconds for all search queries together
+PAGE_DEADLINE = 4  # Seconds for all page fetches together; slower pages are skipped
+MAX_PAGE_BYTES = 2 * 1024 * 1024
+SEARCH_TTL = 15 * 60  # Seconds search results are reused
+PAGE_TTL = 60 * 60  # Seconds fetched page text is reused
+SEARCH_TOKEN_BUDGET = 2500  # Most tokens of search context sent with one question
+MIN_PARAGRAPH_CHARS = 40  # Shorter text blocks are menus, buttons and captions
+MAX_EXCERPT_CHARS = 600  # Longer paragraphs are split at sentence ends so excerpts fit the budget
+DUPLICATE_OVERLAP = 0.6  # Share of a paragraph's word shingles already seen that makes it a duplicate
+USER_AGENT = "Mozilla/5.0 (compatible; TechTeamChatbot/1.0)"
+
+STOPWORDS = {
+    "a", "an", "and", "are", "can", "could", "do", "does", "for", "from", "how", "i", "in", "is", "it",
+    "me", "my", "of", "on", "or", "please", "should", "tell", "that", "the", "this", "to", "was",
+    "what", "when", "where", "which", "who", "why", "will", "with", "would", "you", "about",
+}
+FRESH_WORDS = {"latest", "current", "recent", "today", "new", "newest", "now"}
+SKIP_TAGS = {"head", "script", "style", "noscript", "nav", "header", "footer", "aside", "form", "svg", "button", "select"}
+BLOCK_TAGS = {"p", "li", "pre", "blockquote", "td", "th", "dd", "dt", "h1", "h2", "h3", "h4", "h5", "h6",
+              "div", "section", "article", "main", "br", "tr"}
+
+
+class TTLCache:
+    """Small thread-safe dict whose entries expire; the oldest entries are dropped beyond max_entries."""
+
+    def __init__(self, ttl, max_entries=512):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None or time.time() - entry[0] > self.ttl:
+                return None
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time(), value)
+            while len(self.entries) > self.max_entries:
+                del self.entries[next(iter(self.entries))]
+
+
+def keywords(text):
+    return [w for w in re.findall(r"[\w.+#-]+", text.lower()) if w not in STOPWORDS]
+
+
+def query_variants(query):
+    # The question as typed, its keywords alone, and a dated form for questions about recent events
+    words = keywords(query)
+    variants = [query.strip(), " ".join(words)]
+    if FRESH_WORDS & set(words):
+        variants.append(" ".join(w for w in words if w not in FRESH_WORDS) + f" {time.strftime('%Y')}")
+    unique = []
+    for variant in variants:
+        if variant and variant.lower() not in (u.lower() for u in unique):
+            unique.append(variant)
+    return unique
+
+
+class ReadableText(HTMLParser):
+    """Collects the text blocks of an HTML page, leaving out scripts, navigation and other chrome."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.blocks = []
+        self.current = []
+        self.skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIP_TAGS:
+            self.skip_depth += 1
+        elif tag in BLOCK_TAGS:
+            self.flush()
+
+    def handle_endtag(self, tag):
+        if tag in SKIP_TAGS and self.skip_depth:
+            self.skip_depth -= 1
+        elif tag in BLOCK_TAGS:
+            self.flush()
+
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self.current.append(data)
+
+    def flush(self):
+        text = " ".join("".join(self.current).split())
+        if text:
+            self.blocks.append(text)
+        self.current = []
+
+
+def extract_readable(html):
+    parser = ReadableText()
+    try:
+        parser.feed(html)
+        parser.close()
+    except Exception:
+        pass
+    parser.flush()
+    return [
+        piece for block in parser.blocks if len(block) >= MIN_PARAGRAPH_CHARS
+        for piece in split_paragraph(block)
+    ]
+
+
+def split_paragraph(text, limit=MAX_EXCERPT_CHARS):
+    pieces = []
+    current = ""
+    for sentence in re.split(r"(?<=[.!?])\s+", text):
+        while len(sentence) > limit:
+            pieces.append(sentence[:limit])
+            sentence = sentence[limit:]
+        if current and len(current) + len(sentence) + 1 > limit:
+            pieces.append(current)
+            current = ""
+        current = f"{current} {sentence}".strip()
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def shingles(text, size=5):
+    words = re.findall(r"\w+", text.lower())
+    return {" ".join(words[i:i + size]) for i in range(max(len(words) - size + 1, 1))}
+
+
+class WebSearcher:
+    """Search stage for the chatbot: query variants and page fetches run concurrently.
+
+    Search results and page text are cached with TTLs, every network step has a
+    deadline, and the readable, de-duplicated text of the best pages is trimmed
+    to a token budget before it is sent with the question.
+    """
+
+    def __init__(self, fetch_pages=FETCH_PAGES, token_budget=SEARCH_TOKEN_BUDGET,
+                 search_deadline=SEARCH_DEADLINE, page_deadline=PAGE_DEADLINE):
+        self.fetch_pages = fetch_pages
+        self.token_budget = token_budget
+        self.search_deadline = search_deadline
+        self.page_deadline = page_deadline
+        self.search_cache = TTLCache(SEARCH_TTL)
+        self.page_cache = TTLCache(PAGE_TTL)
+        self.pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix="web-search")
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = USER_AGENT
+        adapter = requests.adapters.HTTPAdapter(pool_connections=32, pool_maxsize=32)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def search_query(self, query):
+        cached = self.search_cache.get(query.lower())
+        if cached is not None:
+            return cached, True
+        with DDGS() as ddgs:
+            results = list(ddgs.text(query, max_results=RESULTS_PER_QUERY) or [])
+        self.search_cache.put(query.lower(), results)
+        return results, False
+
+    def fetch_page(self, url, deadline):
+        cached = self.page_cache.get(url)
+        if cached is not None:
+            return cached, True
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return [], False
+        with self.session.get(url, timeout=(min(remaining, 2), remaining), stream=True) as response:
+            response.raise_for_status()
+            content_type = response.headers.get("Content-Type", "text/html")
+            if "html" not in content_type and "text/plain" not in content_type:
+                return [], False
+            body = bytearray()  # Extended in place; bytes += would copy the whole page for every chunk
+            for chunk in response.iter_content(64 * 1024):
+                body.extend(chunk)
+                # The read timeout is per chunk; the deadline bounds the whole page
+                if len(body) > MAX_PAGE_BYTES or time.monotonic() > deadline:
+                    break
+            html = body.decode(response.encoding or "utf-8", errors="replace")
+        paragraphs = extract_readable(html)
+        self.page_cache.put(url, paragraphs)
+        return paragraphs, False
+
+    def search(self, query):
+        """Return {"text", "sources", "pages", "cache_hits", "tokens", "seconds"} for the prompt."""
+        started = time.perf_counter()
+        if DDGS is None:
+            return self.result("\n\n[Web Search Results]: Web search is unavailable (duckduckgo_search is not installed).", [], 0, 0, started)
+        variants = query_variants(query)
+        futures = {self.pool.submit(self.search_query, v): rank for rank, v in enumerate(variants)}
+        done, _ = wait(futures, timeout=self.search_deadline)
+        # Merge the variants' results; a page found by several variants ranks by its best position
+        merged = {}
+        cache_hits = 0
+        errors = []
+        for future in done:
+            try:
+                results, hit = future.result()
+            except Exception as e:
+                errors.append(str(e))
+                continue
+            cache_hits += hit
+            for position, result in enumerate(results):
+                url = result.get("href")
+                if not url:
+                    continue
+                score = (position, futures[future])
+                if url not in merged or score < merged[url]["score"]:
+                    merged[url] = dict(result, score=score)
+        if not merged:
+            message = f"Error performing web search: {errors[0]}" if errors else "No relevant results found."
+            return self.result(f"\n\n[Web Search Results]: {message}", [], 0, cache_hits, started)
+        sources = sorted(merged.values(), key=lambda r: r["score"])
+
+        deadline = time.monotonic() + self.page_deadline
+        page_futures = {self.pool.submit(self.fetch_page, s["href"], deadline): s for s in sources[:self.fetch_pages]}
+        done, _ = wait(page_futures, timeout=self.page_deadline)
+        pages = {}
+        for future in done:
+            try:
+                paragraphs, hit = future.result()
+            except Exception:
+                continue
+            cache_hits += hit
+            pages[page_futures[future]["href"]] = paragraphs
+
+        text = self.build_context(query, sources, pages)
+        return self.result(text, sources, len(pages), cache_hits, started)
+
+    def build_context(self, query, sources, pages):
+        # Snippets of every result first, then the most relevant new paragraphs of the fetched pages
+        terms = set(keywords(query))
+        header = "\n\n[Web Search Results]:\n"
+        used = count_tokens(header)
+        entries = []
+        for i, source in enumerate(sources, 1):
+            entry = f"{i}. {source.get('title', '')}\n   {source.get('body', '')}\n   Source: {source['href']}\n"
+            tokens = count_tokens(entry)
+            if used + tokens > self.token_budget:
+                break
+            used += tokens
+            entries.append({"entry": entry, "excerpts": []})
+        seen = set()
+        for entry, source in zip(entries, sources):
+            seen |= shingles(source.get("body", ""))
+        candidates = []
+        for index, (entry, source) in enumerate(zip(entries, sources)):
+            for order, paragraph in enumerate(pages.get(source["href"], [])):
+                overlap = len(terms & set(keywords(paragraph)))
+                if overlap:
+                    candidates.append((-overlap, index, order, paragraph))
+        for _, index, order, paragraph in sorted(candidates):
+            paragraph_shingles = shingles(paragraph)
+            if len(paragraph_shingles & seen) >= DUPLICATE_OVERLAP * len(paragraph_shingles):
+                continue
+            line = f"   > {paragraph}\n"
+            tokens = count_tokens(line)
+            if used + tokens > self.token_budget:
+                continue
+            used += tokens
+            seen |= paragraph_shingles
+            entries[index]["excerpts"].append((order, line))
+        return header + "".join(e["entry"] + "".join(line for _, line in sorted(e["excerpts"])) for e in entries)
+
+    def result(self, text, sources, pages, cache_hits, started):
+        return {
+            "text": text,
+            "sources": [{"title": s.get("title", ""), "href": s["href"]} for s in sources],
+            "pages": pages,
+            "cache_hits": cache_hits,
+            "tokens": count_tokens(text),
+            "seconds": time.perf_counter() - started,
+        }
+
+
+def format_search(search):
+    return (
+        f"Web search: {len(search['sources'])} results, {search['pages']} pages read, "
+        f"{search['tokens']} tokens, {search['cache_hits']} cache hits, {search['seconds']:.1f}s"
+    )